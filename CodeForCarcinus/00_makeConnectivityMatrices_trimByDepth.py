@@ -99,9 +99,8 @@ def makeTranspose(inParam):
     transposeFileName='transposes/Etranspose'+rootFileName
     connectFileName='transposes/E'+rootFileName
 
-    #load a number of matrices to play with, and combine them to get a seasonal matrix
-    store=zarr.MemoryStore()
-    E=mcm.makeEmptyConnectivity(store)
+    #the names of the matrices to combine to get a seasonal matrix
+    matInFiles=[]
 
     #loop over the regions that you wish to include -- there is no
     #need to download the data for a region if that region is not
@@ -110,7 +109,6 @@ def makeTranspose(inParam):
     #disk space. 
     for regionName in ['theAmericas']:#['AsiaPacific', 'EuropeAfricaMiddleEast', 'theAmericas']:
         for month in inMonths:
-            print('   working on month',month,'in region',regionName,'for inParam',inParam,flush=True)
             matInFile=(matDir+
                        '%s/%dm/%s/'%(regionName,depth,vertBehavior)+
                        'climatology_month%2.2d_minPLD%2.2d_maxPLD%2.2d.zip'%(month,minPLD,maxPLD))
@@ -125,22 +123,28 @@ def makeTranspose(inParam):
             #local file that contains the same data. Details as to
             #where and how this done, and where the data is
             #stored, can be found in the getEZfateFromOSN module.
-            matInFile=getEZfateFromOSN.getFileFromOSN(matInFile)
-            matIn=zarr.open(matInFile,'r')
-
-            #if a habitat is defined by depth of habitat, then we
-            #need a dictionary that gives the depth of the habitat at the
-            #potential release depths
-            gridDict=mcm.getDepthDict(matIn.nxFrom[:],matIn.nyFrom[:])
-
-            #trim to all points within gridRadius of land
-            #keep all true points, even if they fall outside of To, so we can
-            #latter accurately count the number of points launched. 
-            print('   trimming by distance from land')
-            gridRadius=2.1*sqrt(2)
-            matIn=mcm.trimConnectivity(matIn,gridDict,minHabDepth,maxHabDepth,keepAllTo=True)
-
-            mcm.combineConnectivity(E,matIn)
+            matInFiles.append(getEZfateFromOSN.getFileFromOSN(matInFile))
+
+    #if a habitat is defined by depth of habitat, then we need the
+    #depth of the habitat at every point of the model grid. It is
+    #read once, and then kept; see mcm.gridGeometry()
+    habitatGrid=mcm.gridGeometry('depth')
+
+    #each matrix is trimmed by this function before it is combined
+    def trimMatIn(matIn):
+        #trim to all points within gridRadius of land
+        #keep all true points, even if they fall outside of To, so we can
+        #latter accurately count the number of points launched. 
+        print('   trimming by distance from land',flush=True)
+        return mcm.trimConnectivity(matIn,habitatGrid,minHabDepth,maxHabDepth,keepAllTo=True)
+
+    #read, trim and combine all of the matrices at once. They are read
+    #nThread at a time, and each is held in memory while it is
+    #trimmed, so nThread limits the memory used; see
+    #mcm.combineMany()
+    print('   reading and combining',len(matInFiles),'matrices for inParam',inParam,flush=True)
+    E=mcm.combineMany(matInFiles,zarr.MemoryStore(),prepare=trimMatIn,nThread=4)
+
     print('DONE reading in',inParam,'which has',E.nxFrom.shape[0],'points',flush=True)
     print(' ',flush=True)
 
@@ -154,16 +158,14 @@ def makeTranspose(inParam):
     #breakpoint()
 
     #now trim to only include habitat inside of the regionPoly
-    #polygon
+    #polygon. This also gets rid of the *To points which are not
+    #starting points of E; since the starting points were all
+    #trimmed to the habitat above, this leaves only *To points in
+    #the habitat
     print('trimming by polygon')
     E=mcm.trimConnectivity_byPoly(E,regionPoly,keepInPoly=True)
     #breakpoint()
 
-    #now trim connectivity again, but this time get rid of *To
-    #points that land outside of habitat
-    print('trimming To points')
-    E=mcm.trimConnectivity(E,gridDict,minHabDepth,maxHabDepth,keepAllTo=False)
-
     #write out connectivity matrix
     #breakpoint()
     print('writing connectivity to disk',inParam,flush=True)
@@ -215,7 +217,7 @@ for p in [40]:
 #now, if the following is true, plot your habitat
 if True:
     EwhereTo,EnumTo,EfracReturn,Ecumsum,\
-        nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=cLM.makeLinearModel(connectFileName)
+        nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=cLM.makeLinearModel(connectFileName,useDicts=False)
 
     #how big is domain
     Ndomain=len(nxny2nlin)
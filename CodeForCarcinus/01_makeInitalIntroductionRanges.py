@@ -31,7 +31,7 @@ if not os.path.exists('initialConditions'):
 ConnectivityModelName='E_CmaenasHab_depth1_minPLD40_maxPLD40_months5_to_6'
 EfileName='transposes/'+ConnectivityModelName+'.zarr'
 EwhereTo,EnumTo,EfracReturn,Ecumsum,\
-    nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=cLM.makeLinearModel(EfileName)
+    nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=cLM.makeLinearModel(EfileName,useDicts=False,useCache=True)
 fileNameOut='initialConditions/'+ConnectivityModelName+'.zip'
 
 #how big is domain
@@ -4,9 +4,14 @@ import zarr
 import xarray as xr
 import time
 import os
+import sys
 import multiprocessing as mp
 from multiprocessing import shared_memory
 import createLinearModel_module as cLM
+import populationKernels_module as pkm
+import checkpoint_module as ckm
+import rngStreams_module as rsm
+import outputStore_module as osm
 
 # This code models the stochastic population dynamics of many neutral
 # species in a habitat whose connectivity was defined by the code in
@@ -21,93 +26,91 @@ import createLinearModel_module as cLM
 #Assumes the model output directory modelOutputNeutral exists
 assert os.path.exists('modelOutputNeutral'), 'please create directory modelOutputNeutral to store model output'  
 
-#Initialize random number generator
-rng=np.random.default_rng()
-
-#We load the large connectivity data in global scope, so we don't have
-#to pass it into the parallel functions each time we call
-#the. Sigh. The connectivity matrix specified by ConnectivityModelName
+#The connectivity matrix specified by ConnectivityModelName
 #was created by 00_makeConnectivityMatrices.py
-print('Loading model',flush=True)
 ConnectivityModelName='E_CmaenasHab_depth1_minPLD40_maxPLD40_months5_to_6'
 EfileName='transposes/'+ConnectivityModelName+'.zarr'
-EwhereTo,EnumTo,EfracReturn,Ecumsum,\
-    nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=cLM.makeLinearModel(EfileName)
-print('       done loading model',flush=True)
+
+#The large connectivity data is loaded once, in the main process (see
+#below), in compressed sparse row form, so the destinations of habitat
+#point n are EwhereTo[Eindptr[n]:Eindptr[n+1]]. It is then copied into
+#shared memory, and the worker processes of the multiprocessing pool
+#attach to it by name with attachConnectivity() when they start, in
+#the same way as P and whereSettle are shared. So there is only one
+#copy of the connectivity in memory no matter how many workers there
+#are, and we don't have to pass it into the parallel functions each
+#time we call them. These globals are filled in by attachConnectivity().
+EwhereTo=None; EnumTo=None; Ecumsum=None; EfracReturn=None; Eindptr=None
+shmConnectivity=[]
+def attachConnectivity(connectivitySpec):
+    #connectivitySpec is made by cLM.makeSharedArrays() in the main process
+    global EwhereTo,EnumTo,Ecumsum,EfracReturn,Eindptr,shmConnectivity
+    shmConnectivity,E=cLM.attachSharedArrays(connectivitySpec)
+    EwhereTo=E['EwhereTo']; EnumTo=E['EnumTo']; Ecumsum=E['Ecumsum']
+    EfracReturn=E['EfracReturn']; Eindptr=E['Eindptr']
+    return None
 
 
 #This function calculates how many larvae are produced by each species, and where
 #they settle given the statistics in the connectivity matrices E.
-def findWhereSettle(Pname,whereSettleName,lowerBound,upperBound,R,Ndomain,Nspecies):
+def findWhereSettle(Pname,whereSettleName,whichSpecies,R,Ndomain,Nspecies,seed,streamKey,dispersalMode,
+                    Pdtype,settleDtype):
     #see below for what these parameters are. Pname and whereSettleName are the
-    #shared memory names for P and whereSettle
+    #shared memory names for P and whereSettle. whichSpecies is an array
+    #of the species this call works on; only species which are not extinct
+    #should be passed in, see pkm.balancedChunks(). The larvae of each
+    #species are dispersed with their own stream of random numbers, made
+    #from seed and streamKey=(run,generation) (see rngStreams_module.py),
+    #so the result does not depend on which process does which species.
+    #dispersalMode is one of the keys of pkm.dispersalModes. Pdtype and
+    #settleDtype are the names of the dtypes of P and whereSettle
 
     tic=time.time()
 
     #The variables P, the population, and whereSettle, the number of
     #larvae which settle at each location for each species, are shared
-    #memory arrays. Only processes those parts of the array that lie
-    #between species lowerBound:upperBound,
-    #e.g. P[:,lowerBound:upperBound] and only change
-    #whereSettle[:,lowerBound:upperBound]. This is more complicated than
+    #memory arrays. Only processes those parts of the array that belong
+    #to the species in whichSpecies, e.g. P[:,whichSpecies] and only
+    #change whereSettle[:,whichSpecies]. This is more complicated than
     #the usual mechanisms for sharing data while multiprocessing, but is
     #much, much faster in this case. 
     shm_P=shared_memory.SharedMemory(name=Pname)
     shm_whereSettle=shared_memory.SharedMemory(name=whereSettleName)
-    P=ndarray((Ndomain,Nspecies),dtype=int,buffer=shm_P.buf)
-    whereSettle=ndarray((Ndomain,Nspecies),dtype=int,buffer=shm_whereSettle.buf)
-
-    #Only work on species that exist. To do this, find the total
-    #population of each species by suming along the space axes. P has
-    #dimensions [space,species]
-    Psum=P.sum(axis=0)
-    
-    #now loop over species, and find where the larvae of each settle.
-    for nsp in range(lowerBound,upperBound):
-        if Psum[nsp]>0:
-            #Pvec=P[:,nsp]
-
-            #What is total number of larvae launched from each point which survive
-            totalSurvive=R*P[:,nsp]*EfracReturn #note, can be much less than 1!
-
-            #Now convert totalSurvive into an array of integers. The
-            #likelyhood that it is rounded up is the fractional part,
-            #the likelyhood that it is round down is the 1-fractional
-            #part. I.e. 1.7 has a 30% chance of being rounded to 2,
-            #and a 70% chance of being rounded to 1. We do this by
-            #adding to totalSurvive a random uniform number between 0
-            #and 1, and then rounding down.
-            intSurvive=floor(rng.random(Ndomain)+totalSurvive).astype(int)
-
-            #define thisWhereSettle, the number of larvae from the
-            #species we are considering now in the loop which settle
-            #at each location. So it is the length of the spatial
-            #domain
-            thisWhereSettle=zeros((Ndomain,),dtype=int)
-            for n in arange(Ndomain)[P[:,nsp]>0]:
-                #make array of integers which is list of which entries in EwhereTo of where the larvae are going
-                whereGoList=searchsorted(Ecumsum[n],rng.random(intSurvive[n]))
-
-                #now make array of what indices in the linear domain the larvae are going into
-                whereSettleInDomain=EwhereTo[n][whereGoList]
-
-                #whereSettle contains the number of larve from the species which reach
-                #each point in the domain.
-                if False:
-                    #this is actually much slower, by a factor of two... But is this true
-                    #for all model configurations? Perhaps experiment and see for your case
-                    thisWhereSettle=thisWhereSettle+bincount(whereSettleInDomain,minlength=Ndomain)
-                else:
-                    for n in whereSettleInDomain:
-                        thisWhereSettle[n]+=1
-
+    P=ndarray((Ndomain,Nspecies),dtype=Pdtype,buffer=shm_P.buf)
+    whereSettle=ndarray((Ndomain,Nspecies),dtype=settleDtype,buffer=shm_whereSettle.buf)
 
-            #put answer into whereSettle
-            whereSettle[:,nsp]=thisWhereSettle
+    #now loop over species, and find where the larvae of each settle.
+    for nsp in whichSpecies:
+        #define thisWhereSettle, the number of larvae from the
+        #species we are considering now in the loop which settle
+        #at each location. So it is the length of the spatial
+        #domain
+        thisWhereSettle=zeros((Ndomain,),dtype=int)
+
+        #The number of larvae launched from each point which
+        #survive is R*P*EfracReturn, stochastically rounded to an
+        #integer, and each surviving larva settles at a location
+        #picked at random from the connectivity. This used to be
+        #done in a python loop over the habitat points, and was
+        #the dominant cost of the model; pkm.disperseLarvae() does
+        #all of it in compiled code. See populationKernels_module.py
+        #for the dispersalMode's.
+        speciesRng=rsm.streamRng(seed,rsm.dispersalStream,*streamKey,nsp)
+        pkm.disperseLarvae(P[:,nsp],R,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,speciesRng,thisWhereSettle,
+                           pkm.dispersalModes[dispersalMode])
+
+        #put answer into whereSettle, checking it is not too
+        #large to be stored in it
+        pkm.checkFits(thisWhereSettle,settleDtype,'the number of settlers')
+        whereSettle[:,nsp]=thisWhereSettle
 
     #print('      done with a processes in mp.Pool in',time.time()-tic,flush=True)
     return None #all communication done through shared memory arrays
 
+#pool.imap_unordered() passes a single argument, so unpack it
+def findWhereSettleStar(args):
+    return findWhereSettle(*args)
+
 #write a function that determines how many of the larvae in
 #whereSettle survive to be adults in P.  Now there are two
 #possibilities: Where the total number of larvae reaching a location
@@ -116,12 +119,17 @@ def findWhereSettle(Pname,whereSettleName,lowerBound,upperBound,R,Ndomain,Nspeci
 #function so it is easy to profile. NOTE WELL, assume all fitness
 #differences are in the fecundity and dispersal, and thus handled by
 #findWhereSettle() and not in whichLarvaeSurvive() 
-def whichLarvaeSurvive(Pname,whereSettleName,lowerBound,upperBound,Pmax,Ndomain,Nspecies):
+def whichLarvaeSurvive(Pname,whereSettleName,lowerBound,upperBound,Pmax,Ndomain,Nspecies,seed,streamKey,
+                       Pdtype,settleDtype):
     #inputs:
     #  P: population matrix (Ndomain,Nspecies). Pass in name of shared memory in which it is stored
     #  whereSettle: (Ndomain,Nspecies) number of larvae of each species
     #     which reach each locations. Pass in name of shared memory in which it is stored
     #  Pmax, Ndomain, and Nspecies as defined below
+    #  seed,streamKey: make the streams of random numbers, as in findWhereSettle(). Each
+    #     block of rsm.cellsPerStream habitat points has its own stream, so lowerBound
+    #     must be at the start of a block; see rsm.blockChunks()
+    #  Pdtype, settleDtype: the names of the dtypes of P and whereSettle
 
     #NOTE, THIS CODE ASSUMES P HAS BEEN ZERO'D OUT BEFORE IT IS CALLED!!!!
 
@@ -132,330 +140,549 @@ def whichLarvaeSurvive(Pname,whereSettleName,lowerBound,upperBound,Pmax,Ndomain,
     #change whereSettle[:,lowerBound:upperBound]
     shm_P=shared_memory.SharedMemory(name=Pname)
     shm_whereSettle=shared_memory.SharedMemory(name=whereSettleName)
-    P=ndarray((Ndomain,Nspecies),dtype=int,buffer=shm_P.buf)
-    whereSettle=ndarray((Ndomain,Nspecies),dtype=int,buffer=shm_whereSettle.buf)
-
-    #find total number of recruits into each location, and put them in
-    #population if the number is less or equal than Pmax. Not that all
-    #arrays are of shape [spaceIndex,speciesIndex]
-    totalRecruits=whereSettle.sum(axis=1)
-
-    #find which locations this call to whichLarvaeSurvive() will deal with...
-    #make an indx of all False's, then fill area we are interested in with True
-    indxWorryAbout=zeros((Ndomain,),dtype=bool)
-    indxWorryAbout[lowerBound:upperBound]=True
-    
-    #Fill all locations where the number of larvae attempting to settle in a region
-    #is less than Pmax. This does NOT include case where no larvae get to region!
-    indx=logical_and(totalRecruits<=Pmax,totalRecruits>0)
-    indx=logical_and(indx,indxWorryAbout) #only process between lower and upperBound
-    P[indx,:]=whereSettle[indx,:]
-
-    #now the hard part. if totalRecruits>Pmax, then choose randomly
-    #which recruits survive. How to do this quickly?
-    indx=totalRecruits>Pmax
-    indx=logical_and(indx,indxWorryAbout) #only process between lower and upperBound
-    whichPlaces=arange(Ndomain,dtype=int)[indx]
-    for nin in whichPlaces:
-        #cumulative sum of fraction of settlers by species
-        thisCumsum=cumsum(whereSettle[nin,:])/totalRecruits[nin]
-
-        #randomly choose Pmax survivors by fraction of larvae which
-        #settle there.  note, this does mean there is some chance that
-        #more will survivie then recruited their, but the average
-        #should be right. Is this a problem?
-        whichSpeciesSettle=searchsorted(thisCumsum,rng.random(Pmax))
-
-        #now put them back into P. Note there are two ways to do
-        #this which should be benchmarked
-        if False:
-            P[nin,:]=bincount(whichSpeciesSettle,minlength=Nspecies)
-        else:
-            #P[nin,:]=0 #this is surprizingly slow, do elsewhere. 
-            for n in whichSpeciesSettle:
-                P[nin,n]+=1
+    P=ndarray((Ndomain,Nspecies),dtype=Pdtype,buffer=shm_P.buf)
+    whereSettle=ndarray((Ndomain,Nspecies),dtype=settleDtype,buffer=shm_whereSettle.buf)
+
+    #Where the total number of larvae reaching a location is less than
+    #or equal to Pmax, they all survive. Where it is greater, choose
+    #Pmax survivors randomly from the larvae, without replacement, so
+    #no species can have more recruits than reached the location. This
+    #used to be done in a python loop over the saturated locations;
+    #pkm.recruitDense() does it for all locations between
+    #a block of locations at once, in compiled code, and returns the
+    #survivors as (location,species,number) triplets.
+    for blockStart in range(lowerBound,upperBound,rsm.cellsPerStream):
+        blockEnd=min(blockStart+rsm.cellsPerStream,upperBound)
+        blockRng=rsm.streamRng(seed,rsm.recruitStream,*streamKey,blockStart//rsm.cellsPerStream)
+        cellVec,speciesVec,nRecruit=pkm.recruitDense(whereSettle[blockStart:blockEnd,:],Pmax,blockRng)
+        P[blockStart+cellVec,speciesVec]=nRecruit
 
     #return nothing, everything is communicated via shared memory
     return None
 
+#pool.imap_unordered() passes a single argument, so unpack it
+def whichLarvaeSurviveStar(args):
+    return whichLarvaeSurvive(*args)
+
 __spec__=None
 if __name__=="__main__":
 
+    #load the connectivity and put it in shared memory; see attachConnectivity() above
+    print('Loading model',flush=True)
+    EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,\
+        nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=cLM.makeLinearModel(EfileName,returnCSR=True,
+                                                                         useDicts=False,useCache=True)
+    shmConnectivityMain,connectivitySpec,E=cLM.makeSharedArrays({'EwhereTo':EwhereTo,'EnumTo':EnumTo,
+                                                                  'Ecumsum':Ecumsum,'EfracReturn':EfracReturn,
+                                                                  'Eindptr':Eindptr})
+    EwhereTo=E['EwhereTo']; EnumTo=E['EnumTo']; Ecumsum=E['Ecumsum']
+    EfracReturn=E['EfracReturn']; Eindptr=E['Eindptr']
+    print('       done loading model',flush=True)
+
     #In order to better understand stochastic effects, lets run this
     #model nRun times, and save the results from each model run
     nRun=100; print('WARNING -- RUNNING ONLY 100 TIMES; FOR REAL SCIENCE RUN MORE TIMES')
 
-    #first, loop over model runs -- because results are stochastic, you
-    #want to run it multiple times. nRun controls how many times the model is run
-    for nR in range(nRun):
-        print('Starting run',nR)
-
-        #Define initial population statistics. P array has size
-        #(Ndomain,Nspecies), where Nspecies is the number of species
-        #and Ndomain is the size of the domain. P is an integer array,
-        #since it is the number of individuals in a habitat.
-        #
-        #The carrying capacity of the habitat is Pmax.
-        #
-        #Run model for Tmax generations.
-        #
-        #The number of larvae produced per adult which survives till
-        #it could settle if in suitable habitat is R, which may be a
-        #floating point number..
-        Pmax=1
-        Tmax=601
-        R=16.0
-
-        #define the intial condition file -- this is created by
-        #01_makeInitalIntroductionRanges.py and delineates the regions
-        #into which individual species are introduced.
-        initialConditionFile='initialConditions/'+ConnectivityModelName+'.zip'
-
-        #now, and important and subtle parameter. How many
-        #introductions do we have? I.e. in each species location, how
-        #many adults of a species we are following do we start
-        #with. Call this Nintro. If negative, fill entire species
-        #range defined by the initialConditionsFile. Otherwise just
-        #release Nintro individuals into the domain, as long as each
-        #region they are released into can hold more adults than
-        #Nintro.  All other spaces in the domain are filled with
-        #another species which we do not pay attention to. (It must be
-        #filled with something, so that there is not an intial burst
-        #of population growth to fill the empty habitat. This would
-        #play with various statistics in funny ways.)
-        Nintro=1
+    #The sparse engine can advance nReplicate model runs together, as an
+    #ensemble of independent copies of the habitat held in one set of
+    #arrays, so the overhead of each generation is shared between them.
+    #Memory and the cost of a generation grow in proportion to
+    #nReplicate. The dense engine runs one model run at a time, so
+    #nReplicate must be 1 for it.
+    nReplicate=10
+
+    #Every checkpointEvery generations, the state of the model runs is
+    #saved in the directory checkpoints (see checkpoint_module.py). If
+    #the code is interrupted, run it again with the --resume flag, e.g.
+    #"python 02_manyNeutralSpecies_fastModel.py --resume", and it will
+    #skip the runs that have finished and continue the others from their
+    #last checkpoint, giving the same results as if it had never been
+    #interrupted. The checkpoints can be deleted once all runs are done.
+    checkpointEvery=50
+    resume=('--resume' in sys.argv[1:])
+
+    #All of the random numbers are made from seed (see
+    #rngStreams_module.py), so the results depend only on seed, and not
+    #on nCPU, nReplicate or how the work is split between processes. If
+    #seed is None, a new seed is picked. The seed is saved in each output
+    #file, so a model run can be repeated by setting seed to it. A resumed
+    #run uses the seed saved in its checkpoint.
+    seed=None
+    seed=rsm.makeSeed(seed)
+    print('The seed of the random numbers is',seed)
+
+    #The multiprocessing pool used by the dense engine is made the first
+    #time it is needed, and then kept for all of the model runs, so the
+    #worker processes only start, and attach to the connectivity, once.
+    pool=None
+
+    #the shared memory holding the connectivity is released in the
+    #finally clause below, so it is not left behind in /dev/shm if a
+    #run fails or is interrupted
+    try:
+        #first, loop over model runs -- because results are stochastic, you
+        #want to run it multiple times. nRun controls how many times the model is run,
+        #and the runs in runList are made together
+        for firstRun in range(0,nRun,nReplicate):
+            runList=arange(firstRun,min(firstRun+nReplicate,nRun))
+            print('Starting runs',runList)
+
+            #Define initial population statistics. P array has size
+            #(Ndomain,Nspecies), where Nspecies is the number of species
+            #and Ndomain is the size of the domain. P is an integer array,
+            #since it is the number of individuals in a habitat.
+            #
+            #The carrying capacity of the habitat is Pmax.
+            #
+            #Run model for Tmax generations.
+            #
+            #The number of larvae produced per adult which survives till
+            #it could settle if in suitable habitat is R, which may be a
+            #floating point number..
+            Pmax=1
+            Tmax=601
+            R=16.0
+
+            #How the larvae from each habitat point are sent to their
+            #destinations. 'larvae' places each larva individually, and
+            #its cost scales with R; 'multinomial' draws the number going to
+            #each destination at once, and its cost scales with the number
+            #of destinations; 'auto' picks the cheaper for each habitat
+            #point. All give the same statistics. See populationKernels_module.py
+            dispersalMode='auto'
+
+            #How the population is stored. 'dense' keeps P and whereSettle
+            #as (Ndomain,Nspecies) arrays in shared memory, and does each
+            #generation in parallel over species and habitat points. 'sparse'
+            #keeps, for each habitat point, only the species present and their
+            #numbers, so memory and the cost of a generation scale with the
+            #number of individuals, not with Ndomain*Nspecies; it is much
+            #faster when there are many species. See populationKernels_module.py
+            engineMode='sparse'
+            assert (engineMode=='sparse') or (nReplicate==1),'the dense engine can only run one replicate at a time'
+            nReplicate=len(runList) #the last set of runs may be smaller
+
+            #The integer types in which the population and the number of
+            #settlers are stored, and saved. Pdtype is 'uint8' or 'uint16', or
+            #'auto' to use the smallest which can hold Pmax. settleDtype is
+            #'uint16' or 'uint32'; if more larvae of one species settle in a
+            #habitat point than settleDtype can hold, the model stops with an
+            #error, and a larger one should be used. See populationKernels_module.py
+            Pdtype=pkm.populationDtype(Pmax,'auto').name
+            settleDtype='uint16'
+
+            #define the intial condition file -- this is created by
+            #01_makeInitalIntroductionRanges.py and delineates the regions
+            #into which individual species are introduced.
+            initialConditionFile='initialConditions/'+ConnectivityModelName+'.zip'
+
+            #now, and important and subtle parameter. How many
+            #introductions do we have? I.e. in each species location, how
+            #many adults of a species we are following do we start
+            #with. Call this Nintro. If negative, fill entire species
+            #range defined by the initialConditionsFile. Otherwise just
+            #release Nintro individuals into the domain, as long as each
+            #region they are released into can hold more adults than
+            #Nintro.  All other spaces in the domain are filled with
+            #another species which we do not pay attention to. (It must be
+            #filled with something, so that there is not an intial burst
+            #of population growth to fill the empty habitat. This would
+            #play with various statistics in funny ways.)
+            Nintro=1
+
+            #How the output is saved. A snapshot of the population is saved
+            #every 100 generations. If outputFormat is 'store', the snapshots
+            #of all of the runs are saved into a single zarr store, with
+            #dimensions (run,snapshot,location,species); if 'zip', each
+            #snapshot of each run is saved into its own file. See
+            #outputStore_module.py
+            outputFormat='store'
+
+            #If sparseSnapshots is True, the store keeps each snapshot as
+            #the (location,species,number) of each species present at each
+            #location, rather than as the dense (location,species) array,
+            #which is much smaller and quicker to write when there are many
+            #species. The analysis codes read either.
+            sparseSnapshots=True
         
-        #The arrays for the population P and where the larvae settle,
-        #whereSettle, are created as shared memory arrays to reduce
-        #overhead of communication when parallelization. Both must be
-        #(Ndomain,Nspecies) in size, and thus cannot be made until we know
-        #the number of species and the size of the domain.  so lets define
-        #the size of the domain below (Ndomain), and then load the
-        #initialization data and find the number of species. 
-
-        #how big is domain
-        Ndomain=len(nxny2nlin)
-
-        #Now make initial P.  What is initial condition? The file
-        #specified by initialConditionFile should have been created
-        #with the same connectivity matrix as used in this model, and
-        #is a vector of the same length as the linear domain, with a
-        #series of integers from 0 to Nspecies-1 which indicate which
-        #species start where. The initial condition is created by
-        #01_makeInitialIntroductionRanges.py
-        jnk=zarr.load(initialConditionFile)
-        speciesList=jnk['nSpecies']
-
-        #the number of species is the number of regions if Nintro<0,
-        #and all regions start full. It is the number of regions+1 if
-        #Nintro>0, because we need a species to fill otherwise empty
-        #initial habitat. Otherwise the initial introduction number is
-        #obscured by a burst of growth into otherwise empty habitats.
-        #this filler species is species numbered
-        #len(unique(speciesList))
-        if Nintro<0:
-            Nspecies=len(unique(speciesList))
-        else:
-            Nspecies=len(unique(speciesList))+1
-
-        #how lets make the shared memory for the P and whereSettle arrays
-        jnk=zeros((Ndomain,Nspecies),dtype=int) #this is only used to find size of shared memory to make
-
-        shm_P=shared_memory.SharedMemory(create=True,size=jnk.nbytes)
-        P=ndarray((Ndomain,Nspecies),dtype=int,buffer=shm_P.buf)
-        P.fill(0)
-        Pname=shm_P.name
-
-        shm_whereSettle=shared_memory.SharedMemory(create=True,size=jnk.nbytes)
-        whereSettle=ndarray((Ndomain,Nspecies),dtype=int,buffer=shm_whereSettle.buf)
-        whereSettle.fill(0)
-        whereSettleName=shm_whereSettle.name        
-
-        #Lets make the initial distribution of species -- the initial
-        #condition for this model run.  Loop over all the species, and
-        #introduce them into the habitat at the appropriate location
-        for nSp in unique(speciesList):
-            indx=speciesList==nSp
-            #P[indx,nSp]=Pmax #start habitat full
-
-            #now, figure out how many larvae to introduce
+            #The arrays for the population P and where the larvae settle,
+            #whereSettle, are created as shared memory arrays to reduce
+            #overhead of communication when parallelization. Both must be
+            #(Ndomain,Nspecies) in size, and thus cannot be made until we know
+            #the number of species and the size of the domain.  so lets define
+            #the size of the domain below (Ndomain), and then load the
+            #initialization data and find the number of species. 
+
+            #how big is domain
+            Ndomain=len(nxny2nlin)
+
+            #Now make initial P.  What is initial condition? The file
+            #specified by initialConditionFile should have been created
+            #with the same connectivity matrix as used in this model, and
+            #is a vector of the same length as the linear domain, with a
+            #series of integers from 0 to Nspecies-1 which indicate which
+            #species start where. The initial condition is created by
+            #01_makeInitialIntroductionRanges.py
+            jnk=zarr.load(initialConditionFile)
+            speciesList=jnk['nSpecies']
+
+            #the number of species is the number of regions if Nintro<0,
+            #and all regions start full. It is the number of regions+1 if
+            #Nintro>0, because we need a species to fill otherwise empty
+            #initial habitat. Otherwise the initial introduction number is
+            #obscured by a burst of growth into otherwise empty habitats.
+            #this filler species is species numbered
+            #len(unique(speciesList))
             if Nintro<0:
-                #if Nintro<0, fill entire 
-                P[indx,NSp]=Pmax
+                Nspecies=len(unique(speciesList))
             else:
-                #if Nintro>0, then fill the species range with the smaller
-                #of Nintro or Pmax*(number of locations in species initial range)
-                initialPoints=arange(len(speciesList))[indx] #indices of points in species initial range
-                #now make Pmax copies of these points; this is a list of all possible places an introduction
-                #could go
-                jnk=[]
-                for nP in range(Pmax):
-                    jnk=jnk+list(initialPoints)
-                initialPoints=array(jnk)
-                shuffle(initialPoints) #do this to randomize where individuals are placed
-
-                #now randomly add points to the domain. We know we can't add too many
-                #because initialPoints's length is the maximum number of points an
-                #initial species range can hold.
-                numPoints=min(Nintro,len(initialPoints))
-                for thePoint in initialPoints[:numPoints]:
-                    P[thePoint,nSp]+=1
-
-                #a quick sanity check
-                if Nintro>len(initialPoints):
-                    print('For population',nsp,'Population initially saturated')
-
-                #now we don't want empty habitat in the domain. So any empty habitat will be occupied
-                #by species Nspecies-1, which should be len(speciesList). So check all of the habitat patches
-                #in this introduction region, and if any are not filled to Pmax, add that number of individuals
-                #to nSpeciesOverflow
+                Nspecies=len(unique(speciesList))+1
+
+            #Lets make the initial distribution of species -- the initial
+            #condition for each model run in runList. Each habitat point
+            #lies in the initial range of exactly one species,
+            #speciesList[n], so the initial condition is introCount, the
+            #number of that species introduced at each habitat point in
+            #each replicate. Loop over all the species, and introduce them
+            #into the habitat at the appropriate location
+            introCount=zeros((nReplicate,Ndomain),dtype=int)
+            for nRep in range(nReplicate):
+                initialRng=rsm.streamRng(seed,rsm.initialStream,runList[nRep])
+                for nSp in unique(speciesList):
+                    indx=speciesList==nSp
+
+                    #now, figure out how many larvae to introduce
+                    if Nintro<0:
+                        #if Nintro<0, fill entire 
+                        introCount[nRep,indx]=Pmax
+                    else:
+                        #if Nintro>0, then fill the species range with the smaller
+                        #of Nintro or Pmax*(number of locations in species initial range)
+                        initialPoints=arange(len(speciesList))[indx] #indices of points in species initial range
+                        #now make Pmax copies of these points; this is a list of all possible places an introduction
+                        #could go
+                        jnk=[]
+                        for nP in range(Pmax):
+                            jnk=jnk+list(initialPoints)
+                        initialPoints=array(jnk)
+                        initialRng.shuffle(initialPoints) #do this to randomize where individuals are placed
+
+                        #now randomly add points to the domain. We know we can't add too many
+                        #because initialPoints's length is the maximum number of points an
+                        #initial species range can hold.
+                        numPoints=min(Nintro,len(initialPoints))
+                        for thePoint in initialPoints[:numPoints]:
+                            introCount[nRep,thePoint]+=1
+
+                        #a quick sanity check
+                        if Nintro>len(initialPoints):
+                            print('For population',nSp,'Population initially saturated')
+
+            #now we don't want empty habitat in the domain. So any empty habitat will be occupied
+            #by species Nspecies-1, which should be len(speciesList). So at every habitat patch
+            #that is not filled to Pmax, add that number of individuals of nSpeciesOverflow
+            if Nintro>0:
                 nSpeciesOverflow=len(unique(speciesList))
                 assert Nspecies==nSpeciesOverflow+1, 'oops, think about what silly thing you have done'
-                initialPoints=arange(len(speciesList))[indx]
-                for nHabPatch in initialPoints:
-                    totalP=sum(P[nHabPatch,:-1])
-                    if totalP<Pmax:
-                        P[nHabPatch,nSpeciesOverflow]=Pmax-totalP
-                    if totalP>Pmax:
-                        assert False,'how did the total population at point exceed the carrying capacity?'
-
-        #ok, now just double check that all habitat is filled to Pmax
-        Ptotal=sum(P,axis=1)
-        assert (Ptotal==Pmax).all(),'Not all of the initial habitat is at carrying capacity!?!?'
-
-        #make lat and lon vectors for plotting
-        lonVec=array([nlin2lonLat[n][0] for n in nlin2lonLat])
-        latVec=array([nlin2lonLat[n][1] for n in nlin2lonLat])
-
-        #Do we run in parallel?
-        runParallel=True
-        if runParallel:
-            nCPU=mp.cpu_count()    #use for machines without hyperthreading (apple silicon)
-            nCPU=mp.cpu_count()//2 #for machines with hyperthreading (most intel/amd machines)
-            pool=mp.Pool(nCPU) #keep same pool for all runs, uncomment if using multiprocessing
-
-            #do smaller chunks help parallelize more?
-            #the parameter below is the number of jobs per
-            #process in pool. 
-            nChunksPerCPU=1 #no, increasing this does not help... 
-
-        #now loop over time, and let species propogate
-        #for now assume Nspecies=1
-        print('Starting time iterations with Ndomain size',Ndomain,'and Nspecies',Nspecies)
-        ticBench=time.time()
-        for nt in range(Tmax):
-
-            #plot before working, just to see initial condition
-            #if true, plot
-            if False:
-                if remainder(nt,20)==0:
-                    clf()
-                    plot(lonVec,latVec,'k,')
-                    for nSp in range(Nspecies):
-                        indx=P[:,nSp]>0
-                        plot(lonVec[indx],latVec[indx],'.')
-                    #axis([-90,-50,24,60])
-                    title('Starting generation %d population %d'%(nt,sum(P.flatten())))
-                    draw()
-                    show(block=False)
-                    pause(0.1)
-
-            tic=time.time()
-            #now loop over each species, and figure out where its larvae will settle
-            #NOTE WELL. To make parallization more efficient, P and whereSettle are
-            #shared with findWhereSettle() through shared memory arrays. So findWhereSettle()
-            #has the silent side effect of changing whereSettle. It is important that findWhereSettle()
-            #only changes the habitat it is responsible for. 
-            whereSettle.fill(0)
-            if not runParallel: #parallel or serial choice
-                #serial solution
-                findWhereSettle(Pname,whereSettleName,0,Nspecies,R,Ndomain,Nspecies)
+                assert (introCount<=Pmax).all(),'how did the total population at point exceed the carrying capacity?'
+                fillerCount=Pmax-introCount
             else:
-                #parallel solution
-                chunkVec=linspace(0,Nspecies,nCPU*nChunksPerCPU+1,dtype=int)
-                argIn=[]
-                for nsp in range(nCPU*nChunksPerCPU):
-                    argIn.append((Pname,whereSettleName,chunkVec[nsp],chunkVec[nsp+1],R,Ndomain,Nspecies))
-
-                #again, nothing in output, since findWhereSettle() changes whereSettle through
-                #a shared memory array. 
-                output=pool.starmap(findWhereSettle,argIn)
-
-            if False:
-                #stop after sometime and benchmark
-                if nt==20:
-                    print('after',nt,'iterations, total time is',time.time()-ticBench)
-                    assert False,'stop now'
-
-            #now there are two possibilities. Where the total number of
-            #larvae reaching a location is less than or equal to Pmax,
-            #they all survive. Where it is greater, choose Pmax survivors
-            #randomly from the larvae. Should make sure number of recruits
-            #in each species is not greater than number of larvae which
-            #reach (really? or can the average number be right?). Do this
-            #in a function so it is easy to profile. NOTE WELL, assume all
-            #fitness differences are in the fecundity and dispersal, and
-            #thus handled by findWhereSettle().
-            #
-            #calculate this with whichLarvaeSurvive(), which updates P
-            tic2=time.time()
-            P.fill(0) # zero out P, to avoid doing this slowly below
-            if not runParallel:
-                whichLarvaeSurvive(Pname,whereSettleName,0,Ndomain,Pmax,Ndomain,Nspecies)
+                fillerCount=zeros((nReplicate,Ndomain),dtype=int)
+
+            if engineMode=='dense':
+                #how lets make the shared memory for the P and whereSettle arrays
+                shm_P=shared_memory.SharedMemory(create=True,size=Ndomain*Nspecies*dtype(Pdtype).itemsize)
+                P=ndarray((Ndomain,Nspecies),dtype=Pdtype,buffer=shm_P.buf)
+                P.fill(0)
+                Pname=shm_P.name
+
+                shm_whereSettle=shared_memory.SharedMemory(create=True,size=Ndomain*Nspecies*dtype(settleDtype).itemsize)
+                whereSettle=ndarray((Ndomain,Nspecies),dtype=settleDtype,buffer=shm_whereSettle.buf)
+                whereSettle.fill(0)
+                whereSettleName=shm_whereSettle.name        
+
+                #put the initial condition into P
+                P[arange(Ndomain),speciesList]=introCount[0,:]
+                if Nintro>0:
+                    P[:,nSpeciesOverflow]=fillerCount[0,:]
+                Ptotal=sum(P,axis=1)
             else:
-                #parallel solution
-                chunkVec=linspace(0,Ndomain,nCPU*nChunksPerCPU+1,dtype=int)
-                argIn=[]
-                for nsp in range(nCPU*nChunksPerCPU):
-                    argIn.append((Pname,whereSettleName,chunkVec[nsp],chunkVec[nsp+1],Pmax,Ndomain,Nspecies))
-
-                #again, nothing in output, since findWhereSettle() changes whereSettle through
-                #a shared memory array. 
-                output=pool.starmap(whichLarvaeSurvive,argIn)
-
-
+                #the population is kept as slots, with the replicates
+                #stacked along the habitat axis; see populationKernels_module.py
+                Pspecies,Pcount=pkm.makeSlots(nReplicate*Ndomain,Pmax,Pdtype)
+                for nRep in range(nReplicate):
+                    cellVec=nRep*Ndomain+arange(Ndomain)
+                    pkm.addToSlots(Pspecies,Pcount,cellVec,speciesList,introCount[nRep,:])
+                    if Nintro>0:
+                        pkm.addToSlots(Pspecies,Pcount,cellVec,full((Ndomain,),nSpeciesOverflow),fillerCount[nRep,:])
+                Ptotal=Pcount.sum(axis=1)
+
+            #ok, now just double check that all habitat is filled to Pmax
+            assert (Ptotal==Pmax).all(),'Not all of the initial habitat is at carrying capacity!?!?'
+
+            #make lat and lon vectors for plotting
+            lonVec=nlin2lonLat.valueArray[:,0]
+            latVec=nlin2lonLat.valueArray[:,1]
+
+            #open, or make, the store the snapshots are saved into
+            if outputFormat=='store':
+                store=osm.openNeutralStore(osm.neutralStoreName(ConnectivityModelName,R,Pmax,Nintro),nRun,
+                                           arange(100,Tmax,100),lonVec,latVec,Nspecies,Pdtype,sparseSnapshots,
+                                           engineMode)
+
+            #Do we run in parallel? (the sparse engine always runs in the main process)
+            runParallel=True
+            if runParallel and engineMode=='dense':
+                nCPU=mp.cpu_count()    #use for machines without hyperthreading (apple silicon)
+                nCPU=mp.cpu_count()//2 #for machines with hyperthreading (most intel/amd machines)
+                if pool is None:
+                    pool=mp.Pool(nCPU,initializer=attachConnectivity,initargs=(connectivitySpec,))
+
+                #The work is split into nChunksPerCPU jobs per process in
+                #the pool, and the jobs are handed out to the workers as
+                #they become free, so a worker that finishes early takes
+                #another job instead of waiting. The species are split
+                #into jobs of roughly equal total population (the cost of
+                #findWhereSettle() scales with the population of a species),
+                #and extinct species are left out, so the work stays balanced
+                #late in a run when only a few species are left. The habitat
+                #points are split into jobs of whole blocks of rsm.cellsPerStream
+                #points when choosing the recruits.
+                nChunksPerCPU=4
+
+            #whether a replicate has finished because all its introduced
+            #species are extinct
+            isDone=zeros((nReplicate,),dtype=bool)
+
+            #if resuming, and these runs have a checkpoint, replace the
+            #initial condition with the checkpoint, and continue from
+            #the generation after it with the seed they were started
+            #with. ntStart is the first generation to run. runSeed is the
+            #seed of these runs
+            checkpointFile=os.path.join(ckm.checkpointDir,'manySpecies_'+ConnectivityModelName
+                                        +'_Params_R_%2d_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d_firstRun%d_nReplicate%d.npz'
+                                        %(R,Tmax,Pmax,Nintro,firstRun,nReplicate))
+            ntStart=0
+            runSeed=seed
+            if resume and os.path.exists(checkpointFile):
+                checkpointArrays,checkpointState=ckm.loadCheckpoint(checkpointFile)
+                if engineMode=='sparse':
+                    Pspecies=checkpointArrays['Pspecies']; Pcount=checkpointArrays['Pcount']
+                else:
+                    P[:]=checkpointArrays['P']
+                isDone=checkpointArrays['isDone']
+                runSeed=checkpointState['seed']
+                ntStart=checkpointState['nt']+1
+                if ntStart>=Tmax:
+                    print('   these runs have already finished')
+                else:
+                    print('   resuming from the checkpoint after generation',checkpointState['nt'])
 
-            #if extinct, stop
-            #if sum(whereSettle)==0:
-            #    break
+            #the population of each species in each replicate
+            if engineMode=='dense':
+                numBySpecies=P.sum(axis=0)[newaxis,:]
 
-            #calculate how many species left
-            numSpeciesLeft=sum(P.sum(axis=0)>0)
+            #now loop over time, and let species propogate
+            #for now assume Nspecies=1
+            print('Starting time iterations with Ndomain size',Ndomain,'and Nspecies',Nspecies)
+            ticBench=time.time()
+            for nt in range(ntStart,Tmax):
 
-            #if the number of species is 1, check if only species left
-            #is the filler species that is used when Nintro>0. If it
-            #only the filler species is left, then bail from the run,
-            #since it means that all of the introduced species have
-            #gone extinct. Note that this means the software that
-            #analyzes results must be able to cope with missing output
-            #files.
-            if Nintro>0:
-                if numSpeciesLeft==1:
-                    #only one species left. Check to see it is the filler species
-                    numBySpecies=P.sum(axis=0)
-                    if numBySpecies[-1]>0:
-                        print('   Only filler species persists. No introduced species left. Bail from run')
+                #plot before working, just to see initial condition
+                #if true, plot
+                if False:
+                    if remainder(nt,20)==0:
+                        clf()
+                        plot(lonVec,latVec,'k,')
+                        for nSp in range(Nspecies):
+                            indx=P[:,nSp]>0
+                            plot(lonVec[indx],latVec[indx],'.')
+                        #axis([-90,-50,24,60])
+                        title('Starting generation %d population %d'%(nt,sum(P.flatten())))
+                        draw()
+                        show(block=False)
+                        pause(0.1)
+
+                tic=time.time()
+                if engineMode=='sparse':
+                    #the whole generation, dispersal and recruitment, of all
+                    #the replicates is done in one call of compiled code, in
+                    #the main process. Each replicate is advanced with its
+                    #own stream of random numbers, so its results do not
+                    #depend on which runs it is grouped with; a replicate
+                    #which has finished is left unchanged. tic2 is only kept
+                    #for the timing printout below
+                    tic2=tic
+                    rngList=pkm.generatorList([rsm.streamRng(runSeed,rsm.generationStream,runList[nRep],nt)
+                                               for nRep in range(nReplicate)])
+                    Pspecies,Pcount=pkm.sparseGeneration(Pspecies,Pcount,R,Pmax,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,
+                                                         rngList,logical_not(isDone),pkm.dispersalModes[dispersalMode])
+                else:
+                    #now loop over each species, and figure out where its larvae will settle
+                    #NOTE WELL. To make parallization more efficient, P and whereSettle are
+                    #shared with findWhereSettle() through shared memory arrays. So findWhereSettle()
+                    #has the silent side effect of changing whereSettle. It is important that findWhereSettle()
+                    #only changes the habitat it is responsible for. 
+                    whereSettle.fill(0)
+                    if not runParallel: #parallel or serial choice
+                        #serial solution
+                        findWhereSettle(Pname,whereSettleName,nonzero(numBySpecies[0,:])[0],R,Ndomain,Nspecies,
+                                        runSeed,(runList[0],nt),dispersalMode,Pdtype,settleDtype)
+                    else:
+                        #parallel solution
+                        argIn=[]
+                        for whichSpecies in pkm.balancedChunks(numBySpecies[0,:],nCPU*nChunksPerCPU):
+                            argIn.append((Pname,whereSettleName,whichSpecies,R,Ndomain,Nspecies,
+                                          runSeed,(runList[0],nt),dispersalMode,Pdtype,settleDtype))
+
+                        #again, nothing in output, since findWhereSettle() changes whereSettle through
+                        #a shared memory array. 
+                        for output in pool.imap_unordered(findWhereSettleStar,argIn,chunksize=1):
+                            pass
+
+                    if False:
+                        #stop after sometime and benchmark
+                        if nt==20:
+                            print('after',nt,'iterations, total time is',time.time()-ticBench)
+                            assert False,'stop now'
+
+                    #now there are two possibilities. Where the total number of
+                    #larvae reaching a location is less than or equal to Pmax,
+                    #they all survive. Where it is greater, choose Pmax survivors
+                    #randomly from the larvae, without replacement, so the number
+                    #of recruits in each species is not greater than number of
+                    #larvae which reach. Do this in a function so it is easy to
+                    #profile. NOTE WELL, assume all fitness differences are in
+                    #the fecundity and dispersal, and thus handled by
+                    #findWhereSettle().
+                    #
+                    #calculate this with whichLarvaeSurvive(), which updates P
+                    tic2=time.time()
+                    P.fill(0) # zero out P, to avoid doing this slowly below
+                    if not runParallel:
+                        whichLarvaeSurvive(Pname,whereSettleName,0,Ndomain,Pmax,Ndomain,Nspecies,runSeed,(runList[0],nt),
+                                           Pdtype,settleDtype)
+                    else:
+                        #parallel solution
+                        chunkVec=rsm.blockChunks(Ndomain,nCPU*nChunksPerCPU)
+                        argIn=[]
+                        for nsp in range(len(chunkVec)-1):
+                            argIn.append((Pname,whereSettleName,chunkVec[nsp],chunkVec[nsp+1],Pmax,Ndomain,Nspecies,
+                                          runSeed,(runList[0],nt),Pdtype,settleDtype))
+
+                        #again, nothing in output, since findWhereSettle() changes whereSettle through
+                        #a shared memory array. 
+                        for output in pool.imap_unordered(whichLarvaeSurviveStar,argIn,chunksize=1):
+                            pass
+
+                #if extinct, stop
+                #if sum(whereSettle)==0:
+                #    break
+
+                #calculate how many species left in each replicate
+                if engineMode=='sparse':
+                    numBySpecies=pkm.speciesTotals(Pspecies,Pcount,Nspecies,nReplicate)
+                else:
+                    numBySpecies=P.sum(axis=0)[newaxis,:]
+                numSpeciesLeft=sum(numBySpecies>0,axis=1)
+
+                #if the number of species is 1, check if only species left
+                #is the filler species that is used when Nintro>0. If it
+                #only the filler species is left, then bail from the run,
+                #since it means that all of the introduced species have
+                #gone extinct. Note that this means the software that
+                #analyzes results must be able to cope with missing output
+                #files. In an ensemble, a replicate which has finished is
+                #emptied, so it costs nothing, and the others carry on.
+                if Nintro>0:
+                    for nRep in range(nReplicate):
+                        if (not isDone[nRep]) and (numSpeciesLeft[nRep]==1):
+                            #only one species left. Check to see it is the filler species
+                            if numBySpecies[nRep,-1]>0:
+                                print('   Only filler species persists. No introduced species left. Bail from run',
+                                      runList[nRep])
+                                isDone[nRep]=True
+                                if engineMode=='sparse':
+                                    Pspecies[nRep*Ndomain:(nRep+1)*Ndomain,:]=-1
+                                    Pcount[nRep*Ndomain:(nRep+1)*Ndomain,:]=0
+                    if isDone.all():
                         break
 
-            now=time.time()
-
-            #now save model run every so often
-            if remainder(nt,100)==0 and nt>0:
-                #now make the file name in which data will be saved. 
-                if Nintro<0:
-                    fileOut=('modelOutputNeutral/manySpecies_'+ConnectivityModelName
-                             +'_Params_R_%2d_Tmax%3.3d_Pmax%2.2d_nRun%d.zip'%(R,nt,Pmax,nR))
-                else:
-                    fileOut=('modelOutputNeutral/manySpecies_'+ConnectivityModelName
-                             +'_Params_R_%2d_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d_nRun%d.zip'%(R,nt,Pmax,Nintro,nR))
-                print('   generation %d took'%nt,now-tic,' and',now-tic2,
-                      'at species level, total species left',numSpeciesLeft)
-                zarr.save(fileOut,
-                          lonVec=lonVec,latVec=latVec,P=P)
-
-
-        #close shared memory and multiprocessing pool
-        if runParallel:
-            pool.close()
-            shm_P.close(); shm_P.unlink()
-            shm_whereSettle.close(); shm_whereSettle.unlink()
+                now=time.time()
+
+                #now save model run every so often
+                if remainder(nt,100)==0 and nt>0:
+                    print('   generation %d took'%nt,now-tic,' and',now-tic2,
+                          'at species level, total species left',numSpeciesLeft[logical_not(isDone)])
+                    for nRep in range(nReplicate):
+                        if isDone[nRep]:
+                            continue
+                        nR=runList[nRep]
+                        if engineMode=='sparse':
+                            #a sparse snapshot is made straight from the
+                            #slots, without making the dense population
+                            block=slice(nRep*Ndomain,(nRep+1)*Ndomain)
+                            if (outputFormat=='store') and sparseSnapshots:
+                                P=pkm.slotsToTriplets(Pspecies[block,:],Pcount[block,:])
+                            else:
+                                P=pkm.slotsToDense(Pspecies[block,:],Pcount[block,:],Nspecies)
+
+                        if outputFormat=='store':
+                            osm.saveNeutralSnapshot(store,nR,nt,P,runSeed)
+                        else:
+                            #now make the file name in which data will be saved. 
+                            if Nintro<0:
+                                fileOut=('modelOutputNeutral/manySpecies_'+ConnectivityModelName
+                                         +'_Params_R_%2d_Tmax%3.3d_Pmax%2.2d_nRun%d.zip'%(R,nt,Pmax,nR))
+                            else:
+                                fileOut=('modelOutputNeutral/manySpecies_'+ConnectivityModelName
+                                         +'_Params_R_%2d_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d_nRun%d.zip'%(R,nt,Pmax,Nintro,nR))
+                            zarr.save(fileOut,
+                                      lonVec=lonVec,latVec=latVec,P=P,seed=array(runSeed,dtype=int64))
+
+                #save a checkpoint every so often. This is done after the
+                #output is written, so a resumed run does not need to write it again
+                if remainder(nt+1,checkpointEvery)==0:
+                    if engineMode=='sparse':
+                        checkpointArrays={'Pspecies':Pspecies,'Pcount':Pcount,'isDone':isDone}
+                    else:
+                        checkpointArrays={'P':P,'isDone':isDone}
+                    ckm.saveCheckpoint(checkpointFile,checkpointArrays,
+                                       {'nt':int(nt),'seed':runSeed})
+
+            #these runs are finished; record that in the checkpoint, so
+            #that a resumed run will skip them.
+            if engineMode=='sparse':
+                checkpointArrays={'Pspecies':Pspecies,'Pcount':Pcount,'isDone':isDone}
+            else:
+                checkpointArrays={'P':P,'isDone':isDone}
+            ckm.saveCheckpoint(checkpointFile,checkpointArrays,
+                               {'nt':Tmax-1,'seed':runSeed})
+
+            #and in the store, so the analysis codes know these runs are
+            #complete, even those which ended before their last snapshot
+            if outputFormat=='store':
+                for nR in runList:
+                    osm.markNeutralRunFinished(store,nR)
+
+            #close shared memory
+            if engineMode=='dense':
+                shm_P.close(); shm_P.unlink()
+                shm_whereSettle.close(); shm_whereSettle.unlink()
+
+    finally:
+        #stop the multiprocessing pool, and release the shared memory
+        #holding the connectivity. All of the jobs given to the pool have
+        #finished on a clean exit, and after an error they are not
+        #wanted, so the workers are stopped rather than waited for
+        if pool is not None:
+            pool.terminate(); pool.join()
+        del EwhereTo,EnumTo,Ecumsum,EfracReturn,Eindptr,E
+        for shm in shmConnectivityMain:
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                #after an error, its traceback may still hold arrays made
+                #from the shared memory; it is freed when the process ends
+                pass
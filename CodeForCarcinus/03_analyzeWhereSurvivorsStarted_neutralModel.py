@@ -5,9 +5,12 @@ import xarray as xr
 import time
 import multiprocessing as mp
 import createLinearModel_module as cLM
+import outputStore_module as osm
+import streamingStatistics_module as ssm
 import cartopy.crs as ccrs
 import cartopy
 import os
+import sys
 
 
 #how many runs to include
@@ -24,60 +27,50 @@ initialConditionFile='initialConditions/'+ConnectivityModelName+'.zip'
 jnk=zarr.load(initialConditionFile)
 speciesList=jnk['nSpecies']
 
-
-hasArunExisted=False
-for nR in range(nRun):
-
-    fileName=('modelOutputNeutral/manySpecies_'+ConnectivityModelName+
-                  '_Params_R_%2.2d_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d_nRun%d.zip'%(R,Tmax,Pmax,Nintro,nR))
-
-    if not os.path.exists(fileName):
-        print('does not exist:',fileName)
-    else:
-        #load final answer
-        print('loading',nR)
-        jnk=zarr.load(fileName)
-        P=jnk['P']
-        lonVec=jnk['lonVec']
-        latVec=jnk['latVec']
-
-        #what is P? It is the number of individuals of a given species at
-        #a given location P[whichLocation,whichSpecies]. The total number
-        #of individuals at each location, sum(P,axis=1) is no more than Pmax
-
-        #calculate two things
-        #
-        #isPresent is the fraction of each species that exists anywhere and is Nspecies long
-        #
-        #Pave is [whichLocation,whichSpecies] long and gives the density
-        #(population of species at point/Pmax) when averaged over all the
-        #runs
-
-        if not hasArunExisted:
-            #for the first run we find, intialize variables
-            hasArunExisted=True
-            Pave=P.copy()
-            totalPop=sum(P,axis=0)
-            isPresent=zeros(shape(totalPop))
-            indx=totalPop>0
-            isPresent[indx]=isPresent[indx]+1
-        else:
-            Pave=Pave+P
-            thisPop=sum(P,axis=0)
-            totalPop=totalPop+thisPop
-            indx=thisPop>0
-            isPresent[indx]=isPresent[indx]+1
-
-assert hasArunExisted,'Error, there was no ouput for any model run'
-            
-#normalize Pave and isPresent
-Pave=Pave/nRun/Pmax
-isPresent=isPresent
+#how the output of 02_manyNeutralSpecies_fastModel.py was saved, 'store'
+#for a single store of all the runs, or 'zip' for a file for each
+#snapshot of each run; see outputStore_module.py
+outputFormat='store'
+
+
+#The runs are read, in parallel, and reduced to the statistics below
+#by streamingStatistics_module.py, which only holds a few runs in
+#memory at a time. If this code is run with the --watch flag, e.g.
+#"python 03_analyzeWhereSurvivorsStarted_neutralModel.py --watch", it
+#keeps reading the runs as 02_manyNeutralSpecies_fastModel.py saves
+#them, printing the statistics every watchInterval seconds, until all
+#nRun runs are read or it is stopped with control-C, and then makes
+#the plots from the runs read so far. This needs outputFormat='store'.
+watchInterval=60.0
+source=ssm.neutralSource(outputFormat,ConnectivityModelName,R,Pmax,Nintro,Tmax)
+if '--watch' in sys.argv[1:]:
+    acc=ssm.watchRuns(source,range(nRun),speciesList,lambda acc: ssm.printSummary(acc,'isPresent'),watchInterval)
+else:
+    acc=ssm.reduceRuns(source,range(nRun),speciesList)
+ssm.printSummary(acc,'isPresent')
+assert 'totalPop' in acc['sum'],'Error, there was no ouput for any model run'
+lonVec,latVec=ssm.loadCoordinates(source,range(nRun))
+
+#what is P? It is the number of individuals of a given species at
+#a given location P[whichLocation,whichSpecies]. The total number
+#of individuals at each location, sum(P,axis=1) is no more than Pmax
+#
+#calculate from it
+#
+#isPresent is the number of runs in which each species exists
+#anywhere, and is Nspecies long; isPresentLow and isPresentHigh are
+#the 95% confidence interval of the fraction of runs it is present in
+#
+#totalPop is the population of each species, summed over all the runs
+nRun=acc['nRun'] #the number of runs read
+isPresent=acc['sum']['isPresent']
+isPresentLow,isPresentHigh=ssm.confidenceInterval(acc,'isPresent')
+totalPop=acc['sum']['totalPop']
     
 #====================================================================================
 #first plot where survivors started
-Nspecies=P.shape[1]
-Ndomain=P.shape[0]
+Nspecies=len(totalPop)
+Ndomain=len(lonVec)
 
 figure(1,figsize=(7.98, 7.5)); clf(); style.use('ggplot')
 
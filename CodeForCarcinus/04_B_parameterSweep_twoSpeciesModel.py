@@ -0,0 +1,210 @@
+from pylab import *
+from numpy import *
+import zarr
+import time
+import os
+import sys
+import itertools
+import importlib
+import multiprocessing as mp
+import populationKernels_module as pkm
+import rngStreams_module as rsm
+import tqdm
+
+#the two species model; its name starts with a number, so it must be
+#imported with importlib
+tsm=importlib.import_module('04_twoSpeciesModel_differentR_relativeFitnessDifference')
+
+# This code runs the two species model of
+# 04_twoSpeciesModel_differentR_relativeFitnessDifference.py over a grid
+# of parameters, rather than the single set of parameters which is
+# written into that code. Each point of the grid is a set of values of
+# the connectivity model (and so the PLD), R0, R1, Pmax, Tmax and
+# Nintro, and for each point nRun runs are made, each of which
+# introduces the species into every region. The output of each run is
+# saved into the same file, with the same name, as
+# 04_twoSpeciesModel_differentR_relativeFitnessDifference.py would save
+# it into (or into the same store; see outputStore_module.py), so the
+# analysis codes work on the output of a sweep, and runs which have
+# been saved are skipped.
+#
+# Rather than starting a pool of processes for each run, every
+# introduction of every run of every grid point is a task in a single
+# pool, so the processes are kept busy even when a run has fewer
+# regions than there are processes, or some of its introductions take
+# much longer than the rest. The tasks are started cheapest first, so
+# the output of the quick parts of the sweep is written early; the
+# output of a run is written as soon as all of its introductions are
+# done. The connectivity models are loaded once in each process from
+# the memory mapped cache of createLinearModel_module.py, so all the
+# processes share one copy of each in memory, and every grid point
+# which uses a model uses that copy.
+
+#the speciesList of the initial conditions of each connectivity model,
+#loaded the first time it is needed in each process
+speciesListCache={}
+
+def getSpeciesList(theModelName):
+    '''speciesList=getSpeciesList(theModelName)
+
+    the introduction region of each habitat point, from the initial
+    condition file of the connectivity model theModelName
+    '''
+    if theModelName not in speciesListCache:
+        jnk=zarr.load('initialConditions/'+theModelName+'.zip')
+        speciesListCache[theModelName]=jnk['nSpecies']
+    return speciesListCache[theModelName]
+
+def loadModels(modelNames):
+    '''loadModels(modelNames)
+
+    load all of the connectivity models in modelNames; this is the
+    initializer of the worker processes
+    '''
+    for theModelName in modelNames:
+        tsm.loadConnectivity(theModelName)
+    return None
+
+def taskCost(params,Ndomain):
+    '''cost=taskCost(params,Ndomain)
+
+    a rough estimate of how long an introduction with the parameters
+    params takes, used only to order the tasks. A generation of the
+    dense engine costs about Ndomain*Pmax, and a run lasts up to Tmax
+    generations; an introduction which is less fit than the native
+    species (R0<R1) usually dies out quickly, and a fitter one usually
+    spreads, so the cost is scaled by R0/R1.
+    '''
+    return params['Tmax']*Ndomain*params['Pmax']*params['R0']/params['R1']
+
+def runSweepTask(task):
+    '''nParam,nR,nsp,result=runSweepTask(task)
+
+    task is (nParam,params,nR,nsp,runSeed,checkpointFile,settings).
+    Make the introduction into region nsp of run nR at grid point
+    nParam, whose parameters are params, with the model settings that
+    are the same for all of the sweep, and return what runModelOnce()
+    returns. The initial condition is made here, rather than passed in,
+    to keep the list of tasks small.
+    '''
+    nParam,params,nR,nsp,runSeed,checkpointFile,settings=task
+    tsm.loadConnectivity(params['ConnectivityModelName'])
+    Pmax=params['Pmax']
+    Pinit=tsm.introductionPinit(getSpeciesList(params['ConnectivityModelName']),nsp,Pmax,params['Nintro'],
+                                runSeed,nR)
+    Pdtype=pkm.populationDtype(Pmax,'auto').name
+    switchThreshold=tsm.defaultSwitchThreshold(len(Pinit),Pmax)
+    result=tsm.runModelOnce(Pinit,params['R0'],params['R1'],Pmax,params['Tmax'],nsp,settings['dispersalMode'],
+                            settings['engineMode'],switchThreshold,settings['stationaryWindow'],
+                            settings['stationaryTolerance'],Pdtype,settings['settleDtype'],
+                            rsm.streamSeed(runSeed,rsm.modelStream,nR,nsp),checkpointFile,
+                            settings['checkpointEvery'])
+    return nParam,nR,nsp,result
+
+__spec__=None #ignore this line, it fixes a bug in multiprocessing on osx
+if __name__=="__main__":
+
+    #The grid of parameters. The sweep is made over every combination
+    #of the values in the lists below; see
+    #04_twoSpeciesModel_differentR_relativeFitnessDifference.py for what
+    #they mean. The PLD is changed by changing the connectivity model.
+    sweepGrid={'ConnectivityModelName':['E_CmaenasHab_depth1_minPLD40_maxPLD40_months5_to_6'],
+               'R0':[16.0/2*1.0,16.0/2*1.05,16.0/2*1.1,16.0/2*1.2],
+               'R1':[16.0/2],
+               'Pmax':[1],
+               'Tmax':[601*4],
+               'Nintro':[1]}
+
+    #the number of runs made at each grid point
+    nRun=100 ; print('FOR SPEED OF INITIAL USE, nRun IS SET TO 100. IT SHOULD BE LARGER IN MOST CASES')
+
+    #the settings which are the same for the whole sweep; see
+    #04_twoSpeciesModel_differentR_relativeFitnessDifference.py
+    settings={'dispersalMode':'auto',
+              'engineMode':tsm.defaultEngineMode,
+              'stationaryWindow':None,
+              'stationaryTolerance':0.05,
+              'settleDtype':'uint16',
+              'checkpointEvery':100,
+              'outputFormat':'store'}
+
+    #as in 04_twoSpeciesModel_differentR_relativeFitnessDifference.py, a
+    #sweep which is interrupted can be continued from its checkpoints
+    #with the --resume flag
+    resume=('--resume' in sys.argv[1:])
+
+    #All of the random numbers are made from seed; see
+    #04_twoSpeciesModel_differentR_relativeFitnessDifference.py. Every
+    #grid point uses the same seed, so a run of the sweep is the same as
+    #the run 04_twoSpeciesModel_differentR_relativeFitnessDifference.py
+    #makes with the same parameters and seed, and the grid points are
+    #compared with the same random numbers.
+    seed=None
+    seed=rsm.makeSeed(seed)
+    print('The seed of the random numbers is',seed)
+
+    #In general, in machines with hyperthreading, divide the number of
+    #CPU's reported by cpu_count() by two; see
+    #04_twoSpeciesModel_differentR_relativeFitnessDifference.py
+    nCPU=mp.cpu_count()#//2
+
+    #make the list of grid points
+    gridKeys=list(sweepGrid.keys())
+    paramList=[dict(zip(gridKeys,values)) for values in itertools.product(*[sweepGrid[k] for k in gridKeys])]
+    modelNames=sweepGrid['ConnectivityModelName']
+    loadModels(modelNames)
+
+    #make the list of tasks, one for each introduction of each run
+    #which has not been saved. runInfo keeps, for each run, what is
+    #needed to save it when all of its introductions are done
+    taskList=[]
+    runInfo={}
+    for nParam,params in enumerate(paramList):
+        theModelName=params['ConnectivityModelName']
+        tsm.loadConnectivity(theModelName)
+        speciesList=getSpeciesList(theModelName)
+        Nregions=len(unique(speciesList))
+        cost=taskCost(params,len(speciesList))
+        store=tsm.openRunOutput(settings['outputFormat'],theModelName,params['R0'],params['R1'],params['Tmax'],
+                                params['Pmax'],params['Nintro'],nRun,speciesList,
+                                pkm.populationDtype(params['Pmax'],'auto').name,settings['engineMode'])
+        for nR in range(nRun):
+            fileOut=tsm.outputFileName(theModelName,params['R0'],params['R1'],params['Tmax'],params['Pmax'],
+                                       params['Nintro'],nR)
+            if tsm.isRunSaved(fileOut,store,nR):
+                print('skipping because it has been saved:',fileOut)
+                continue
+            runSeed,runStateFile,regionCheckpointFiles=tsm.startRun(fileOut,Nregions,seed,resume)
+            runInfo[(nParam,nR)]={'fileOut':fileOut,'store':store,'runSeed':runSeed,'output':[None]*Nregions,
+                                  'nLeft':Nregions,'checkpointFiles':regionCheckpointFiles+[runStateFile]}
+            for nsp in range(Nregions):
+                taskList.append((cost,nParam,nR,nsp))
+
+    #the cheapest tasks first; tasks which cost the same are kept in
+    #order of run, so that the runs are finished, and saved, one after another
+    taskList.sort()
+    argVec=[(nParam,paramList[nParam],nR,nsp,runInfo[(nParam,nR)]['runSeed'],
+             runInfo[(nParam,nR)]['checkpointFiles'][nsp],settings) for cost,nParam,nR,nsp in taskList]
+    print('The sweep has',len(paramList),'grid points, and',len(runInfo),'runs with',len(argVec),
+          'introductions to make')
+
+    tic=time.time()
+    with mp.Pool(nCPU,initializer=loadModels,initargs=(modelNames,)) as pool:
+        #the results come back in the order the tasks finish; the tasks
+        #are handed out one at a time, so the cheapest go first
+        results=pool.imap_unordered(runSweepTask,argVec,chunksize=1)
+        for nParam,nR,nsp,result in tqdm.tqdm(results,total=len(argVec)):
+            theRun=runInfo[(nParam,nR)]
+            theRun['output'][nsp]=result
+            theRun['nLeft']-=1
+
+            #when all the introductions of a run are done, save it
+            if theRun['nLeft']==0:
+                params=paramList[nParam]
+                tsm.loadConnectivity(params['ConnectivityModelName'])
+                tsm.saveRunOutput(theRun['fileOut'],theRun['store'],nR,theRun['output'],
+                                  getSpeciesList(params['ConnectivityModelName']),theRun['runSeed'],
+                                  settings['engineMode'],pkm.populationDtype(params['Pmax'],'auto').name,
+                                  theRun['checkpointFiles'])
+                del runInfo[(nParam,nR)]
+    print('The sweep was done in',time.time()-tic,'seconds',flush=True)
@@ -5,10 +5,14 @@ import xarray as xr
 from collections import Counter
 import time
 import os
+import sys
 import multiprocessing as mp
 from multiprocessing import shared_memory
 import createLinearModel_module as cLM
-from numba import jit,njit
+import populationKernels_module as pkm
+import checkpoint_module as ckm
+import rngStreams_module as rsm
+import outputStore_module as osm
 import tqdm
 
 # This code models the stochastic population dynamics of two species
@@ -35,36 +39,76 @@ import tqdm
 assert os.path.exists('modelOutputRelativeFitness'), 'please create directory modelOutputRelativeFitness to store model output'  
 
 
-#initialize random number generator
-rng=np.random.default_rng()
-
-#we load the large connectivity data in global scope, so we don't have to pass it into the
-#parallel functions each time we call the. 
-#print('    Loading model',flush=True)
-#load a connectivity matrix and convert to linear models
+#we keep the large connectivity data in global scope, so we don't have to pass it into the
+#parallel functions each time we call the. It is loaded by loadConnectivity(), which is
+#called in the main program below, and by each worker process of a parameter sweep (see
+#04_B_parameterSweep_twoSpeciesModel.py), so importing this file does not load a model.
+#The connectivity is kept in compressed sparse row form, so the
+#destinations of habitat point n are EwhereTo[Eindptr[n]:Eindptr[n+1]]
 ConnectivityModelName='E_CmaenasHab_depth1_minPLD40_maxPLD40_months5_to_6'
-EfileName='transposes/'+ConnectivityModelName+'.zarr'
-EwhereTo,EnumTo,EfracReturn,Ecumsum,\
-    nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=cLM.makeLinearModel(EfileName)
-#print('       done loading model')
-
-#this is a function which quickly counts how many of each value in
-#whereSettleInDomain there are. It uses Numba to run faster, and
-#is faster than the Counter class. 
-@njit
-def numbaFastCount(whereSettleInDomain,thisWhereSettle):
-    for n in whereSettleInDomain:
-        thisWhereSettle[n]+=1
+EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr=None,None,None,None,None
+nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=None,None,None,None
+
+#the frontier engine needs the connectivity in reverse, and the level
+#of the native species, which depends on R1 and Pmax. They are made
+#the first time they are needed in each process, and kept here, keyed
+#by 'incoming' and (R1,Pmax); see populationKernels_module.py. Each
+#connectivity model has its own frontierCache
+frontierCache={}
+
+#the connectivity models loaded in this process, and their
+#frontierCache's, keyed by the name of the model
+loadedModels={}
+
+#the engine the model is run with, and when a 'hybrid' run changes to
+#the dense engine, unless the main program below, or a parameter sweep,
+#sets them otherwise; see engineMode in the main program
+defaultEngineMode='dense'
+
+def defaultSwitchThreshold(Ndomain,Pmax):
+    '''switchThreshold=defaultSwitchThreshold(Ndomain,Pmax)
+
+    the number of adults of the introduced species past which a
+    'hybrid' run changes to the dense engine: about 2% of the adults
+    the Ndomain habitat points can hold, but at least 100.
+    '''
+    return max(100,(Ndomain*Pmax)//50)
+
+def loadConnectivity(theModelName):
+    '''loadConnectivity(theModelName)
+
+    make the connectivity model theModelName the one the model runs in
+    this process use, loading it if it has not been loaded yet. It is
+    loaded from the cache of createLinearModel_module.py, whose arrays
+    are memory mapped, so it is quick, and all the processes on a
+    machine share one copy of the model in memory. This is used as the
+    initializer of the worker processes of a parameter sweep.
+    '''
+    global ConnectivityModelName,EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr
+    global nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat,frontierCache
+
+    if theModelName not in loadedModels:
+        #print('    Loading model',flush=True)
+        EfileName='transposes/'+theModelName+'.zarr'
+        loadedModels[theModelName]=(cLM.makeLinearModel(EfileName,returnCSR=True,useDicts=False,useCache=True),{})
+        #print('       done loading model')
+
+    theModel,frontierCache=loadedModels[theModelName]
+    EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=theModel
+    ConnectivityModelName=theModelName
     return None
 
 #for better profiling, and future parallelization, lets move the computational core to a function
 #@profile
-def findWhereSettle(P,lowerBound,upperBound,R0,R1,Ndomain,Nspecies):
-    #see below for what these parameters are. 
+def findWhereSettle(P,lowerBound,upperBound,R0,R1,Ndomain,Nspecies,dispersalMode,settleDtype,taskRng):
+    #see below for what these parameters are. dispersalMode is one of
+    #the keys of pkm.dispersalModes, settleDtype is the dtype of the
+    #whereSettle returned, and taskRng is the random number generator of
+    #this model run
 
     tic=time.time()
 
-    whereSettle=zeros((Ndomain,Nspecies),dtype=int)
+    whereSettle=zeros((Ndomain,Nspecies),dtype=settleDtype)
 
     #only work on species that exist
     Psum=P.sum(axis=0)
@@ -79,44 +123,22 @@ def findWhereSettle(P,lowerBound,upperBound,R0,R1,Ndomain,Nspecies):
             else:
                 assert False,'only set up for two species'
 
-            #What is total number of larvae launched from each point which survive
-            totalSurvive=R*P[:,nsp]*EfracReturn #note, can be much less than 1!
-
-            #now convert totalSurvive into an array of integers. The
-            #likelyhood that it is rounded up is the fractional part, the
-            #likelyhood that it is round down is the 1-fractional part. We
-            #do this by adding to totalSurvive a random uniform number
-            #between 0 and 1, and then rounding down.
-            intSurvive=floor(rng.random(Ndomain)+totalSurvive).astype(int)
-
+            #The number of larvae launched from each point which
+            #survive is R*P*EfracReturn, stochastically rounded to an
+            #integer (so 1.7 has a 30% chance of being rounded to 2,
+            #and a 70% chance of being rounded to 1), and the surviving
+            #larvae are sent to locations picked at random from the
+            #connectivity. This used to be done in a python loop over
+            #the habitat points, and was the main hotspot of the code;
+            #pkm.disperseLarvae() does all of it in compiled code. See
+            #populationKernels_module.py for the dispersalMode's.
             thisWhereSettle=zeros((Ndomain,),dtype=int)
-            for n in arange(Ndomain)[P[:,nsp]>0]:
-                #make array of integers which is list of which entries in EwhereTo of where the larvae are going
-                #for future optimization, the rng.random() takes about 1/3 of the time of the whereGoList.
-                #this is the main hotspot of the code, and takes about 60% of the total time
-                whereGoList=searchsorted(Ecumsum[n],rng.random(intSurvive[n]))
+            pkm.disperseLarvae(P[:,nsp],R,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,taskRng,thisWhereSettle,
+                               pkm.dispersalModes[dispersalMode])
 
-                #now make array of what indices in the linear domain the larvae are going into
-                whereSettleInDomain=EwhereTo[n][whereGoList]
-
-                #where settle contains the number of larve from the species which reach
-                #each point in the domain.
-                if False:
-                    #this is actually much slower, by a factor of two... But is this true
-                    #for all model configurations? Perhaps experiment and see for your case
-                    thisWhereSettle=thisWhereSettle+bincount(whereSettleInDomain,minlength=Ndomain)
-                elif False:
-                    for n in whereSettleInDomain:
-                        thisWhereSettle[n]+=1
-                elif False:
-                    jnk=Counter(whereSettleInDomain)
-                    for j in jnk:
-                        thisWhereSettle[j]+=jnk[j]
-                else:
-                    numbaFastCount(whereSettleInDomain,thisWhereSettle)
-                #breakpoint()
-
-            #put answer into whereSettle
+            #put answer into whereSettle, checking it is not too
+            #large to be stored in it
+            pkm.checkFits(thisWhereSettle,settleDtype,'the number of settlers')
             whereSettle[:,nsp]=thisWhereSettle
 
     #print('      done with a processes in mp.Pool in',time.time()-tic,flush=True)
@@ -126,70 +148,36 @@ def findWhereSettle(P,lowerBound,upperBound,R0,R1,Ndomain,Nspecies):
 #whereSettle survive to be adults in P.  now there are two
 #possibilities. Where the total number of larvae reaching a location
 #is less than or equal to Pmax, they all survive. Where it is greater,
-#choose Pmax survivors randomly from the larvae. Should make sure
-#number of recruits in each species is not greater than number of
-#larvae which reach (really? or can the average number be right?). Do
-#this in a function so it is easy to profile. NOTE WELL, assume all
-#fitness differences are in the fecundity and dispersal, and thus
-#handled by findWhereSettle()
+#choose Pmax survivors randomly from the larvae, without replacement,
+#so the number of recruits in each species is not greater than number
+#of larvae which reach. Do this in a function so it is easy to
+#profile. NOTE WELL, assume all fitness differences are in the
+#fecundity and dispersal, and thus handled by findWhereSettle()
 #@profile
-def whichLarvaeSurvive(whereSettle,lowerBound,upperBound,Pmax,Ndomain,Nspecies):
+def whichLarvaeSurvive(whereSettle,lowerBound,upperBound,Pmax,Ndomain,Nspecies,Pdtype,taskRng):
     #inputs:
     #  P: population matrix (Ndomain,Nspecies). Pass in name of shared memory in which it is stored
     #  whereSettle: (Ndomain,Nspecies) number of larvae of each species
     #     which reach each locations. Pass in name of shared memory in which it is stored
     #  Pmax, Ndomain, and Nspecies as defined below
-
-    P=zeros((Ndomain,Nspecies),dtype=int)
-
-    #find total number of recruits, and put them in population
-    #if the number is less or equal than Pmax
-    totalRecruits=whereSettle.sum(axis=1)
-
-    #find which regions this call to whichLarvaeSurvive() will deal with...
-    #make an indx of all False's, then fill area we are interested in with True
-    indxWorryAbout=zeros((Ndomain,),dtype=bool)
-    indxWorryAbout[lowerBound:upperBound]=True
-    
-    #don't worry about empty habitat? Does this save time? Then have to make a new index below...
-    indx=logical_and(totalRecruits<=Pmax,totalRecruits>0)
-    indx=logical_and(indx,indxWorryAbout) #only process between lower and upperBound
-    P[indx,:]=whereSettle[indx,:]
-
-    #now the hard part. if totalRecruits>Pmax, then choose randomly
-    #which recruits survive. How to do this quickly?
-    indx=totalRecruits>Pmax
-    indx=logical_and(indx,indxWorryAbout) #only process between lower and upperBound
-    whichPlaces=arange(Ndomain,dtype=int)[indx]
-    for nin in whichPlaces:
-        #cumulative sum of fraction of settlers by species
-        thisCumsum=cumsum(whereSettle[nin,:])/totalRecruits[nin]
-
-        #randomly choose Pmax survivors by fraction of larvae which
-        #settle there.  note, this does mean there is some chance that
-        #more will survivie then recruited their, but the average
-        #should be right. Is this a problem?
-        whichSpeciesSettle=searchsorted(thisCumsum,rng.random(Pmax))
-
-        #breakpoint()
-        
-        #now put them back into P. Note there are two ways to do
-        #this which should be benchmarked
-        if False:
-            P[nin,:]=bincount(whichSpeciesSettle,minlength=Nspecies)
-        elif False:
-            #P[nin,:]=0 #this is surprizingly slow, do elsewhere. 
-            for n in whichSpeciesSettle:
-                P[nin,n]+=1
-        else:
-            numbaFastCount(whichSpeciesSettle,P[nin,:])
-                
-
-        #breakpoint()
+    #  Pdtype: the dtype of the P returned
+    #  taskRng: the random number generator of this model run
+
+    P=zeros((Ndomain,Nspecies),dtype=Pdtype)
+
+    #Where the total number of larvae reaching a location is less than
+    #or equal to Pmax, they all survive. Where it is greater, choose
+    #Pmax survivors randomly from the larvae, without replacement.
+    #pkm.recruitDense() does this for all locations between
+    #lowerBound:upperBound at once, in compiled code, and returns the
+    #survivors as (location,species,number) triplets.
+    cellVec,speciesVec,nRecruit=pkm.recruitDense(whereSettle[lowerBound:upperBound,:],Pmax,taskRng)
+    P[lowerBound+cellVec,speciesVec]=nRecruit
             
     return P
 
-def runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp):
+def runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp,dispersalMode,engineMode,switchThreshold,stationaryWindow,
+                 stationaryTolerance,Pdtype,settleDtype,taskSeed,checkpointFile,checkpointEvery):
     '''
 
     Now the whole model is wrapped in this function. Pass in the
@@ -198,11 +186,46 @@ def runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp):
     species.
 
     Returns the number of generations run before the 0 population
-    goes extinct (or we reach Tmax), and the final population distribution.
+    goes extinct (or we reach Tmax), the final population distribution,
+    and why the run stopped, one of the values of pkm.stopReasons. The
+    run stops early when the introduced species goes extinct, when it
+    fixes (the native species is gone, which it cannot recover from),
+    or, if stationaryWindow is not None, when the population of the
+    introduced species has stopped changing, as judged by
+    pkm.isStationary(...,stationaryWindow,stationaryTolerance).
 
     nsp is the number of introduction we are running. It is passsed in only
     so we can print it out in diagnostics below.
 
+    dispersalMode is how the larvae are sent to their destinations, one
+    of the keys of pkm.dispersalModes; see populationKernels_module.py
+
+    engineMode is 'dense', to model both species over the whole domain,
+    or 'frontier', to only follow the introduced species, taking the
+    native species to fill the rest of the habitat; see the frontier
+    engine in populationKernels_module.py. If it is 'hybrid', the run
+    starts with the frontier engine, and changes to the dense engine
+    if the population of the introduced species grows past
+    switchThreshold adults. The frontier engine takes the native
+    species to fill every habitat point up to Pmax, so there the
+    native species is gone, and the introduced species has fixed, when
+    the introduced species holds Pmax adults in every habitat point;
+    fixation is thus found in the same way whichever engine is in use.
+
+    Pdtype and settleDtype are the dtypes in which the population and
+    the number of settlers are stored.
+
+    taskSeed is the SeedSequence of the stream of random numbers of this
+    model run, made by rsm.streamSeed(), so that each run has its own
+    stream of random numbers, whichever worker process it runs in.
+
+    Every checkpointEvery generations the state of the run is saved in
+    checkpointFile (see checkpoint_module.py), and when the run finishes
+    its result is saved there. If checkpointFile exists when the run
+    starts, it continues from the checkpoint, or just returns the
+    result if it had finished. If checkpointFile is None, no
+    checkpoints are made.
+
     '''
 
     #record when starting for benchmarking
@@ -214,7 +237,7 @@ def runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp):
     #==================================
     #now make initial P
     Nspecies=2
-    P=zeros((Ndomain,Nspecies),dtype=int)
+    P=zeros((Ndomain,Nspecies),dtype=Pdtype)
         
     #here we set the initial abundance of the native species as
     #Pmax-(abundance of introduced species) so that the initial
@@ -223,15 +246,54 @@ def runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp):
     P[:,1]=Pmax-P[:,0]
         
     #==================================
+
+    #the random number generator for this run
+    taskRng=np.random.default_rng(taskSeed)
+
+    #the engine in use; a 'hybrid' run starts with the frontier engine
+    engineNow=('dense' if engineMode=='dense' else 'frontier')
+
+    #the population of the introduced species in each generation, for
+    #finding when it has stopped changing, and why the run stopped
+    invaderHistory=[]
+    stopReason=pkm.stopReasons['Tmax']
+
+    #if there is a checkpoint, start from it. ntStart is the first generation to run
+    ntStart=0
+    if (checkpointFile is not None) and os.path.exists(checkpointFile):
+        checkpointArrays,checkpointState=ckm.loadCheckpoint(checkpointFile)
+        P=checkpointArrays['P']
+        if checkpointState['finished']:
+            return checkpointState['nt'],P[:,0],checkpointState['stopReason']
+        taskRng.bit_generator.state=checkpointState['rng']
+        engineNow=checkpointState['engine']
+        invaderHistory=list(checkpointArrays['invaderHistory'])
+        ntStart=checkpointState['nt']+1
+            
+    #the frontier engine keeps the introduced species as the habitat
+    #points it holds, and the number there, and needs three scratch arrays
+    if engineNow=='frontier':
+        if 'incoming' not in frontierCache:
+            frontierCache['incoming']=pkm.incomingConnectivity(Eindptr,EwhereTo,EnumTo)
+        if (R1,Pmax) not in frontierCache:
+            frontierCache[(R1,Pmax)]=pkm.residentApproach(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo)
+        EinIndptr,EinFrom,EinProb=frontierCache['incoming']
+        supplyByGeneration=frontierCache[(R1,Pmax)]
+        invCell=nonzero(P[:,0])[0]
+        invCount=P[invCell,0]
+        settleWork=zeros((Ndomain,),dtype=int64)
+        invWork=zeros((Ndomain,),dtype=int64)
+        residentWork=zeros((Ndomain,),dtype=int64)
             
     #make lat and lon vectors for plotting
-    lonVec=array([nlin2lonLat[n][0] for n in nlin2lonLat])
-    latVec=array([nlin2lonLat[n][1] for n in nlin2lonLat])
+    lonVec=nlin2lonLat.valueArray[:,0]
+    latVec=nlin2lonLat.valueArray[:,1]
         
     #now loop over time, and let species propogate
     #for now assume Nspecies=1
     #print('Starting time iterations with Ndomain size',Ndomain,'and Nspecies',Nspecies)
-    for nt in range(Tmax):
+    nt=ntStart-1 #in case the checkpoint was at the last generation
+    for nt in range(ntStart,Tmax):
 
         #plot before working, just to see initial condition
         #if true, plot
@@ -249,25 +311,52 @@ def runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp):
                 pause(0.1)
             
         tic=time.time()
-        #now loop over each species, and figure out where its larvae will settle
-        #serial solution
-        whereSettle=findWhereSettle(P,0,Nspecies,R0,R1,Ndomain,Nspecies)
-
-        #now there are two possibilities. Where the total number of
-        #larvae reaching a location is less than or equal to Pmax,
-        #they all survive. Where it is greater, choose Pmax survivors
-        #randomly from the larvae. Should make sure number of recruits
-        #in each species is not greater than number of larvae which
-        #reach (really? or can the average number be right?). Do this
-        #in a function so it is easy to profile. NOTE WELL, assume all
-        #fitness differences are in the fecundity and dispersal, and
-        #thus handled by findWhereSettle().
-        #
-        #calculate this with whichLarvaeSurvive(), which updates P
-        tic2=time.time()
-        Pold=P.copy()
-        P=whichLarvaeSurvive(whereSettle,0,Ndomain,Pmax,Ndomain,Nspecies)
-            
+        if engineNow=='frontier':
+            #the whole generation is done in compiled code, and only
+            #works on the habitat points the introduced species holds
+            #or its larvae reach. tic2 is only kept for the diagnostics below
+            tic2=tic
+            #the native species starts full, as in P above, and falls
+            #to its level over the first generations
+            residentSupply=pkm.residentSupplyAt(supplyByGeneration,nt)
+            invCell,invCount=pkm.frontierGeneration(invCell,invCount,R0,R1,Pmax,residentSupply,EfracReturn,Eindptr,
+                                                    EwhereTo,Ecumsum,EnumTo,EinIndptr,EinFrom,EinProb,taskRng,
+                                                    pkm.dispersalModes[dispersalMode],settleWork,invWork,
+                                                    residentWork)
+            invaderTotal=invCount.sum()
+            #the native species fills the rest of the habitat, as in
+            #pkm.frontierToDense()
+            nativeTotal=Ndomain*Pmax-invaderTotal
+
+            #if the introduced species has grown too large for the
+            #frontier engine to be cheap, or accurate, change to the
+            #dense engine, with the native species drawn at its level
+            if (engineMode=='hybrid') and (invaderTotal>switchThreshold):
+                P=pkm.frontierToDense(invCell,invCount,Ndomain,Pmax,Pdtype,
+                                      pkm.residentSupplyAt(supplyByGeneration,nt+1),taskRng)
+                engineNow='dense'
+                nativeTotal=sum(P[:,1])
+        else:
+            #now loop over each species, and figure out where its larvae will settle
+            #serial solution
+            whereSettle=findWhereSettle(P,0,Nspecies,R0,R1,Ndomain,Nspecies,dispersalMode,settleDtype,taskRng)
+
+            #now there are two possibilities. Where the total number of
+            #larvae reaching a location is less than or equal to Pmax,
+            #they all survive. Where it is greater, choose Pmax survivors
+            #randomly from the larvae, without replacement, so the number
+            #of recruits in each species is not greater than number of
+            #larvae which reach. Do this in a function so it is easy to
+            #profile. NOTE WELL, assume all fitness differences are in the
+            #fecundity and dispersal, and thus handled by findWhereSettle().
+            #
+            #calculate this with whichLarvaeSurvive(), which updates P
+            tic2=time.time()
+            Pold=P.copy()
+            P=whichLarvaeSurvive(whereSettle,0,Ndomain,Pmax,Ndomain,Nspecies,Pdtype,taskRng)
+            invaderTotal=sum(P[:,0])
+            nativeTotal=sum(P[:,1])
+
 
         now=time.time()
         if False:
@@ -276,17 +365,195 @@ def runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp):
                   now-tic2,'; the population of the two species are',sum(P[:,0]),sum(P[:,1]),flush=True)
 
         #if the total population of 0 species (the introduced one) is 0, then quit
-        if sum(P[:,0])==0:
+        if invaderTotal==0:
             #print('species 0 whent extinct at nt=',nt)
+            stopReason=pkm.stopReasons['extinct']
+            break
+
+        #if the native species is gone, the introduced one has fixed,
+        #and nothing more can change, so quit. nativeTotal is found by
+        #both engines, so this does not depend on engineMode
+        if nativeTotal==0:
+            stopReason=pkm.stopReasons['fixed']
+            break
+
+        #if the population of the introduced species has stopped
+        #changing, quit
+        invaderHistory.append(int(invaderTotal))
+        if (stationaryWindow is not None) and pkm.isStationary(invaderHistory,stationaryWindow,stationaryTolerance):
+            stopReason=pkm.stopReasons['stationary']
             break
 
+        #save a checkpoint every so often
+        if (checkpointFile is not None) and (remainder(nt+1,checkpointEvery)==0):
+            if engineNow=='frontier':
+                P=pkm.frontierToDense(invCell,invCount,Ndomain,Pmax,Pdtype)
+            ckm.saveCheckpoint(checkpointFile,{'P':P,'invaderHistory':array(invaderHistory,dtype=int64)},
+                               {'nt':int(nt),'finished':False,'rng':taskRng.bit_generator.state,
+                                'engine':engineNow})
+
+    #the run is finished, so save its result, in case the other runs are interrupted
+    if engineNow=='frontier':
+        P=pkm.frontierToDense(invCell,invCount,Ndomain,Pmax,Pdtype)
+    if checkpointFile is not None:
+        ckm.saveCheckpoint(checkpointFile,{'P':P},{'nt':int(nt),'finished':True,'stopReason':int(stopReason)})
+
     #print what species and what process id -- only use when debugging to figure
     #out effciency issues. 
     #print('   done with region',nsp,'PID',os.getpid(),'in time',time.time()-ticBench,flush=True)
     
-    #return how many generations the introduced species persisted, and what its final
-    #distribution was
-    return nt,P[:,0]
+    #return how many generations the introduced species persisted, what its final
+    #distribution was, and why the run stopped
+    return nt,P[:,0],stopReason
+
+#The functions below set up the introductions of a run, and save its
+#output. They are used by the main program below, and by the parameter
+#sweep in 04_B_parameterSweep_twoSpeciesModel.py, so that both make the
+#same runs, and save them into the same files.
+
+def outputFileName(theModelName,R0,R1,Tmax,Pmax,Nintro,nR):
+    '''fileOut=outputFileName(theModelName,R0,R1,Tmax,Pmax,Nintro,nR)
+
+    the name of the file in which run nR with these parameters is
+    saved. If it exists, the run has been made.
+    '''
+    if Nintro<0:
+        fileOut=('modelOutputRelativeFitness/twoSpecies_'+theModelName
+                 +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_nRun%d.zip'%(R0,R1,Tmax,Pmax,nR))
+    else:
+        fileOut=('modelOutputRelativeFitness/twoSpecies_'+theModelName
+                 +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d_nRun%d.zip'%(R0,R1,Tmax,Pmax,Nintro,nR))
+    return fileOut
+
+def startRun(fileOut,Nregions,seed,resume):
+    '''runSeed,runStateFile,regionCheckpointFiles=startRun(fileOut,Nregions,seed,resume)
+
+    The seed of the run saved in fileOut is saved in runStateFile, so
+    that a resumed run uses the same one, and each introduction is
+    checkpointed into its own file in regionCheckpointFiles. If resume
+    is True and the run has been started before, its runSeed is the
+    one saved then; otherwise it is seed, and any old checkpoints of
+    the run are removed.
+    '''
+    checkpointName=os.path.join(ckm.checkpointDir,os.path.basename(fileOut).replace('.zip',''))
+    runStateFile=checkpointName+'_runState.npz'
+    regionCheckpointFiles=[checkpointName+'_region%d.npz'%nsp for nsp in range(Nregions)]
+    if resume and os.path.exists(runStateFile):
+        print('resuming from checkpoints',checkpointName)
+        checkpointArrays,checkpointState=ckm.loadCheckpoint(runStateFile)
+        runSeed=checkpointState['seed']
+    else:
+        runSeed=seed
+        for fileName in regionCheckpointFiles:
+            ckm.removeCheckpoint(fileName) #do not use the checkpoints of some older run
+        ckm.saveCheckpoint(runStateFile,{},{'seed':runSeed})
+    return runSeed,runStateFile,regionCheckpointFiles
+
+def introductionPinit(speciesList,nsp,Pmax,Nintro,runSeed,nR):
+    '''Pinit=introductionPinit(speciesList,nsp,Pmax,Nintro,runSeed,nR)
+
+    Pinit is the number of introduced species at each location in the
+    Ndomain points that make up the modeled habitat, for the
+    introduction into region nsp of run nR. speciesList gives the
+    region of each point, from the initial condition file. If Nintro<0
+    the whole region is filled to Pmax, otherwise Nintro individuals
+    are placed at random in it.
+    '''
+    Ndomain=len(speciesList)
+    indx=speciesList==nsp #find all points in species in initial range.
+    Pinit=zeros((Ndomain,),dtype=int)
+
+    #now, figure out how many larvae to introduce
+    if Nintro<0:
+        #if Nintro<0, fill entire 
+        Pinit[indx]=Pmax
+    else:
+        #if Nintro>0, then fill the species range with the smaller
+        #of Nintro or Pmax*(number of locations in species initial range)
+        initialPoints=arange(len(speciesList))[indx] #indices of points in species initial range
+        #now make Pmax copies of these points; this is a list of all possible places an introduction
+        #could go
+        jnk=[]
+        for nP in range(Pmax):
+            jnk=jnk+list(initialPoints)
+        initialPoints=array(jnk)
+        #randomize where individuals are placed
+        rsm.streamRng(runSeed,rsm.initialStream,nR,nsp).shuffle(initialPoints)
+
+        #now randomly add points to the domain. We know we can't add too many
+        #because initialPoints's length is the maximum number of points an
+        #initial species range can hold.
+        numPoints=min(Nintro,len(initialPoints))
+        for thePoint in initialPoints[:numPoints]:
+            Pinit[thePoint]+=1
+
+        if Nintro>len(initialPoints):
+            print('For population',nsp,'Population initially saturated')
+
+    return Pinit
+
+def openRunOutput(outputFormat,theModelName,R0,R1,Tmax,Pmax,Nintro,nRun,speciesList,Pdtype,engineMode):
+    '''store=openRunOutput(outputFormat,theModelName,R0,R1,Tmax,Pmax,Nintro,nRun,speciesList,Pdtype,engineMode)
+
+    If outputFormat is 'store', all nRun runs with these parameters are
+    saved into a single zarr store, which is opened, or made, here; see
+    outputStore_module.py. If it is 'zip', each run is saved into its
+    own file, named by outputFileName(), and store is None.
+    '''
+    if outputFormat=='zip':
+        return None
+    assert outputFormat=='store','outputFormat must be zip or store'
+    lonVec=nlin2lonLat.valueArray[:,0]
+    latVec=nlin2lonLat.valueArray[:,1]
+    return osm.openFitnessStore(osm.fitnessStoreName(theModelName,R0,R1,Tmax,Pmax,Nintro),nRun,
+                                lonVec,latVec,speciesList,Pdtype,engineMode)
+
+def isRunSaved(fileOut,store,nR):
+    '''isSaved=isRunSaved(fileOut,store,nR)
+
+    True if run nR has been saved, into fileOut if store is None, and
+    into store otherwise
+    '''
+    if store is None:
+        return os.path.isfile(fileOut)
+    return osm.hasFitnessRun(store,nR)
+
+def saveRunOutput(fileOut,store,nR,output,speciesList,runSeed,engineMode,Pdtype,checkpointFiles):
+    '''saveRunOutput(fileOut,store,nR,output,speciesList,runSeed,engineMode,Pdtype,checkpointFiles)
+
+    save the results of run nR, where output[n] is what runModelOnce()
+    returned for the introduction into region n, into fileOut if store
+    is None, and into store otherwise. Then remove the checkpointFiles
+    of the run, which are no longer needed.
+    '''
+    Ndomain=len(speciesList)
+    Nregions=len(output)
+    ntVecFinal=zeros((Nregions,),dtype=int) #the number of generations each species lasts before going extinct
+    stopReasonVec=zeros((Nregions,),dtype=int8) #why each run stopped, one of pkm.stopReasons
+    finalPopVec=zeros((Ndomain,Nregions),dtype=Pdtype) #the distribution of each generation at the end of the run
+
+    #save into ntVecFinal how long the introduced species persisted in region n
+    #save into finalPopVec what the final spatial distribution of the species introduced
+    #into region n was, and into stopReasonVec why its run stopped
+    for n in range(Nregions):
+        nt,Pfinal,stopReason=output[n]
+        ntVecFinal[n]=nt
+        finalPopVec[:,n]=Pfinal
+        stopReasonVec[n]=stopReason
+
+    if store is None:
+        lonVec=nlin2lonLat.valueArray[:,0]
+        latVec=nlin2lonLat.valueArray[:,1]
+        zarr.save(fileOut,
+                  lonVec=lonVec,latVec=latVec,finalPopVec=finalPopVec,ntVecFinal=ntVecFinal,speciesList=speciesList,
+                  stopReasonVec=stopReasonVec,seed=array(runSeed,dtype=int64),engineMode=array(engineMode))
+    else:
+        osm.saveFitnessRun(store,nR,finalPopVec,ntVecFinal,stopReasonVec,runSeed)
+
+    #the output is saved, so the checkpoints are no longer needed
+    for fileName in checkpointFiles:
+        ckm.removeCheckpoint(fileName)
+    return None
         
 __spec__=None #ignore this line, it fixes a bug in multiprocessing on osx
 if __name__=="__main__":
@@ -303,6 +570,32 @@ if __name__=="__main__":
     #for speed, the Nregion model runs will be made in parallel. 
     nRun=100 ; print('FOR SPEED OF INITIAL USE, nRun IS SET TO 100. IT SHOULD BE LARGER IN MOST CASES')
 
+    #Every checkpointEvery generations, the state of each introduction
+    #is saved in the directory checkpoints (see checkpoint_module.py),
+    #along with the initial conditions and random number seeds of the
+    #introductions. If the code is interrupted, run it again with the
+    #--resume flag, e.g.
+    #"python 04_twoSpeciesModel_differentR_relativeFitnessDifference.py --resume",
+    #and it will continue each introduction from its last checkpoint,
+    #giving the same results as if it had never been interrupted. The
+    #checkpoints of a run are deleted when its output file is written.
+    checkpointEvery=100
+    resume=('--resume' in sys.argv[1:])
+
+    #All of the random numbers are made from seed (see
+    #rngStreams_module.py), so the results depend only on seed, and
+    #not on nCPU. The introduction into region nsp in run nR uses the
+    #streams with keys (nR,nsp). If seed is None, a new seed is picked.
+    #The seed is saved in each output file, so the runs can be repeated
+    #by setting seed to it. A resumed run uses the seed saved in its
+    #checkpoint.
+    seed=None
+    seed=rsm.makeSeed(seed)
+    print('The seed of the random numbers is',seed)
+
+    #load the connectivity model
+    loadConnectivity(ConnectivityModelName)
+
     for nR in range(nRun):
 
         print('\nStarting run %d\n'%nR)
@@ -314,28 +607,94 @@ if __name__=="__main__":
         Pmax=1
         Tmax=601*4 
 
+        #How the larvae from each habitat point are sent to their
+        #destinations. 'larvae' places each larva individually, and
+        #its cost scales with R; 'multinomial' draws the number going to
+        #each destination at once, and its cost scales with the number
+        #of destinations; 'auto' picks the cheaper for each habitat
+        #point. All give the same statistics. See populationKernels_module.py
+        dispersalMode='auto'
+
+        #How the model is run. 'dense' models both species over the
+        #whole domain every generation. 'frontier' only follows the
+        #introduced species, taking the native species to fill the rest
+        #of the habitat, and draws the native larvae competing with the
+        #introduced ones where they settle; its cost scales with the
+        #number of habitat points the introduced species holds, so it is
+        #much faster, since most introductions stay small or die out
+        #quickly. It is an approximation, which ignores the thinning of
+        #the native species around an introduction which has become
+        #established. 'hybrid' uses the frontier engine while the
+        #introduced species has no more than switchThreshold adults,
+        #and changes to the dense engine if it grows past that, so it is
+        #fast for the many introductions which stay small, and exact for
+        #those which spread. See populationKernels_module.py. 'dense' is
+        #the default, defaultEngineMode above; use 'frontier' or
+        #'hybrid' only once runs of several generations of them have
+        #been shown to give the same persistence of the introduced
+        #species as 'dense' for the connectivity and parameters in use.
+        #switchThreshold is made by defaultSwitchThreshold() above
+        engineMode=defaultEngineMode
+        switchThreshold=defaultSwitchThreshold(len(nxny2nlin),Pmax)
+
+        #A run stops before Tmax if the introduced species goes extinct,
+        #or if it fixes, so the native species is gone. If
+        #stationaryWindow is not None, it also stops if the population
+        #of the introduced species has stopped changing: if, over the
+        #last stationaryWindow generations, the change in its
+        #population, plus twice the uncertainty of that change, is less
+        #than stationaryTolerance times its population; see
+        #pkm.isStationary(). Such a run could still have gone extinct
+        #before Tmax, so it is not counted as persisting, and this is
+        #off by default; e.g. stationaryWindow=400 and
+        #stationaryTolerance=0.05 turn it on. Why each run stopped is
+        #saved in stopReasonVec, with the codes in pkm.stopReasons, and
+        #the generation it stopped in ntVecFinal.
+        stationaryWindow=None
+        stationaryTolerance=0.05
+
+        #The integer types in which the population and the number of
+        #settlers are stored, and saved. Pdtype is 'uint8' or 'uint16', or
+        #'auto' to use the smallest which can hold Pmax. settleDtype is
+        #'uint16' or 'uint32'; if more larvae of one species settle in a
+        #habitat point than settleDtype can hold, the model stops with an
+        #error, and a larger one should be used. See populationKernels_module.py
+        Pdtype=pkm.populationDtype(Pmax,'auto').name
+        settleDtype='uint16'
+
         #now, and important and subtle parameter. How many introductions
         #do we have? I.e. in each species location, how many adults do we
         #start with. Call this Nintro. If negative, fill entire species
         #range. Otherwise just release Nintro into the domain.
         Nintro=1
 
+        #How the output is saved. If 'store', all of the runs are saved
+        #into a single zarr store, with dimensions (run,location,region)
+        #and (run,region); if 'zip', each run is saved into its own
+        #file. See outputStore_module.py
+        outputFormat='store'
+
         #size of domain
         Ndomain=len(nxny2nlin)
 
-        #now make the file name in which data will be saved. Then
-        #check if the file exists, and if it does not exist, run the
-        #model. This allows the code to interrupted and restarted.
-        if Nintro<0:
-            fileOut=('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
-                     +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_nRun%d.zip'%(R0,R1,Tmax,Pmax,nR))
-        else:
-            fileOut=('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
-                     +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d_nRun%d.zip'%(R0,R1,Tmax,Pmax,Nintro,nR))
-
-        #check if file exists, skips if it does not
-        if os.path.isfile(fileOut):
-            print('skipping because it exists:',fileOut)
+        #load an initial condition file; there will be a run for every
+        #discrete "species" in that initial condition file.
+        jnk=zarr.load(initialConditionFile)
+        speciesList=jnk['nSpecies']
+        Nregions=len(unique(speciesList))
+
+        #now make the file name in which data will be saved, or open the
+        #store it will be saved in. Then check if the run has been
+        #saved, and if it has not, run the model. This allows the code
+        #to interrupted and restarted. The name of fileOut is also used
+        #for the checkpoints of the run.
+        fileOut=outputFileName(ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro,nR)
+        store=openRunOutput(outputFormat,ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro,nRun,speciesList,Pdtype,
+                            engineMode)
+
+        #check if run has been saved, skips if it has
+        if isRunSaved(fileOut,store,nR):
+            print('skipping run %d because it has been saved'%nR)
         else:
             #run model
 
@@ -343,37 +702,31 @@ if __name__=="__main__":
                 #simple debugging run
                 def findClosest(lonVec,latVec,lonP,latP):
                     return argmin(((lonVec-lonP)/cos(deg2rad(latVec)))**2+(latVec-latP)**2)
-                lonVec=array([nlin2lonLat[n][0] for n in nlin2lonLat])
-                latVec=array([nlin2lonLat[n][1] for n in nlin2lonLat])
+                lonVec=nlin2lonLat.valueArray[:,0]
+                latVec=nlin2lonLat.valueArray[:,1]
                 n0=findClosest(lonVec,latVec,-74.42,39.21);
                 Pinit=zeros((Ndomain,),dtype=int)
                 Pinit[n0]=4
 
-                Pfinal,nt=runModelOnce(Pinit,R0,R1,Pmax,Tmax)
+                nt,Pfinal,stopReason=runModelOnce(Pinit,R0,R1,Pmax,Tmax,0,dispersalMode,engineMode,switchThreshold,
+                                                  stationaryWindow,stationaryTolerance,Pdtype,settleDtype,
+                                                  rsm.streamSeed(seed,rsm.modelStream,nR,0),None,checkpointEvery)
             else:
-                #load an initial condition file, and make a run for every discrete "species" in that
-                #initial condition file.
-                jnk=zarr.load(initialConditionFile)
-                speciesList=jnk['nSpecies']
-                Nregions=len(unique(speciesList))
-
+                #make a run for every discrete "species" in the initial condition file.
                 print('This run has',Nregions,'regions in which a novel species is introduced')
                 print('note, progress bar only includes start of each species run...')
 
-                ntVecFinal=zeros((Nregions,),dtype=int) #the number of generations each species lasts before going extinct
-                finalPopVec=zeros((Ndomain,Nregions),dtype=int) #the distribution of each generation at the end of the run
-
                 if False:
                     #serial run
+                    output=[]
+                    runSeed=seed
                     for nsp in [0]: #range(Nregions): #assume species numbered in range(0,Nregions)
-                        indx=speciesList==nsp
-                        Pinit=zeros((Ndomain,),dtype=int)
-                        Pinit[indx]=Pmax
-                        assert False,'have not implimented Nintro yet'
-
-                        nt,Pfinal=runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp)
-                        ntVecFinal[nsp]=nt
-                        finalPopVec[:,nsp]=Pfinal
+                        Pinit=introductionPinit(speciesList,nsp,Pmax,Nintro,runSeed,nR)
+                        output.append(runModelOnce(Pinit,R0,R1,Pmax,Tmax,nsp,dispersalMode,engineMode,
+                                                   switchThreshold,stationaryWindow,stationaryTolerance,Pdtype,
+                                                   settleDtype,rsm.streamSeed(runSeed,rsm.modelStream,nR,nsp),
+                                                   None,checkpointEvery))
+                    checkpointFiles=[]
                 else:
                     #parallel run. Each introduction region will be run
                     #on a seperate core of the machine. 
@@ -387,67 +740,34 @@ if __name__=="__main__":
                     #experiment...
                     nCPU=mp.cpu_count()#//2 
 
+                    #get the seed of the run, and its checkpoint files;
+                    #if resuming, the seed is the one the run started with
+                    runSeed,runStateFile,regionCheckpointFiles=startRun(fileOut,Nregions,seed,resume)
+                    checkpointFiles=regionCheckpointFiles+[runStateFile]
+
                     argVec=[]
                     for nsp in range(Nregions): #make a seperate run for each introduction region
-                        indx=speciesList==nsp #find all points in species in initial range.
-
                         #Pinit is the number of introduced species at
                         #each location in the Ndomain points that make
                         #up the modeled habitat
-                        Pinit=zeros((Ndomain,),dtype=int)
-
-                        #now, figure out how many larvae to introduce
-                        if Nintro<0:
-                            #if Nintro<0, fill entire 
-                            Pinit[indx]=Pmax
-                        else:
-                            #if Nintro>0, then fill the species range with the smaller
-                            #of Nintro or Pmax*(number of locations in species initial range)
-                            initialPoints=arange(len(speciesList))[indx] #indices of points in species initial range
-                            #now make Pmax copies of these points; this is a list of all possible places an introduction
-                            #could go
-                            jnk=[]
-                            for nP in range(Pmax):
-                                jnk=jnk+list(initialPoints)
-                            initialPoints=array(jnk)
-                            shuffle(initialPoints) #do this to randomize where individuals are placed
-
-                            #now randomly add points to the domain. We know we can't add too many
-                            #because initialPoints's length is the maximum number of points an
-                            #initial species range can hold.
-                            numPoints=min(Nintro,len(initialPoints))
-                            for thePoint in initialPoints[:numPoints]:
-                                Pinit[thePoint]+=1
-
-                            if Nintro>len(initialPoints):
-                                print('For population',nsp,'Population initially saturated')
+                        Pinit=introductionPinit(speciesList,nsp,Pmax,Nintro,runSeed,nR)
 
                         #argVec are the list of arguements to be fed into the multiprocessing routine
                         #which will run all the different introductions on different cores. 
-                        argVec.append((Pinit,R0,R1,Pmax,Tmax,nsp))
+                        argVec.append((Pinit,R0,R1,Pmax,Tmax,nsp,dispersalMode,engineMode,switchThreshold,
+                                       stationaryWindow,stationaryTolerance,Pdtype,settleDtype,
+                                       rsm.streamSeed(runSeed,rsm.modelStream,nR,nsp),
+                                       regionCheckpointFiles[nsp],checkpointEvery))
 
                     tic=time.time()
-                    with mp.Pool(nCPU) as pool:
+                    with mp.Pool(nCPU,initializer=loadConnectivity,initargs=(ConnectivityModelName,)) as pool:
                         #tqdm adds a progress bar (which is wonky, because it
                         #really tells you when function is called), but it is close. 
                         output=pool.starmap(runModelOnce,tqdm.tqdm(argVec,total=len(argVec))) #displays progress bar
                         #output=pool.starmap(runModelOnce,argVec) #run without progress bar
                     print('One run of introductions into all regions done in',time.time()-tic,'seconds',flush=True)
 
-                    #save into ntVecFinal how long the introduced species persisted in region n
-                    #save into finalPopVec what the final spatial distribution of the species introduced
-                    #into region n was. 
-                    for n in range(len(output)):
-                        nt,Pfinal=output[n]
-                        ntVecFinal[n]=nt
-                        finalPopVec[:,n]=Pfinal
-
-
-                #now save for each run what the results of introductions into each region was. 
+                #now save for each run what the results of introductions into each region was,
+                #into ntVecFinal, finalPopVec and stopReasonVec; see saveRunOutput()
                 if True: #turn off for benchmarking
-                    lonVec=array([nlin2lonLat[n][0] for n in nlin2lonLat])
-                    latVec=array([nlin2lonLat[n][1] for n in nlin2lonLat])
-                    zarr.save(fileOut,
-                              lonVec=lonVec,latVec=latVec,finalPopVec=finalPopVec,ntVecFinal=ntVecFinal,speciesList=speciesList)
-
-
+                    saveRunOutput(fileOut,store,nR,output,speciesList,runSeed,engineMode,Pdtype,checkpointFiles)
@@ -4,7 +4,10 @@ import zarr
 import xarray as xr
 import time
 import multiprocessing as mp
+import sys
 import createLinearModel_module as cLM
+import populationKernels_module as pkm
+import streamingStatistics_module as ssm
 import cartopy.crs as ccrs
 import cartopy
 
@@ -21,33 +24,55 @@ initialConditionFile='initialConditions/'+ConnectivityModelName+'.zip'
 jnk=zarr.load(initialConditionFile)
 speciesList=jnk['nSpecies']
 
-#load final answer
-for nR in arange(nRun):
-    if Nintro<=0:
-        jnk=zarr.load('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
-                      +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_nRun%d.zip'
-                      %(R0,R1,Tmax,Pmax,nR))
-    else:
-        jnk=zarr.load('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
-                      +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d_nRun%d.zip'
-                      %(R0,R1,Tmax,Pmax,Nintro,nR))
-
-    print('reading run nR',nR,'number fixed',sum(jnk['ntVecFinal']==Tmax-1))
-    if nR==0:
-        #finalPopVec=jnk['finalPopVec']
-        lonVec=jnk['lonVec']
-        latVec=jnk['latVec']
-        ntVecFinal=jnk['ntVecFinal']
-        fixedVec=0*jnk['ntVecFinal']
-        fixedVec[jnk['ntVecFinal']==Tmax-1]=1
-    else:
-        ntVecFinal=jnk['ntVecFinal']+ntVecFinal
-        indx=jnk['ntVecFinal']==Tmax-1
-        fixedVec[indx]=fixedVec[indx]+1
-
-#normalize by nRun to get average ntVecFinal
-ntVecFinal=ntVecFinal/nRun
-fixedVec=fixedVec/nRun
+#how the output of
+#04_twoSpeciesModel_differentR_relativeFitnessDifference.py was saved,
+#'store' for a single store of all the runs, or 'zip' for a file for
+#each run; see outputStore_module.py
+outputFormat='store'
+
+#The runs are read, in parallel, and reduced to the statistics below
+#by streamingStatistics_module.py, which only holds a few runs in
+#memory at a time. If this code is run with the --watch flag, e.g.
+#"python 05_analyzeWhereSurvivorsStarted_RelativeFitnessModel.py --watch",
+#it keeps reading the runs as
+#04_twoSpeciesModel_differentR_relativeFitnessDifference.py saves them,
+#printing the statistics every watchInterval seconds, until all nRun
+#runs are read or it is stopped with control-C, and then makes the
+#plots from the runs read so far.
+watchInterval=60.0
+source=ssm.fitnessSource(outputFormat,ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro)
+if '--watch' in sys.argv[1:]:
+    acc=ssm.watchRuns(source,range(nRun),speciesList,lambda acc: ssm.printSummary(acc,'persisted'),watchInterval)
+else:
+    acc=ssm.reduceRuns(source,range(nRun),speciesList)
+ssm.printSummary(acc,'persisted')
+if acc['nRun']<nRun:
+    print('only',acc['nRun'],'of the',nRun,'runs have been saved')
+lonVec,latVec=ssm.loadCoordinates(source,range(nRun))
+
+#a run can stop before Tmax because the introduced species fixed, or
+#stopped changing, as well as because it went extinct. Only extinction
+#and fixation are final, so the introductions which persisted are
+#those whose run reached Tmax or fixed, found with pkm.didPersist(),
+#and counted as lasting until Tmax. Runs which stopped because they
+#stopped changing (only if stationaryWindow was set in the model) may
+#still have gone extinct before Tmax, so they are counted separately,
+#as stationary; see ssm.fitnessRunStatistics().
+#
+#fixedVec is the fraction of the runs in which the introduction into
+#each region persisted, and fixedLow and fixedHigh its 95% confidence
+#interval. stationaryVec, stationaryLow and stationaryHigh are the
+#same for the runs which stopped as stationary. ntVecFinal is the
+#average number of generations the introduction into each region
+#lasted.
+nRun=acc['nRun'] #the number of runs read
+fixedVec=ssm.runMean(acc,'persisted')
+fixedLow,fixedHigh=ssm.confidenceInterval(acc,'persisted')
+stationaryVec=ssm.runMean(acc,'stationary')
+stationaryLow,stationaryHigh=ssm.confidenceInterval(acc,'stationary')
+if any(stationaryVec>0):
+    ssm.printSummary(acc,'stationary')
+ntVecFinal=ssm.runMean(acc,'ntVecRun')
         
 
 
@@ -78,6 +103,9 @@ ax1.gridlines(draw_labels=True)
 if True:
     #plot fraction fixed
     titleText='\nFraction persist for %d generations'%Tmax
+    if any(stationaryVec>0):
+        titleText+=('\n%4.2f%% of runs stopped as stationary, not counted as persisting'
+                    %(100*mean(stationaryVec),))
     for n in range(len(unique(speciesList))):
         indx=speciesList==n
         if fixedVec[n]>0.5/100: #ignore less than some fraction
@@ -0,0 +1,60 @@
+from numpy import *
+import numpy as np
+import os
+import json
+
+# This module saves and loads checkpoints of the long model runs in
+# 02_manyNeutralSpecies_fastModel.py and
+# 04_twoSpeciesModel_differentR_relativeFitnessDifference.py, so that a
+# run that is interrupted (e.g. on a pre-emptible cluster node) can be
+# continued with the --resume flag, and gives the same answer,
+# bit-for-bit, as if it had never been interrupted.
+#
+# A checkpoint is a .npz file holding numpy arrays (e.g. the
+# population) and a dictionary of python values (e.g. the generation
+# and the seed of the random numbers), which is stored as json. It is
+# written to a temporary file which is then renamed to the checkpoint
+# name, so a checkpoint file is always complete, even if the job is
+# killed while it is being written.
+
+#the directory the checkpoints are kept in
+checkpointDir='checkpoints'
+
+def saveCheckpoint(fileName,arrays,state):
+    '''saveCheckpoint(fileName,arrays,state)
+
+    fileName: the name of the checkpoint file, which should end in .npz
+    arrays: a dictionary of numpy arrays
+    state: a dictionary of values which can be stored as json, such as
+       ints, floats, strings and rng.bit_generator.state
+    '''
+    theDir=os.path.dirname(fileName)
+    if theDir!='':
+        os.makedirs(theDir,exist_ok=True)
+
+    tmpName=fileName+'.tmp'
+    with open(tmpName,'wb') as fid:
+        np.savez(fid,checkpointState=array(json.dumps(state)),**arrays)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmpName,fileName)
+    return None
+
+def loadCheckpoint(fileName):
+    '''arrays,state=loadCheckpoint(fileName)
+
+    load a checkpoint written by saveCheckpoint()
+    '''
+    with np.load(fileName) as data:
+        state=json.loads(str(data['checkpointState']))
+        arrays={k:data[k] for k in data.files if k!='checkpointState'}
+    return arrays,state
+
+def removeCheckpoint(fileName):
+    '''removeCheckpoint(fileName)
+
+    delete a checkpoint file, if it exists
+    '''
+    if os.path.exists(fileName):
+        os.remove(fileName)
+    return None
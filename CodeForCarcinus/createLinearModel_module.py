@@ -3,7 +3,13 @@ from numpy import *
 import zarr
 import xarray as xr
 from collections import defaultdict,Counter
+from collections.abc import Mapping
 import time
+import os
+import json
+import hashlib
+import shutil
+from multiprocessing import shared_memory
 import getEZfateFromOSN
 
 
@@ -23,9 +29,474 @@ import getEZfateFromOSN
 maskFile='EZfateData/EZfateFiles/ext-PSY4V3R1_mesh_zgr.nc'
 maskFile=getEZfateFromOSN.getFileFromOSN(maskFile)
 
+#This function takes the ragged, object array form of the connectivity
+#(one small array per habitat point) and packs it into compressed
+#sparse row (CSR) form. The destinations of all the habitat points are
+#stored end to end in a single flat array, and the destinations of
+#habitat point n are in the slice Eindptr[n]:Eindptr[n+1] of the flat
+#arrays. This avoids the overhead of a python object for each habitat
+#point, and the flat arrays can be passed straight into numba.
+def packCSR(EwhereTo,EnumTo):
+    '''packCSR(EwhereTo,EnumTo):
+
+    EwhereTo and EnumTo are object arrays of length Ndomain, where each
+    element is an array of the linear indices that larvae go to, and
+    the number of larvae that go to each of those indices.
+
+    returns Eindptr,EwhereToFlat,EnumToFlat,EcumsumFlat where Eindptr is
+    of length Ndomain+1 and the row n of each flat array is
+    flatArray[Eindptr[n]:Eindptr[n+1]]. EcumsumFlat is the cumulative
+    sum of numTo/sum(numTo) within each row, as in Ecumsum.
+    '''
+
+    #find the offsets of each row in the flat arrays
+    rowLength=array([len(n) for n in EnumTo],dtype=int64)
+    Eindptr=zeros((len(rowLength)+1,),dtype=int64)
+    Eindptr[1:]=cumsum(rowLength)
+
+    #now pack the rows end to end. The linear indices will always be
+    #less than 2**31, so store them as int32 to save memory
+    if Eindptr[-1]>0:
+        EwhereToFlat=concatenate([n for n in EwhereTo]).astype(int32)
+        EnumToFlat=concatenate([n for n in EnumTo])
+    else:
+        EwhereToFlat=zeros((0,),dtype=int32)
+        EnumToFlat=zeros((0,),dtype=uint16)
+
+    EcumsumFlat=cumsumCSR(Eindptr,EnumToFlat)
+
+    return Eindptr,EwhereToFlat,EnumToFlat,EcumsumFlat
+
+def cumsumCSR(Eindptr,EnumToFlat):
+    '''cumsumCSR(Eindptr,EnumToFlat): returns the flat array of the
+    cumulative sum of numTo/sum(numTo) within each row of the compressed
+    sparse row array EnumToFlat, as in Ecumsum
+    '''
+    #the cumulative sum within each row is the cumulative sum over the
+    #whole flat array minus the cumulative sum at the start of the
+    #row. Do this in integers so the last value in each row is exactly 1.0
+    rowLength=diff(Eindptr)
+    rowNum=repeat(arange(len(rowLength)),rowLength)
+    numCumsum=concatenate(([0],cumsum(EnumToFlat,dtype=int64)))
+    numBefore=numCumsum[Eindptr[:-1]]
+    rowTotal=numCumsum[Eindptr[1:]]-numBefore
+    return (numCumsum[1:]-numBefore[rowNum])/rowTotal[rowNum]
+
+def unpackCSR(Eindptr,flatArray):
+    '''unpackCSR(Eindptr,flatArray): the inverse of packCSR(); returns an
+    object array with one array per row of the compressed sparse row
+    array flatArray. Each element is a view into flatArray.
+    '''
+    out=empty((len(Eindptr)-1,),dtype=object)
+    for n in range(len(out)):
+        out[n]=flatArray[Eindptr[n]:Eindptr[n+1]]
+    return out
+
+#===============================================================================================
+#Array backed replacements for the nxny2nlin, nlin2nxny, nxny2lonLat
+#and nlin2lonLat dictionaries. Building dictionaries with an entry for
+#every habitat point, and then looking up every destination in them
+#one at a time, is what makes loading a large connectivity matrix
+#slow. These classes store the same information in arrays, and look
+#up (nx,ny) with a packed integer key and searchsorted(), but they can
+#still be used like the dictionaries (indexed, iterated over, tested
+#with "in" and passed to len()) by the existing scripts.
+
+#pack (nx,ny) into a single integer. This is the same packing as
+#makeConnectivityModule.grid2int(), but in int64 so that the
+#impossible location (-1,-1) does not wrap around.
+def nxny2key(nx,ny):
+    '''nxny2key(nx,ny): convert (nx,ny) model grid indices, which may be
+    arrays, to a single integer key'''
+    return asarray(nx,dtype=int64)*10000+asarray(ny,dtype=int64)
+
+class nxnyMap(Mapping):
+    '''nxnyMap(nxVec,nyVec,valueArray=None,sortIndx=None)
+
+    A read only, dictionary like map whose keys are the (nx,ny) pairs
+    in nxVec and nyVec. If valueArray is None, the value of key
+    (nxVec[n],nyVec[n]) is n, so this behaves like nxny2nlin. Otherwise
+    the value is valueArray[n], returned as a tuple if valueArray is
+    two dimensional, so an (Ndomain,2) array of (lon,lat) behaves like
+    nxny2lonLat.
+
+    For vectorized use, lookup(nx,ny) returns the index n for arrays
+    of nx and ny, and valueArray holds all the values.
+
+    sortIndx, the order that sorts the packed keys, can be passed in
+    if it is already known (e.g. from the linear model cache) to save
+    sorting them again.
+    '''
+    def __init__(self,nxVec,nyVec,valueArray=None,sortIndx=None):
+        self.nxVec=asarray(nxVec)
+        self.nyVec=asarray(nyVec)
+        if valueArray is None:
+            valueArray=arange(len(self.nxVec))
+        self.valueArray=valueArray
+
+        #sort the keys so they can be found with searchsorted()
+        keyVec=nxny2key(self.nxVec,self.nyVec)
+        if sortIndx is None:
+            sortIndx=argsort(keyVec,kind='stable')
+        self.sortIndx=sortIndx
+        self.sortedKeys=keyVec[self.sortIndx]
+
+    def lookup(self,nx,ny):
+        '''lookup(nx,ny): return the index n of each (nx,ny), or -1 if
+        (nx,ny) is not in the map'''
+        key=nxny2key(nx,ny)
+        if len(self.sortedKeys)==0:
+            return full(shape(key),-1,dtype=int64)
+        indx=minimum(searchsorted(self.sortedKeys,key),len(self.sortedKeys)-1)
+        return where(self.sortedKeys[indx]==key,self.sortIndx[indx],-1)
+
+    def __getitem__(self,nxny):
+        n=int(self.lookup(nxny[0],nxny[1]))
+        if n<0:
+            raise KeyError(nxny)
+        if ndim(self.valueArray)==1:
+            return self.valueArray[n].item()
+        return tuple(self.valueArray[n].tolist())
+
+    def __contains__(self,nxny):
+        return int(self.lookup(nxny[0],nxny[1]))>=0
+
+    def __iter__(self):
+        #iterate in the order of nxVec and nyVec, as the dictionaries did
+        return zip(self.nxVec.tolist(),self.nyVec.tolist())
+
+    def __len__(self):
+        return len(self.nxVec)
+
+class nlinMap(Mapping):
+    '''nlinMap(valueArray)
+
+    A read only, dictionary like map whose keys are the integers
+    0..len(valueArray)-1 and whose value for key n is valueArray[n],
+    returned as a tuple if valueArray is two dimensional. So an
+    (Ndomain,2) array of (lon,lat) behaves like nlin2lonLat.
+    '''
+    def __init__(self,valueArray):
+        self.valueArray=valueArray
+
+    def __getitem__(self,n):
+        if not (0<=n<len(self.valueArray)):
+            raise KeyError(n)
+        if ndim(self.valueArray)==1:
+            return self.valueArray[n].item()
+        return tuple(self.valueArray[n].tolist())
+
+    def __contains__(self,n):
+        return 0<=n<len(self.valueArray)
+
+    def __iter__(self):
+        return iter(range(len(self.valueArray)))
+
+    def __len__(self):
+        return len(self.valueArray)
+
+#This function does the same job as makeLinearModel() below, and
+#returns the same things, but it builds everything with whole array
+#operations instead of dictionaries and per point loops, and it
+#returns nxnyMap and nlinMap objects in place of the nxny2nlin,
+#nlin2nxny, nxny2lonLat and nlin2lonLat dictionaries. It is much
+#faster for large habitats. Call it through makeLinearModel(EfileName,useDicts=False)
+def makeLinearModel_arrays(EfileName,returnCSR=False):
+
+    # what transpose file is going to give connectivity to the model?
+    # It is called Enxny to make clear it is in nx,ny model grid space
+    Enxny=zarr.open(EfileName,'r')
+
+    #the map from (nx,ny) to the linear index is just the position of
+    #(nx,ny) in nxFrom,nyFrom. Again, THE KEY ASSUMPTION IS that there
+    #are no points in nxTo,nyTo that are not also in nxFrom,nyFrom.
+    nxVec=Enxny.nxFrom[:]
+    nyVec=Enxny.nyFrom[:]
+    nxny2nlin=nxnyMap(nxVec,nyVec)
+    assert len(unique(nxny2nlin.sortedKeys))==len(nxVec),'there seem to be duplicate nxFrom,nyFrom points in E matrix?'
+
+    #the map from the linear index back to (nx,ny), with the "kill
+    #bucket" Ndomain at the impossible location (-1,-1)
+    Ndomain=len(nxVec)
+    nxnyArray=full((Ndomain+1,2),-1,dtype=int64)
+    nxnyArray[:Ndomain,0]=nxVec
+    nxnyArray[:Ndomain,1]=nyVec
+    nlin2nxny=nlinMap(nxnyArray)
+
+    #now make a map from (nx,ny) and (nlin) to (lon,lat)
+    gridData=xr.open_dataset(maskFile)
+    lonLatArray=zeros((Ndomain,2),dtype=gridData.nav_lon.dtype)
+    lonLatArray[:,0]=gridData.nav_lon.data[nyVec,nxVec]
+    lonLatArray[:,1]=gridData.nav_lat.data[nyVec,nxVec]
+    nxny2lonLat=nxnyMap(nxVec,nyVec,lonLatArray)
+    nlin2lonLat=nlinMap(lonLatArray)
+
+    #flatten the ragged arrays into compressed sparse row form (see
+    #packCSR()), and map all of the destinations into the linear space at once
+    nxTo=Enxny.nxTo[:]
+    nyTo=Enxny.nyTo[:]
+    numTo=Enxny.numTo[:]
+    Eindptr=zeros((Ndomain+1,),dtype=int64)
+    Eindptr[1:]=cumsum([len(n) for n in numTo])
+    if Eindptr[-1]>0:
+        EwhereTo=nxny2nlin.lookup(concatenate(list(nxTo)),concatenate(list(nyTo)))
+        EnumTo=concatenate(list(numTo))
+    else:
+        EwhereTo=zeros((0,),dtype=int64)
+        EnumTo=zeros((0,),dtype=uint16)
+    assert (EwhereTo>=0).all(),'there are nxTo,nyTo points that are not in nxFrom,nyFrom'
+    EwhereTo=EwhereTo.astype(int32)
+    Ecumsum=cumsumCSR(Eindptr,EnumTo)
+
+    #the fraction of releases that return to shore, with the nan's from
+    #the zeros in numLaunched replaced by 0, as in makeLinearModel()
+    numReturn=concatenate(([0],cumsum(EnumTo,dtype=int64)))
+    EfracReturn=(numReturn[Eindptr[1:]]-numReturn[Eindptr[:-1]])/Enxny.numLaunched[:]
+    EfracReturn[isnan(EfracReturn)]=0.0
+
+    if returnCSR:
+        return EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat
+
+    #otherwise, split the flat arrays back into one array per habitat point
+    EwhereTo,EnumTo,Ecumsum=[unpackCSR(Eindptr,a) for a in (EwhereTo,EnumTo,Ecumsum)]
+    return EwhereTo,EnumTo,EfracReturn,Ecumsum,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat
+
+#===============================================================================================
+#A persistent cache of the linear model. Every script that runs the
+#model starts by compiling the same connectivity matrix into the linear
+#space, which for a large habitat takes a long time. The compiled
+#model is written into its own directory in linearModelCacheDir as one
+#.npy file per array, along with a meta.json file that records where
+#it came from. Later calls memory map the arrays, which takes
+#milliseconds, and the arrays are shared between processes through the
+#operating system's page cache.
+#
+#The cache is keyed by the path, size, modification time and content
+#hash of the connectivity matrix. If the size and modification time
+#have not changed the cache is used directly; if they have, the
+#content is hashed, and the cache is only rebuilt if the content has
+#changed. The longitude and latitude of each point come from maskFile,
+#so the cache is also keyed by its path, size and modification time,
+#and is rebuilt if any of them change. The cache is also rebuilt if
+#linearModelCacheVersion, which should be increased whenever what is
+#cached changes, does not match. If anything goes wrong, the whole
+#linearModelCacheDir can be deleted.
+linearModelCacheDir='linearModelCache'
+linearModelCacheVersion=2
+
+#these are the arrays saved in the cache
+linearModelCacheArrays=['EwhereTo','EnumTo','EfracReturn','Ecumsum','Eindptr',
+                        'nxVec','nyVec','sortIndx','nxnyArray','lonLatArray']
+
+def sourceFileList(EfileName):
+    '''sourceFileList(EfileName): return a sorted list of all the files
+    that make up EfileName, which can be a single file (e.g. a zip
+    store) or a directory (e.g. a zarr directory store)'''
+    if not os.path.isdir(EfileName):
+        return [EfileName]
+    fileList=[]
+    for root,dirs,files in os.walk(EfileName):
+        fileList=fileList+[os.path.join(root,f) for f in files]
+    return sorted(fileList)
+
+def sourceSizeAndTime(EfileName):
+    '''sourceSizeAndTime(EfileName): return the total size and the
+    latest modification time of the files that make up EfileName'''
+    stats=[os.stat(f) for f in sourceFileList(EfileName)]
+    return int(sum([s.st_size for s in stats])),float(amax([s.st_mtime for s in stats]))
+
+def sourceContentHash(EfileName):
+    '''sourceContentHash(EfileName): return the sha1 hash of the names
+    and contents of the files that make up EfileName'''
+    theHash=hashlib.sha1()
+    for f in sourceFileList(EfileName):
+        theHash.update(os.path.relpath(f,EfileName).encode())
+        with open(f,'rb') as fid:
+            for block in iter(lambda: fid.read(2**20),b''):
+                theHash.update(block)
+    return theHash.hexdigest()
+
+def linearModelCacheName(EfileName):
+    '''linearModelCacheName(EfileName): the directory in which the
+    linear model for EfileName, with the coordinates from maskFile, is
+    cached'''
+    absName=os.path.abspath(EfileName)
+    key=absName+'\n'+os.path.abspath(maskFile)
+    return os.path.join(linearModelCacheDir,os.path.basename(absName.rstrip(os.sep))
+                        +'_'+hashlib.sha1(key.encode()).hexdigest()[:12])
+
+def maskFileMeta():
+    '''maskFileMeta(): the path, size and modification time of
+    maskFile, as recorded in the meta.json of the cache'''
+    size,mtime=sourceSizeAndTime(maskFile)
+    return {'mask':os.path.abspath(maskFile),'maskSize':size,'maskMtime':mtime}
+
+def isLinearModelCacheGood(EfileName):
+    '''isLinearModelCacheGood(EfileName): returns True if there is an
+    up to date cached linear model for EfileName. If only the size or
+    modification time of EfileName have changed, but not its contents,
+    the record of them in the cache is updated.'''
+    metaFile=os.path.join(linearModelCacheName(EfileName),'meta.json')
+    if not os.path.exists(metaFile):
+        return False
+    with open(metaFile) as fid:
+        meta=json.load(fid)
+    if meta['version']!=linearModelCacheVersion or meta['source']!=os.path.abspath(EfileName):
+        return False
+
+    #has maskFile, from which the coordinates come, been changed?
+    for key,value in maskFileMeta().items():
+        if meta[key]!=value:
+            return False
+
+    #quick check; has the file been changed?
+    size,mtime=sourceSizeAndTime(EfileName)
+    if (meta['size']==size) and (meta['mtime']==mtime):
+        return True
+
+    #slow check; the file has been touched, but has its content changed?
+    if meta['sha1']!=sourceContentHash(EfileName):
+        return False
+    meta['size']=size; meta['mtime']=mtime
+    with open(metaFile,'w') as fid:
+        json.dump(meta,fid)
+    return True
+
+def writeLinearModelCache(EfileName):
+    '''writeLinearModelCache(EfileName): compile the linear model for
+    EfileName with makeLinearModel_arrays() and write it to the cache.
+    The cache is written into a temporary directory which is then
+    renamed, so a partly written cache is never used, and several
+    processes can try to build it at once.'''
+    size,mtime=sourceSizeAndTime(EfileName)
+    meta={'version':linearModelCacheVersion,'source':os.path.abspath(EfileName),
+          'size':size,'mtime':mtime,'sha1':sourceContentHash(EfileName)}
+    meta.update(maskFileMeta())
+
+    EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,\
+        nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=makeLinearModel_arrays(EfileName,returnCSR=True)
+    toSave={'EwhereTo':EwhereTo,'EnumTo':EnumTo,'EfracReturn':EfracReturn,'Ecumsum':Ecumsum,
+            'Eindptr':Eindptr,'nxVec':nxny2nlin.nxVec,'nyVec':nxny2nlin.nyVec,
+            'sortIndx':nxny2nlin.sortIndx,'nxnyArray':nlin2nxny.valueArray,
+            'lonLatArray':nlin2lonLat.valueArray}
+
+    cacheName=linearModelCacheName(EfileName)
+    tempName=cacheName+'_tmp%d'%(os.getpid(),)
+    os.makedirs(tempName)
+    for name in linearModelCacheArrays:
+        save(os.path.join(tempName,name+'.npy'),toSave[name])
+    with open(os.path.join(tempName,'meta.json'),'w') as fid:
+        json.dump(meta,fid)
+
+    #now replace any old cache with the new one
+    if os.path.exists(cacheName):
+        shutil.rmtree(cacheName,ignore_errors=True)
+    try:
+        os.rename(tempName,cacheName)
+    except OSError:
+        #another process got there first
+        shutil.rmtree(tempName,ignore_errors=True)
+    return None
+
+#This function returns the same thing as makeLinearModel_arrays(), but
+#reads the compiled linear model from the cache, building the cache
+#first if it does not exist or is out of date. The arrays are memory
+#mapped read only. Call it through makeLinearModel(EfileName,useDicts=False,useCache=True)
+def makeLinearModel_cached(EfileName,returnCSR=False):
+
+    if not isLinearModelCacheGood(EfileName):
+        print('   compiling linear model for',EfileName,'into cache',linearModelCacheName(EfileName),flush=True)
+        writeLinearModelCache(EfileName)
+
+    cacheName=linearModelCacheName(EfileName)
+    A={name:load(os.path.join(cacheName,name+'.npy'),mmap_mode='r') for name in linearModelCacheArrays}
+
+    nxny2nlin=nxnyMap(A['nxVec'],A['nyVec'],sortIndx=A['sortIndx'])
+    nlin2nxny=nlinMap(A['nxnyArray'])
+    nxny2lonLat=nxnyMap(A['nxVec'],A['nyVec'],A['lonLatArray'],sortIndx=A['sortIndx'])
+    nlin2lonLat=nlinMap(A['lonLatArray'])
+
+    EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr=[A[name] for name in
+                                                ['EwhereTo','EnumTo','EfracReturn','Ecumsum','Eindptr']]
+    if returnCSR:
+        return EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat
+
+    EwhereTo,EnumTo,Ecumsum=[unpackCSR(Eindptr,a) for a in (EwhereTo,EnumTo,Ecumsum)]
+    return EwhereTo,EnumTo,EfracReturn,Ecumsum,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat
+
+#===============================================================================================
+#Share the flat (compressed sparse row) arrays of the linear model
+#between processes. The arrays are copied once into
+#multiprocessing.shared_memory blocks, and worker processes attach to
+#them by name, in the same way as the P and whereSettle arrays of the
+#models are shared. Since the arrays are flat numeric arrays and not
+#object arrays, there are no python reference counts in them to be
+#updated, so only one copy exists no matter how many workers there are.
+
+def makeSharedArrays(arrayDict):
+    '''makeSharedArrays(arrayDict): arrayDict is a dictionary of numpy
+    arrays. Copy each into a new shared memory block.
+
+    returns shmList,sharedSpec,sharedDict where shmList is a list of
+    the SharedMemory objects (keep a reference to them, and close() and
+    unlink() them when done), sharedSpec is a small, picklable
+    dictionary that attachSharedArrays() uses to find the arrays in
+    another process, and sharedDict is a dictionary of the arrays in
+    shared memory.
+    '''
+    shmList=[]; sharedSpec={}; sharedDict={}
+    for name in arrayDict:
+        theArray=asarray(arrayDict[name])
+        shm=shared_memory.SharedMemory(create=True,size=max(theArray.nbytes,1))
+        sharedArray=ndarray(theArray.shape,dtype=theArray.dtype,buffer=shm.buf)
+        sharedArray[...]=theArray
+        shmList.append(shm)
+        sharedSpec[name]=(shm.name,theArray.shape,theArray.dtype.str)
+        sharedDict[name]=sharedArray
+    return shmList,sharedSpec,sharedDict
+
+def attachSharedArrays(sharedSpec):
+    '''attachSharedArrays(sharedSpec): attach to the shared memory arrays
+    described by sharedSpec, as returned by makeSharedArrays().
+
+    returns shmList,sharedDict, where shmList is a list of the
+    SharedMemory objects (keep a reference to them as long as the
+    arrays are used) and sharedDict is a dictionary of the arrays.
+    '''
+    shmList=[]; sharedDict={}
+    for name in sharedSpec:
+        shmName,theShape,theDtype=sharedSpec[name]
+        shm=shared_memory.SharedMemory(name=shmName)
+        shmList.append(shm)
+        sharedDict[name]=ndarray(theShape,dtype=theDtype,buffer=shm.buf)
+    return shmList,sharedDict
+
+#===============================================================================================
 #This function returns the linear space module and other useful mappings
 #when given the file name of a connectivity matrix as made by 00_makeTransposeMatrices.py
-def makeLinearModel(EfileName):
+#
+#If returnCSR is True, then EwhereTo, EnumTo and Ecumsum are returned
+#as flat arrays in compressed sparse row form (see packCSR() above),
+#and the array of row offsets Eindptr is returned immediately after
+#Ecumsum, so the return values are
+#   EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat
+#and the destinations of habitat point n are EwhereTo[Eindptr[n]:Eindptr[n+1]]
+#
+#If useDicts is False, the model is built by makeLinearModel_arrays()
+#above, which is much faster, and the four maps are returned as array
+#backed nxnyMap and nlinMap objects instead of dictionaries.
+#
+#If useCache is also True, the compiled model is read from (and if
+#need be, written to) the cache in linearModelCacheDir by
+#makeLinearModel_cached() above.
+def makeLinearModel(EfileName,returnCSR=False,useDicts=True,useCache=False):
+
+    #the fast paths
+    if useCache:
+        assert not useDicts,'the linear model cache can only be used with useDicts=False'
+        return makeLinearModel_cached(EfileName,returnCSR=returnCSR)
+    if not useDicts:
+        return makeLinearModel_arrays(EfileName,returnCSR=returnCSR)
 
     # what transpose file is going to give connectivity to the model?
     # It is called Enxny to make clear it is in nx,ny model grid space
@@ -97,6 +568,11 @@ def makeLinearModel(EfileName):
         EnumTo[n]=numTo[n]
         Ecumsum[n]=cumsum(numTo[n])/sum(numTo[n])
 
+    #if asked for, pack into compressed sparse row form
+    if returnCSR:
+        Eindptr,EwhereTo,EnumTo,Ecumsum=packCSR(EwhereTo,EnumTo)
+        return EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat
+
     #now return what we have created
     return EwhereTo,EnumTo,EfracReturn,Ecumsum,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat
 
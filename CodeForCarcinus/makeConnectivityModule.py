@@ -10,11 +10,20 @@ import numcodecs
 import os
 import netCDF4 as nc
 import sklearn.neighbors as skn
+import scipy.ndimage as ndimage
+import functools
 import pandas as pd
 import shutil
 import copy
-from shapely.geometry import Point,MultiPoint
+import glob
+import tempfile
+from multiprocessing.pool import ThreadPool
+from shapely.geometry import Point,MultiPoint,MultiPolygon
 from shapely.geometry.polygon import Polygon
+try:
+    from shapely import contains_xy
+except ImportError: #shapely before version 2
+    contains_xy=None
 import getEZfateFromOSN
 
 
@@ -74,6 +83,130 @@ def int2grid(points):
 #    -depth of water of each point getDepthDict()
 #    -distance from shore of each point in kilometers getDistanceDict()
 #    -distance from shore of each point in grid spacing getGridDistanceDict()
+#
+# These are answered from 2d arrays over the whole model grid, indexed
+# [ny,nx], made by gridGeometry(). Each array is computed once, from
+# the mask file, and saved next to it, so it is read from disk the
+# next time it is needed, and kept in memory once read. The arrays
+# can be passed straight to trimConnectivity() in place of the
+# dictionaries.
+#
+#    'depth': the depth of the water, nan where it is masked
+#    'coastMask': True at a coast point, a land point (depth<landThresh)
+#                 next to a point which is not land
+#    'gridDistance': the distance to the nearest coast point, in grid spacings
+#    'kmDistance': the distance to the nearest coast point, in kilometers
+#
+# the coast and distances depend on landThresh, and are kept separately
+# for each value of it.
+
+#the arrays made by gridGeometry(), keyed by (name,landThresh)
+gridGeometryCache={}
+
+def gridGeometryFileName(name,landThresh):
+    '''gridGeometryFileName(name,landThresh): the file the array name
+    of gridGeometry() is saved in'''
+    if name=='depth':
+        return os.path.splitext(maskFile)[0]+'_depth.npy'
+    return os.path.splitext(maskFile)[0]+'_%s_landThresh%g.npy'%(name,landThresh)
+
+def makeCoastMask(depth,landThresh):
+    '''makeCoastMask(depth,landThresh): the coast points of the 2d array
+    depth; see gridGeometry()'''
+    print('Assuming land is depth<',landThresh)
+    landGrid=depth<landThresh
+    coastGrid=logical_and(False,landGrid) #start coast as all false
+    coastGrid[1:-1,1:-1]=logical_and(landGrid[1:-1,1:-1], #coast is a point that is land next to a point that is water
+                                     logical_not(functools.reduce(logical_and,(landGrid[:-2,2:],
+                                                                               landGrid[1:-1,2:],
+                                                                               landGrid[2:,2:],
+                                                                               landGrid[:-2,1:-1],
+                                                                               landGrid[2:,1:-1],
+                                                                               landGrid[:-2,:-2],
+                                                                               landGrid[1:-1,:-2],
+                                                                               landGrid[2:,:-2]
+                                     ))))
+    return coastGrid
+
+def makeKmDistance(coastGrid,nav_lon,nav_lat,nThread=None):
+    '''makeKmDistance(coastGrid,nav_lon,nav_lat,nThread=None): the
+    distance in km from every grid point to the nearest coast point
+    along the surface of the earth. The BallTree of the coast points is
+    made once, and the grid is queried a block of rows at a time by
+    nThread threads (os.cpu_count() if None).'''
+    coastPoints=zeros((sum(coastGrid),2))
+    coastPoints[:,1]=nav_lon[coastGrid]
+    coastPoints[:,0]=nav_lat[coastGrid]
+    print('making coast point tree')
+    coastTree=skn.BallTree(radians(coastPoints),metric='haversine')
+    print('   done with tree')
+
+    Re=6371.0 #in km
+    kmDistance=empty(nav_lon.shape,dtype=float64)
+    def queryRows(rowSlice):
+        allPointsLatLon=stack((nav_lat[rowSlice].ravel(),nav_lon[rowSlice].ravel()),axis=1)
+        isFinite=isfinite(allPointsLatLon).all(axis=1) #masked points have no distance
+        dist=full((len(allPointsLatLon),),nan)
+        if isFinite.any():
+            dist[isFinite]=coastTree.query(radians(allPointsLatLon[isFinite]),k=1,return_distance=True)[0][:,0]
+        kmDistance[rowSlice]=Re*dist.reshape(nav_lon[rowSlice].shape)
+        return None
+    rowBlock=max(1,100000//nav_lon.shape[1])
+    with ThreadPool(nThread) as pool:
+        pool.map(queryRows,[slice(n,n+rowBlock) for n in range(0,nav_lon.shape[0],rowBlock)])
+    return kmDistance
+
+def gridGeometry(name,landThresh=2.1):
+    '''gridGeometry(name,landThresh=2.1): returns the 2d array, indexed
+    [ny,nx], of name, which is one of 'depth', 'coastMask',
+    'gridDistance' or 'kmDistance', as described above. Land is
+    defined as any depth less than landThresh, which defaults to 2.1
+    as appropriate for the Mercator 1/12th global run. It is made the
+    first time it is asked for and saved, and then loaded from disk.
+    '''
+    if name=='depth':
+        landThresh=None
+    theKey=(name,landThresh)
+    if theKey in gridGeometryCache:
+        return gridGeometryCache[theKey]
+
+    #load it from disk, unless the mask file is newer
+    fileName=gridGeometryFileName(name,landThresh)
+    if os.path.exists(fileName) and (os.path.getmtime(fileName)>=os.path.getmtime(maskFile)):
+        gridGeometryCache[theKey]=load(fileName)
+        return gridGeometryCache[theKey]
+
+    print('making',name,'of the model grid, and saving it to',fileName)
+    if name=='depth':
+        with nc.Dataset(maskFile,'r') as gridData:
+            theGrid=ma.filled(ma.asarray(gridData['hdepw'][0,:,:],dtype=float64),nan)
+    elif name=='coastMask':
+        theGrid=makeCoastMask(gridGeometry('depth'),landThresh)
+    elif name=='gridDistance':
+        #the exact euclidean distance transform gives, at every point,
+        #the distance in grid spacings to the nearest coast point
+        theGrid=ndimage.distance_transform_edt(logical_not(gridGeometry('coastMask',landThresh)))
+    elif name=='kmDistance':
+        with nc.Dataset(maskFile,'r') as gridData:
+            nav_lon=ma.filled(ma.asarray(gridData['nav_lon'][:],dtype=float64),nan)
+            nav_lat=ma.filled(ma.asarray(gridData['nav_lat'][:],dtype=float64),nan)
+        theGrid=makeKmDistance(gridGeometry('coastMask',landThresh),nav_lon,nav_lat)
+    else:
+        assert False,'Error, unknown grid geometry '+name
+
+    #write to a temporary file, and rename, so the file is always complete
+    with open(fileName+'.tmp','wb') as fid:
+        save(fid,theGrid)
+    os.replace(fileName+'.tmp',fileName)
+    gridGeometryCache[theKey]=theGrid
+    return theGrid
+
+def gridGeometryDict(name,nxVec,nyVec,landThresh=2.1):
+    '''gridGeometryDict(name,nxVec,nyVec,landThresh=2.1): a dictionary
+    which maps from (nx,ny), for the points in nxVec and nyVec, to the
+    value of gridGeometry(name,landThresh) at that point'''
+    values=gridGeometry(name,landThresh)[asarray(nyVec),asarray(nxVec)]
+    return dict(zip(zip(nxVec,nyVec),values))
 
 def getDepthDict(nxVec,nyVec):
     '''
@@ -82,10 +215,7 @@ def getDepthDict(nxVec,nyVec):
     #a dictionary that maps from (nx,ny) to the depth at that grid
     #point
     '''
-    gridData=nc.Dataset(maskFile)
-    depth=gridData['hdepw'][0,:,:]
-    depthDict={(p[0],p[1]):depth[p[1],p[0]] for p in zip(nxVec,nyVec) }
-    return depthDict
+    return gridGeometryDict('depth',nxVec,nyVec)
 
 def getDistanceDict(nxVec,nyVec,landThresh=2.1):
     '''getDistanceDict(nxVec,nyVec): this code takes a vector grid indices
@@ -95,41 +225,7 @@ def getDistanceDict(nxVec,nyVec,landThresh=2.1):
     Mercator 1/12th global run
 
     '''
-    gridData=nc.Dataset(maskFile)
-    depth=gridData['hdepw'][0,:,:]
-    nav_lon=gridData['nav_lon'][:]
-    nav_lat=gridData['nav_lat'][:]
-
-    #now make coast grid
-    #landThresh=2.1
-    print('Assuming land is depth<',landThresh)
-    landGrid=depth<landThresh
-    coastGrid=logical_and(False,landGrid) #start coast as all false
-    coastGrid[1:-1,1:-1]=logical_and(landGrid[1:-1,1:-1], #coast is a point that is land next to a point that is water
-                                     logical_not(functools.reduce(logical_and,(landGrid[:-2,2:],
-                                                                               landGrid[1:-1,2:],
-                                                                               landGrid[2:,2:],
-                                                                               landGrid[:-2,1:-1],
-                                                                               landGrid[2:,1:-1],
-                                                                               landGrid[:-2,:-2],
-                                                                               landGrid[1:-1,:-2],
-                                                                               landGrid[2:,:-2]
-                                     ))))
-
-    coastLon=nav_lon[coastGrid]
-    coastLat=nav_lat[coastGrid]
-    coastPoints=zeros((len(coastLon),2))
-    coastPoints[:,1]=coastLon
-    coastPoints[:,0]=coastLat
-    print('making coast point tree')
-    coastTree=skn.BallTree(radians(coastPoints),metric='haversine')
-    allPointsLatLon=array([(nav_lat[p[0],p[1]],nav_lon[p[0],p[1]]) for p in zip(nyVec,nxVec)])
-    dist,jnk=coastTree.query(radians(allPointsLatLon),k=1,return_distance=True)
-    Re=6371.0 #in km
-    dist=Re*dist
-    distanceDict={(p[0],p[1]):p[2][0] for p in zip(nxVec,nyVec,dist) }
-    
-    return distanceDict
+    return gridGeometryDict('kmDistance',nxVec,nyVec,landThresh)
 
 def getGridDistanceDict(nxVec,nyVec,landThresh=2.1):
     '''getGridDistanceDict(nxVec,nyVec): this code takes a vector of grid
@@ -139,40 +235,7 @@ def getGridDistanceDict(nxVec,nyVec,landThresh=2.1):
     appropriate for the Mercator 1/12th global run
 
     '''
-    gridData=nc.Dataset(maskFile)
-    depth=gridData['hdepw'][0,:,:]
-
-    nav_nx,nav_ny=meshgrid(arange(depth.shape[1]),arange(depth.shape[0]))
-
-    #now make coast grid
-    #landThresh=2.1
-    print('Assuming land is depth<',landThresh)
-    landGrid=depth<landThresh
-    coastGrid=logical_and(False,landGrid) #start coast as all false
-    coastGrid[1:-1,1:-1]=logical_and(landGrid[1:-1,1:-1], #coast is a point that is land next to a point that is water
-                                     logical_not(functools.reduce(logical_and,(landGrid[:-2,2:],
-                                                                               landGrid[1:-1,2:],
-                                                                               landGrid[2:,2:],
-                                                                               landGrid[:-2,1:-1],
-                                                                               landGrid[2:,1:-1],
-                                                                               landGrid[:-2,:-2],
-                                                                               landGrid[1:-1,:-2],
-                                                                               landGrid[2:,:-2]
-                                     ))))
-
-    coastNx=nav_nx[coastGrid]
-    coastNy=nav_ny[coastGrid]
-    coastPoints=zeros((len(coastNx),2))
-    coastPoints[:,1]=coastNx
-    coastPoints[:,0]=coastNy
-    print('making coast point tree')
-    coastTree=skn.BallTree(coastPoints)
-    print('   done with tree')
-    allPointsNyNx=array([(nav_ny[p[0],p[1]],nav_nx[p[0],p[1]]) for p in zip(nyVec,nxVec)])
-    dist,jnk=coastTree.query(allPointsNyNx,k=1,return_distance=True)
-    gridDistanceDict={(p[0],p[1]):p[2][0] for p in zip(nxVec,nyVec,dist) }
-    
-    return gridDistanceDict
+    return gridGeometryDict('gridDistance',nxVec,nyVec,landThresh)
 
 
 
@@ -463,53 +526,70 @@ def isGood(theDict,theMin,theMax,thePoint):
     #note that this works because of how python short-circuits evaluation of 'if'
     return (thePoint in theDict) and (theMin<=theDict[thePoint]) and (theDict[thePoint]<=theMax)
 
-#@profile
-def trimConnectivity(connectivityIn,theDict,theMin,theMax,loadConnectToMem=True,keepAllTo=False):
-    '''trimConnectivity(connectivityIn,theDict,theMin,theMax) takes as input
-
-    connectivityIn, an open zarr file that specifies the connectivity
-    matrix, as created by makeConnectFromFile()
-
-    theDict, a dictionary with key (nx,ny) that returns a number as a
-    value (e.g. as from depthDict(), where the dictionary returns the
-    depth at the location (nx,ny).
-
-    theMin and the theMax: each starting and ending point in
-    connectivityIn (defined by their (nx,ny)) is only included in the
-    new connectivity matrix if (nx,ny) is in theDict AND
-    theMin<=theDict(nx,ny)<=theMax
-
-    loadConnectToMem=True: If this is true, load connectivity into
-    memory -- much faster, but much more memory. If false, work on disk, slower but no memory ussage.
-
-    keepAllTo=False: if False, also trim *To points that are meet the triming criteria. if True, don't
-    remove *To points
+def makeIsGood(theDict,theMin,theMax):
+    '''isGoodVec=makeIsGood(theDict,theMin,theMax)
 
-    returns connectivityOut, an in memory zarr file that is the
-    reduced connectivity matrix that satisfies the criterion above.
+    returns isGoodVec(nxVec,nyVec), which does what isGood() does, but
+    for the arrays of points nxVec,nyVec at once, and returns a boolean
+    array which is True where (nx,ny) is good.
 
+    theDict is either a dictionary with key (nx,ny), as for isGood(),
+    or a 2d array (which may be masked) of the value at every point of
+    the model grid, indexed [ny,nx], such as the depth of the water.
+    A masked value, or a point outside of the array, is not good.
     '''
+    if isinstance(theDict,dict):
+        #make a sorted array of the grid2int() keys of the good points,
+        #and look up all the points in it at once
+        keys=array(list(theDict.keys()),dtype=int64).reshape((-1,2))
+        values=array([nan if v is ma.masked else v for v in theDict.values()],dtype=float64)
+        goodKeys=sort(grid2int(keys[:,0],keys[:,1])[logical_and(theMin<=values,values<=theMax)])
+        def isGoodVec(nxVec,nyVec):
+            return isin(grid2int(asarray(nxVec),asarray(nyVec)),goodKeys)
+        return isGoodVec
+
+    #or make a mask of the good points of the grid, and index it
+    theGrid=ma.filled(ma.asarray(theDict,dtype=float64),nan)
+    goodMask=logical_and(theMin<=theGrid,theGrid<=theMax)
+    def isGoodVec(nxVec,nyVec):
+        nxVec=asarray(nxVec); nyVec=asarray(nyVec)
+        isIn=logical_and(nxVec<goodMask.shape[1],nyVec<goodMask.shape[0])
+        isGoodOut=zeros(nxVec.shape,dtype=bool)
+        isGoodOut[isIn]=goodMask[nyVec[isIn],nxVec[isIn]]
+        return isGoodOut
+    return isGoodVec
+
+def trimConnectivityByMask(connectivityIn,keepFrom,isGoodTo,loadConnectToMem=True,keepAllTo=False):
+    '''trimConnectivityByMask(connectivityIn,keepFrom,isGoodTo,loadConnectToMem=True,keepAllTo=False)
+
+    the array version of the trimming in trimConnectivity() and
+    trimConnectivity_byPoly(). Keep the rows of connectivityIn where
+    the boolean array keepFrom is True, and, unless keepAllTo is True,
+    only the destinations (nxTo,nyTo) in them for which
+    isGoodTo(nxTo,nyTo) is True; isGoodTo takes and returns arrays.
+
+    The destinations are filtered as flat arrays, rather than row by
+    row. If loadConnectToMem is False, the rows are read and filtered
+    a chunk of connectivityIn at a time, to use less memory.
+
+    returns connectivityOut, an in memory zarr file, laid out as the
+    output of trimConnectivity()
+    '''
+    keepFrom=asarray(keepFrom,dtype=bool)
+    nOut=int(sum(keepFrom))
 
-    #first, make in-memory connectivityOut zarr data store and fill
-    #with appropriate (nxFrom,nyFrom)
-    nxFromIn=connectivityIn['nxFrom'][:]
-    nyFromIn=connectivityIn['nyFrom'][:]
-
-    toKeep=[isGood(theDict,theMin,theMax,p) for p in zip(nxFromIn,nyFromIn)]
-
-    #make output as an in-memory zarr
-    nOut=sum(toKeep)
-
-    #create zarr dataset
-    chunkSize=int(1e6) #should experiment with this
+    #create zarr dataset; a chunk is no bigger than the output, since
+    #a mostly empty chunk of ragged arrays is slow to write
+    chunkSize=max(1,min(int(1e6),nOut)) #should experiment with this
     store=zarr.MemoryStore()
     root=zarr.group(store=store)
-    
+
     nxFrom=root.empty(shape=(nOut,),name='nxFrom',dtype=coordType,chunks=chunkSize)
     nyFrom=root.empty(shape=(nOut,),name='nyFrom',dtype=coordType,chunks=chunkSize)
     if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases everything
         print('   adding numLaunched variable')
         numLaunched=root.empty(shape=(nOut,),name='numLaunched',dtype='i',chunks=chunkSize)
+        numLaunched[:]=connectivityIn['numLaunched'][:][keepFrom]
 
     nxTo=root.empty(shape=(nOut,),name='nxTo',dtype=object,chunks=chunkSize,
                     object_codec=numcodecs.VLenArray(coordType))
@@ -519,64 +599,75 @@ def trimConnectivity(connectivityIn,theDict,theMin,theMax,loadConnectToMem=True,
                      object_codec=numcodecs.VLenArray(typeOfSum))
 
     #write out nxFrom,nyFrom
-    nxFrom[:]=nxFromIn[toKeep]
-    nyFrom[:]=nyFromIn[toKeep]
-    if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases things
-        print('  adding numLaunched data')
-        numLaunchedIn=connectivityIn['numLaunched'][:] #again, zarr lowercases things? or not? or macOS
-        numLaunched[:]=numLaunchedIn[toKeep] 
-
-    #now we need to update nxTo,nyTo and numTo
-    print('starting to fill lists')
+    nxFrom[:]=connectivityIn['nxFrom'][:][keepFrom]
+    nyFrom[:]=connectivityIn['nyFrom'][:][keepFrom]
+
+    #now filter nxTo,nyTo and numTo, all at once, or a chunk at a time
     tic=time.time()
-    sourceIndx=arange(len(nxFromIn))[toKeep]
-    nxToNew=empty((nOut,),dtype=object)
-    nyToNew=empty((nOut,),dtype=object)
-    numToNew=empty((nOut,),dtype=object)
-
-    #if we can fit the connectivity array in memory, it should be much
-    #faster... if we can't, just leave as link to zarr array
-    if not loadConnectToMem:
-        #slow, low memory usage
-        print('In trimConnectivity, using slow, low memory ussage path')
-        nxToIn=connectivityIn['nxTo']
-        nyToIn=connectivityIn['nyTo']
-        numToIn=connectivityIn['numTo']
+    nRow=len(keepFrom)
+    if loadConnectToMem:
+        readChunk=max(1,nRow)
     else:
-        #fast, high memory usage
-        print('In trimConnectivity, Loading connectivity matrix into memory; if fails, make loadConnectToMem=False')
-        nxToIn=connectivityIn['nxTo'][:]
-        nyToIn=connectivityIn['nyTo'][:]
-        numToIn=connectivityIn['numTo'][:]
-        print('   done loading into memory')
-
-    #breakpoint()
-    
-    for n in range(nOut):
-        nIn=sourceIndx[n]
-        nxToOld=nxToIn[nIn]
-        nyToOld=nyToIn[nIn]
-        numToOld=numToIn[nIn]
-        if keepAllTo:
-            nxToNew[n]=nxToOld
-            nyToNew[n]=nyToOld
-            numToNew[n]=numToOld
-        else:
-            toKeep=[isGood(theDict,theMin,theMax,p) for p in zip(nxToOld,nyToOld)]
-            nxToNew[n]=nxToOld[toKeep]
-            nyToNew[n]=nyToOld[toKeep]
-            numToNew[n]=numToOld[toKeep]
-    print('done filling lists in ',time.time()-tic)
-    nxTo[:]=nxToNew 
-    nyTo[:]=nyToNew
-    numTo[:]=numToNew
+        print('In trimConnectivityByMask, reading the connectivity a chunk at a time')
+        readChunk=max(1,connectivityIn['nxFrom'].chunks[0])
+    startOut=0
+    for startRow in range(0,nRow,readChunk):
+        endRow=min(nRow,startRow+readChunk)
+        keepRow=keepFrom[startRow:endRow]
+        nKeep=int(sum(keepRow))
+        if nKeep==0:
+            continue
+        nxToIn,rowLength=raggedToFlat(connectivityIn['nxTo'][startRow:endRow][keepRow],coordType)
+        nyToIn,jnk=raggedToFlat(connectivityIn['nyTo'][startRow:endRow][keepRow],coordType)
+        numToIn,jnk=raggedToFlat(connectivityIn['numTo'][startRow:endRow][keepRow],typeOfSum)
+        if not keepAllTo:
+            toKeep=isGoodTo(nxToIn,nyToIn)
+            rowOfEntry=repeat(arange(nKeep),rowLength)
+            rowLength=bincount(rowOfEntry[toKeep],minlength=nKeep)
+            nxToIn=nxToIn[toKeep]; nyToIn=nyToIn[toKeep]; numToIn=numToIn[toKeep]
+        nxTo[startOut:startOut+nKeep]=flatToRagged(nxToIn,rowLength)
+        nyTo[startOut:startOut+nKeep]=flatToRagged(nyToIn,rowLength)
+        numTo[startOut:startOut+nKeep]=flatToRagged(numToIn,rowLength)
+        startOut=startOut+nKeep
     print('done with To',time.time()-tic,'cummalative')
 
     #pass the numberOfStartingTimes info through to the output
     root.attrs['numberOfStartingTimes']=connectivityIn.attrs['numberOfStartingTimes']
-    
+
     return root
 
+def trimConnectivity(connectivityIn,theDict,theMin,theMax,loadConnectToMem=True,keepAllTo=False):
+    '''trimConnectivity(connectivityIn,theDict,theMin,theMax,loadConnectToMem=True,keepAllTo=False) takes as input
+
+    connectivityIn, an open zarr file that specifies the connectivity
+    matrix, as created by makeConnectFromFile()
+
+    theDict, a dictionary with key (nx,ny) that returns a number as a
+    value (e.g. as from depthDict(), where the dictionary returns the
+    depth at the location (nx,ny). It can also be a 2d array of the
+    value at every point of the model grid, indexed [ny,nx]; see
+    makeIsGood()
+
+    theMin and the theMax: each starting and ending point in
+    connectivityIn (defined by their (nx,ny)) is only included in the
+    new connectivity matrix if (nx,ny) is in theDict AND
+    theMin<=theDict(nx,ny)<=theMax
+
+    loadConnectToMem=True: If this is true, load connectivity into
+    memory -- much faster, but much more memory. If false, work a chunk at a time, slower but less memory ussage.
+
+    keepAllTo=False: if False, also trim *To points that are meet the triming criteria. if True, don't
+    remove *To points
+
+    returns connectivityOut, an in memory zarr file that is the
+    reduced connectivity matrix that satisfies the criterion above.
+
+    '''
+    isGoodVec=makeIsGood(theDict,theMin,theMax)
+    keepFrom=isGoodVec(connectivityIn['nxFrom'][:],connectivityIn['nyFrom'][:])
+    return trimConnectivityByMask(connectivityIn,keepFrom,isGoodVec,loadConnectToMem=loadConnectToMem,
+                                  keepAllTo=keepAllTo)
+
 #===============================================================================================
 # cull from connectivity matrices points that start or stop at
 # locations that are inside or outside of some polygon
@@ -586,164 +677,110 @@ def trimConnectivity(connectivityIn,theDict,theMin,theMax,loadConnectToMem=True,
 #     #note that this works because of how python short-circuits evaluation of 'if'
 #     return (thePoint in theDict) and theDict[thePoint]
 
-#@profile
-#print('TURNIPS!, TURNIPS')
+# The points are tested against the polygon all at once, for the whole
+# of the model grid within the bounds of the polygon, and the
+# resulting mask of the grid is kept in polygonMaskCache, so trimming
+# by the same polygon again does not test any points.
+
+#the masks made by polygonGridMask(), keyed by the polygon
+polygonMaskCache={}
+
+def polygonGeometry(thePolygon):
+    '''regionShapely=polygonGeometry(thePolygon)
+
+    the shapely geometry of thePolygon, which is either a list of
+    (lon,lat) points that define a polygon, a list of such lists, for
+    a region made of several polygons, or a shapely geometry, which is
+    returned as it is.
+    '''
+    if hasattr(thePolygon,'geom_type'):
+        return thePolygon
+    if (len(thePolygon)>0) and (not isscalar(thePolygon[0][0])):
+        return MultiPolygon([Polygon(p) for p in thePolygon])
+    return Polygon(thePolygon)
+
+def polygonGridMask(thePolygon):
+    '''inPoly=polygonGridMask(thePolygon)
+
+    a boolean array the shape of the model grid, indexed [ny,nx],
+    which is True where the (nav_lon,nav_lat) of the grid point is
+    within thePolygon, as defined by polygonGeometry(). As for
+    shapely's within(), points on the edge of the polygon are not
+    within it. The mask is cached, so it is made once for each polygon.
+    '''
+    regionShapely=polygonGeometry(thePolygon)
+    theKey=regionShapely.wkb
+    if theKey not in polygonMaskCache:
+        with nc.Dataset(maskFile,'r') as gridData:
+            lonMat=ma.filled(ma.asarray(gridData['nav_lon'][:],dtype=float64),nan)
+            latMat=ma.filled(ma.asarray(gridData['nav_lat'][:],dtype=float64),nan)
+
+        #only test the points within the bounds of the polygon
+        lonMin,latMin,lonMax,latMax=regionShapely.bounds
+        inBox=logical_and(logical_and(lonMat>=lonMin,lonMat<=lonMax),
+                          logical_and(latMat>=latMin,latMat<=latMax))
+        inPoly=zeros(lonMat.shape,dtype=bool)
+        if contains_xy is not None:
+            inPoly[inBox]=contains_xy(regionShapely,lonMat[inBox],latMat[inBox])
+        else:
+            inPoly[inBox]=[Point(p).within(regionShapely) for p in zip(lonMat[inBox],latMat[inBox])]
+        polygonMaskCache[theKey]=inPoly
+    return polygonMaskCache[theKey]
+
 def trimConnectivity_byPoly(connectivityIn,thePolygon,keepInPoly=True,loadConnectToMem=True,keepAllTo=False):
-    '''trimConnectivity(connectivityIn,theDict,theMin,theMax) takes as input
+    '''trimConnectivity_byPoly(connectivityIn,thePolygon,keepInPoly=True,loadConnectToMem=True,keepAllTo=False) takes as input
 
     connectivityIn, an open zarr file that specifies the connectivity
     matrix, as created by makeConnectFromFile()
 
-    thePolygon, a list of (lon,lat) points that define a polygon.
+    thePolygon, a list of (lon,lat) points that define a polygon, or
+    a list of such lists, or a shapely geometry; see polygonGeometry()
 
     keepInPoly=True, if this is true, keep points in polygon, if false, keep points outside polygon
 
     loadConnectToMem=True: If this is true, load connectivity into
-    memory -- much faster, but much more memory. If false, work on disk, slower but no memory ussage.
+    memory -- much faster, but much more memory. If false, work a chunk at a time, slower but less memory ussage.
 
-    keepAllTo=False: if False, also trim *To points that are meet the triming criteria. if True, don't
-    remove *To points
+    keepAllTo=False: if False, only keep the *To points which are
+    also starting points that are kept. if True, don't remove *To points
 
     returns connectivityOut, an in memory zarr file that is the
     reduced connectivity matrix that satisfies the criterion above.
 
     '''
-
-    #first, make in-memory connectivityOut zarr data store and fill
-    #with appropriate (nxFrom,nyFrom)
     nxFromIn=connectivityIn['nxFrom'][:]
     nyFromIn=connectivityIn['nyFrom'][:]
+    keepFrom=polygonGridMask(thePolygon)[nyFromIn,nxFromIn]
 
-    #get latitude and longitude matrices, and make vectors of latFromIn and lonFromIn
-    with nc.Dataset(maskFile,'r') as gridData:
-        lonMat=gridData['nav_lon'][:]
-        latMat=gridData['nav_lat'][:]
-        lonHabVec=array([lonMat[p] for p in zip(nyFromIn,nxFromIn)])
-        latHabVec=array([latMat[p] for p in zip(nyFromIn,nxFromIn)])
-
-    #now make dictionary with key (nx,ny) and a boolean if in polygon
-    allPoints=MultiPoint([a for a in zip(lonHabVec,latHabVec)])
-    regionPolyShapely=Polygon(thePolygon)
-    toKeep=[p.within(regionPolyShapely) for p in allPoints.geoms] #there has to be a better way
-
-    #plot(*regionPolyShapely.exterior.xy)
-    #
-    # jnkx=[p.x for p in allPoints.geoms]
-    # jnky=[p.y for p in allPoints.geoms]
-    # plot(jnkx,jnky,'k*')
-        
-                        
     #if keepInPoly is false, then we want to keep the points outside
-    #of the polygon, so must reverse toKeep
+    #of the polygon, so must reverse keepFrom
     if not keepInPoly:
-        toKeep=logical_not(toKeep)
-
-    #make dictionary of points to keep with key (nx,ny)
-    toKeepDict={}
-    jnk=[(p,True) for p in zip(nxFromIn[toKeep],nyFromIn[toKeep])]
-    toKeepDict.update(jnk)
+        keepFrom=logical_not(keepFrom)
 
-    #make output as an in-memory zarr
-    nOut=sum(toKeep)
-
-    #create zarr dataset
-    chunkSize=int(1e6) #should experiment with this
-    store=zarr.MemoryStore()
-    root=zarr.group(store=store)
-
-    #print('   LOST IN TURNIPS'); breakpoint()
-    
-    nxFrom=root.empty(shape=(nOut,),name='nxFrom',dtype=coordType,chunks=chunkSize)
-    nyFrom=root.empty(shape=(nOut,),name='nyFrom',dtype=coordType,chunks=chunkSize)
-    if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases everything
-        print('   adding numLaunched variable')
-        numLaunched=root.empty(shape=(nOut,),name='numLaunched',dtype='i',chunks=chunkSize)
-
-    nxTo=root.empty(shape=(nOut,),name='nxTo',dtype=object,chunks=chunkSize,
-                    object_codec=numcodecs.VLenArray(coordType))
-    nyTo=root.empty(shape=(nOut,),name='nyTo',dtype=object,chunks=chunkSize,
-                    object_codec=numcodecs.VLenArray(coordType))
-    numTo=root.empty(shape=(nOut,),name='numTo',dtype=object,chunks=chunkSize,
-                     object_codec=numcodecs.VLenArray(typeOfSum))
-
-    #write out nxFrom,nyFrom
-    nxFrom[:]=nxFromIn[toKeep]
-    nyFrom[:]=nyFromIn[toKeep]
-    if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases things
-        print('  adding numLaunched data')
-        #is the case insensitivity of macOS screwing me up? Will this work on my laptop?
-        numLaunchedIn=connectivityIn['numLaunched'][:] #again, zarr lowercases things
-        numLaunched[:]=numLaunchedIn[toKeep] 
-
-
-    #now we need to update nxTo,nyTo and numTo
-    print('starting to fill lists')
-    tic=time.time()
-    sourceIndx=arange(len(nxFromIn))[toKeep]
-    nxToNew=empty((nOut,),dtype=object)
-    nyToNew=empty((nOut,),dtype=object)
-    numToNew=empty((nOut,),dtype=object)
-
-    #if we can fit the connectivity array in memory, it should be much
-    #faster... if we can't, just leave as link to zarr array
-    if not loadConnectToMem:
-        #slow, low memory usage
-        print('In trimConnectivity, using slow, low memory ussage path')
-        nxToIn=connectivityIn['nxTo']
-        nyToIn=connectivityIn['nyTo']
-        numToIn=connectivityIn['numTo']
-    else:
-        #fast, high memory usage
-        print('In trimConnectivity, Loading connectivity matrix into memory; if fails, make loadConnectToMem=False')
-        nxToIn=connectivityIn['nxTo'][:]
-        nyToIn=connectivityIn['nyTo'][:]
-        numToIn=connectivityIn['numTo'][:]
-        print('   done loading into memory')
-
-    #breakpoint()
-    
-    for n in range(nOut):
-        nIn=sourceIndx[n]
-        nxToOld=nxToIn[nIn]
-        nyToOld=nyToIn[nIn]
-        numToOld=numToIn[nIn]
-        if keepAllTo:
-            nxToNew[n]=nxToOld
-            nyToNew[n]=nyToOld
-            numToNew[n]=numToOld
-        else:
-            toKeep=[(p in toKeepDict)  for p in zip(nxToOld,nyToOld)]
-            nxToNew[n]=nxToOld[toKeep]
-            nyToNew[n]=nyToOld[toKeep]
-            numToNew[n]=numToOld[toKeep]
-    print('done filling lists in ',time.time()-tic)
-    nxTo[:]=nxToNew 
-    nyTo[:]=nyToNew
-    numTo[:]=numToNew
-    print('done with To',time.time()-tic,'cummalative')
-
-    #pass the numberOfStartingTimes info through to the output
-    root.attrs['numberOfStartingTimes']=connectivityIn.attrs['numberOfStartingTimes']
-    
-    return root
+    #the *To points which are kept are those which are kept starting points
+    keptPoints=sort(grid2int(nxFromIn[keepFrom],nyFromIn[keepFrom]))
+    def isGoodTo(nxTo,nyTo):
+        return isin(grid2int(nxTo,nyTo),keptPoints)
 
+    return trimConnectivityByMask(connectivityIn,keepFrom,isGoodTo,loadConnectToMem=loadConnectToMem,
+                                  keepAllTo=keepAllTo)
 
 #===============================================================================================
 # Make code to combine connectivity matrices
 
-def makeEmptyConnectivity(store):
-    '''makeEmptyConnectivity(store)
+def makeEmptyConnectivity(store,chunkSize=int(1e6)):
+    '''makeEmptyConnectivity(store,chunkSize=int(1e6))
 
     Take a zarr store (as created by zarr.MemoryStore() or
     zarr.DirectoryStore() or the like) and create an empty
-    connectivity matrix in it. This can then be used by
-    combineConnectivity to combine multiple matrices together.
+    connectivity matrix in it, whose arrays are chunked in chunkSize
+    rows. This can then be used by combineConnectivity to combine
+    multiple matrices together.
 
     returns the root object to the connectivity matrix.
 
     '''
-    #create zarr dataset
-    chunkSize=int(1e6) #should experiment with this
+    #create zarr dataset; the chunkSize should be experimented with
     root=zarr.group(store=store)
     
     nOut=0 #empty!
@@ -759,7 +796,124 @@ def makeEmptyConnectivity(store):
 
     return root
 
-#@profile
+# The connectivity matrices are combined by flattening each into one
+# (from,to,number) triplet for each entry of its rows, with the points
+# stored as grid2int() integers, adding together the numbers of the
+# triplets with the same from and to points with unique(), and packing
+# the sums back into rows. This replaces looping over the rows in
+# python, and a dictionary for each row; the old code is kept, to test
+# against, as combineConnectivity_rowByRow() in
+# tests/test_makeConnectivity.py.
+
+def raggedToFlat(rows,dtype):
+    '''flat,rowLength=raggedToFlat(rows,dtype)
+
+    rows is an object array of 1d arrays, such as nxTo[:] of a
+    connectivity matrix. Returns them concatenated into a single array
+    of type dtype, and the length of each row.
+    '''
+    rowLength=array([len(p) for p in rows],dtype=int64)
+    if rowLength.sum()==0:
+        return zeros((0,),dtype=dtype),rowLength
+    return concatenate(list(rows)).astype(dtype,copy=False),rowLength
+
+def flatToRagged(flat,rowLength):
+    '''rows=flatToRagged(flat,rowLength)
+
+    the inverse of raggedToFlat(); split flat into an object array of
+    rows, of lengths rowLength
+    '''
+    rows=empty((len(rowLength),),dtype=object)
+    #fill in a loop, since numpy would make a 2d array if all the rows
+    #had the same length
+    for n,p in zip(range(len(rowLength)),split(flat,cumsum(rowLength)[:-1])):
+        rows[n]=p
+    return rows
+
+def flattenConnectivity(C):
+    '''rowPoint,rowLength,toPoint,numTo=flattenConnectivity(C)
+
+    flatten the connectivity matrix C, the root object of a zarr
+    structure as made by makeConnectFromFile() or the like. rowPoint is
+    the starting point of each row, and rowLength the number of
+    destinations in it; toPoint and numTo are the destinations and the
+    number of drifters that went to them, of all the rows, one row
+    after another. The points are grid2int() integers.
+    '''
+    nxTo,rowLength=raggedToFlat(C['nxTo'][:],coordType)
+    nyTo,jnk=raggedToFlat(C['nyTo'][:],coordType)
+    numTo,jnk=raggedToFlat(C['numTo'][:],typeOfSum)
+    rowPoint=grid2int(C['nxFrom'][:],C['nyFrom'][:])
+    return rowPoint,rowLength,grid2int(nxTo,nyTo),numTo
+
+def mergeFlatConnectivity(flatList):
+    '''rowPoint,rowLength,toPoint,numTo=mergeFlatConnectivity(flatList)
+
+    add together the connectivity matrices in flatList, each a tuple
+    (rowPoint,rowLength,toPoint,numTo) as returned by
+    flattenConnectivity(), and return the sum in the same form.
+
+    The rows of the sum are in the order their starting points first
+    appear in flatList, and the destinations within each row are in
+    the order they first appear in that row. So, as in the old
+    row by row code, adding B to A leaves the rows of A,
+    and the destinations in them, where they were, and puts what is
+    new in B after them, in the order it is in B.
+
+    numTo is kept as typeOfSum, and it is an error for a sum to
+    overflow it.
+    '''
+    rowPointAll=concatenate([p[0] for p in flatList])
+    rowLengthAll=concatenate([p[1] for p in flatList])
+    toPointAll=concatenate([p[2] for p in flatList])
+    numToAll=concatenate([p[3] for p in flatList])
+
+    #number the distinct starting points in the order they first
+    #appear, and find the row of the sum each input row goes into
+    uniquePoint,firstRow,rowInverse=unique(rowPointAll,return_index=True,return_inverse=True)
+    rowOrder=argsort(firstRow,kind='stable')
+    rowRank=empty_like(rowOrder)
+    rowRank[rowOrder]=arange(len(rowOrder))
+    rowPoint=uniquePoint[rowOrder]
+    rowOfEntry=repeat(rowRank[rowInverse.ravel()],rowLengthAll)
+
+    #a triplet is identified by its row and destination; since
+    #pointType is a 32 bit integer, both fit in one 64 bit key
+    key=rowOfEntry.astype(int64)*2**32+toPointAll.astype(int64)
+    uniqueKey,firstEntry,entryInverse=unique(key,return_index=True,return_inverse=True)
+    numTo=bincount(entryInverse.ravel(),weights=numToAll,minlength=len(uniqueKey))
+    if len(numTo)>0:
+        assert amax(numTo)<=iinfo(typeOfSum).max,'Error, numTo has overflowed typeOfSum; make typeOfSum larger'
+
+    #put the triplets in order of row, and of first appearance within a row
+    uniqueRow=uniqueKey//2**32
+    entryOrder=lexsort((firstEntry,uniqueRow))
+    toPoint=(uniqueKey[entryOrder]%2**32).astype(pointType)
+    numTo=numTo[entryOrder].astype(typeOfSum)
+    rowLength=bincount(uniqueRow,minlength=len(rowPoint)).astype(int64)
+
+    return rowPoint,rowLength,toPoint,numTo
+
+def writeFlatConnectivity(C,rowPoint,rowLength,toPoint,numTo):
+    '''writeFlatConnectivity(C,rowPoint,rowLength,toPoint,numTo)
+
+    replace the contents of the connectivity matrix C, made by
+    makeEmptyConnectivity() or the like, with the flattened
+    connectivity rowPoint,rowLength,toPoint,numTo, as made by
+    flattenConnectivity(). Attributes of C are left alone.
+    '''
+    nOut=len(rowPoint)
+    nxFrom,nyFrom=int2grid(rowPoint)
+    nxTo,nyTo=int2grid(toPoint)
+    for name,values in (('nxFrom',nxFrom.astype(coordType)),('nyFrom',nyFrom.astype(coordType)),
+                        ('nxTo',flatToRagged(nxTo.astype(coordType),rowLength)),
+                        ('nyTo',flatToRagged(nyTo.astype(coordType),rowLength)),
+                        ('numTo',flatToRagged(numTo.astype(typeOfSum),rowLength))):
+        C[name].resize(nOut)
+        if nOut>0:
+            C[name][:]=values
+    return None
+
 def combineConnectivity(A,B,runFast=True):
     '''combineConnectivity(A,B,runFast=True)
 
@@ -769,154 +923,220 @@ def combineConnectivity(A,B,runFast=True):
 
     A and B are the root object to a zarr structure
 
-    if runFast=True, then load some of B into memory, so that it is
-    faster (but uses more memory)
+    Both are flattened into triplets and summed by
+    mergeFlatConnectivity(), which needs both in memory. runFast is
+    not used; it is kept so that calls made for the old, row by row,
+    code still work.
 
     Does not return anything.
 
     '''
-
-    #find total number of starting times in A and B, and update
-    #numberOfStartingTimes in A. Need to deal with fact that A might not
-    #have that attribute yet, if it is an empty dataset
+    #update numberOfStartingTimes in A, which might not have that
+    #attribute yet, if it is an empty dataset
     if 'numberOfStartingTimes' in A.attrs:
         numA=A.attrs['numberOfStartingTimes']
     else:
         numA=0
-        
-    numB=B.attrs['numberOfStartingTimes']
-    A.attrs['numberOfStartingTimes']=numA+numB
-        
-    #make sets of starting points in A and B
-    inA=set([(p[0],p[1]) for p in zip(A['nxFrom'][:],A['nyFrom'][:])])
-    inB=set([(p[0],p[1]) for p in zip(B['nxFrom'][:],B['nyFrom'][:])])
-
-    #make a dictionary that maps from (nxFrom,nyFrom) in B to row in B
-    nxFromB=B['nxFrom'][:]
-    nyFromB=B['nyFrom'][:]
-    whereInB=dict([((nxFromB[n],nyFromB[n]),n) for n in range(len(nxFromB))])
-
-    #find all points in A and B, and all points in B but not A
-    inAandB=inA.intersection(inB)
-    inBnotA=inB.difference(inA)
-
-    if runFast:
-        nxToAllB=B['nxTo'][:]
-        nyToAllB=B['nyTo'][:]
-        numToAllB=B['numTo'][:]
-
-    #The basic logic is simple, but the implementation here is perhaps
-    #slow.
-    #
-    #First loop over all points in A, by chunk, and if the starting
-    #points are in A and B ((nxFrom,nyFrom) in inAandB) then add to
-    #existing nxTo,nyTo and numTo. Note their are two cases to worry
-    #about -- (nxTo,nyTo) in both A and B, and (nxTo,nyTo) just in
-    #B. The case where a point is in A but not B should be fine and
-    #automatically delt with in the follow loop for the in A and B
-    #case.
-    #
-    #All this code needs to do is update nxTo,nyTo and numTo
-    tic=time.time()
-    print('Starting to combine inAandB')
-    lenA=A['nxFrom'].shape[0]
-    chunkSize=A['nxFrom'].chunks[0]
-    startThisChunk=0
-    while startThisChunk <lenA:
-        thisChunkSize=min(chunkSize,lenA-startThisChunk) #on last loop, should == lenA 
-
-        #get a chunk. Do a deep copy for the ones that will be
-        #altered. Why? For reasons I don't understand, the object
-        #arrays in *To arrays are unwriteable with the deep copy. It
-        #is ok to do this, because below I copy the update chunks back
-        #to A
-        nxFrom=A['nxFrom'][startThisChunk:startThisChunk+thisChunkSize]
-        nyFrom=A['nyFrom'][startThisChunk:startThisChunk+thisChunkSize]
-
-        nxTo=copy.deepcopy(A['nxTo'][startThisChunk:startThisChunk+thisChunkSize])
-        nyTo=copy.deepcopy(A['nyTo'][startThisChunk:startThisChunk+thisChunkSize])
-        numTo=copy.deepcopy(A['numTo'][startThisChunk:startThisChunk+thisChunkSize])
-
-        #update info in this chunk
-        for nA in range(len(nxFrom)): #loop over chunk, nA is a row in the chunk
-            if (nxFrom[nA],nyFrom[nA]) in inAandB: #is (nxFrom,nyFrom) in A and B
-
-                #to check if To point from B in A already for this
-                #(nxFrom,nyFrom), and to find where that
-                #(nxFrom,nyFrom) are, create dictionary whose key is a
-                #single (nxFrom[],nyFrom[]) in A and whose value is the
-                #location of that point in the nxFrom/nyFrom/numFrom
-                #vector for a row in A
-                inThisTo=dict([((p[0],p[1]),p[2]) for p in zip(nxTo[nA],nyTo[nA],range(len(nxTo[nA])))]) 
-
-                #breakpoint()
-                
-                #to store points that need to be appended to nxTo, nyTo and numTo of A
-                nxToNew=[]; nyToNew=[]; numToNew=[]
-
-                #loop over *To in B. Note that here it is gaurenteed
-                #that *From points are in both A and B
-                bRow=whereInB[(nxFrom[nA],nyFrom[nA])]
-                if runFast:
-                    nxToB=nxToAllB[bRow]
-                    nyToB=nyToAllB[bRow]
-                    numToB=numToAllB[bRow]                    
-                else:
-                    nxToB=B['nxTo'][bRow]
-                    nyToB=B['nyTo'][bRow]
-                    numToB=B['numTo'][bRow]
-
-                for nB in range(len(nxToB)): #nB is, confusingly, a location in nxToB/nyToB/numToB
-                    if (nxToB[nB],nyToB[nB]) in inThisTo:
-                        #then the (nxTo,nyTo) point is in both A and B
-                        #for this (nxFrom,nyFrom), and so we just need
-                        #to update the numTo
-                        whichOne=inThisTo[(nxToB[nB],nyToB[nB])]
-                        numTo[nA][whichOne]+=numToB[nB]
-                    else:
-                        #then the (nxTo,nyTo) point is only in B for
-                        #this (nxFrom,nyFrom), and so we need to add
-                        #new items to nxTo/nyTo/numTo in A
-                        nxToNew.append(nxToB[nB])
-                        nyToNew.append(nyToB[nB])
-                        numToNew.append(numToB[nB])
-
-                #now, we need to append nxToNew,nyToNew and numToNew to nxTo[n]/nyTo[n]/numTo[n]
-                nxTo[nA]=concatenate((nxTo[nA],array(nxToNew)))#,casting='no')
-                nyTo[nA]=concatenate((nyTo[nA],array(nyToNew)))#,casting='no')
-                numTo[nA]=concatenate((numTo[nA],array(numToNew)))#,casting='no')
-                #breakpoint()
-
-        #now write the chunk back to A, but only the *To's, since they
-        #are the only ones to have changed
-        A['nxTo'][startThisChunk:startThisChunk+thisChunkSize]=nxTo
-        A['nyTo'][startThisChunk:startThisChunk+thisChunkSize]=nyTo
-        A['numTo'][startThisChunk:startThisChunk+thisChunkSize]=numTo
-
-        #now update startThisChunk
-        #print('Done with',startThisChunk,'of',lenA)
-        startThisChunk=startThisChunk+chunkSize
-
-    print('   done in',time.time()-tic)
+    A.attrs['numberOfStartingTimes']=numA+B.attrs['numberOfStartingTimes']
 
     tic=time.time()
-    print('Starting to combine inBnotA')
-
-    #now we need to find all (nxFrom,nyFrom) points that are in B but
-    #not A, and the nxFrom/nyFrom/nxTo/nyTo/numTo lines for those
-    #starting points to A. This is a straightforward append.
-    indxInBnotA=array([ (p in inBnotA) for p in zip(nxFromB,nyFromB)])
-    A['nxFrom'].append(B['nxFrom'].vindex[indxInBnotA],axis=0)                    
-    A['nyFrom'].append(B['nyFrom'].vindex[indxInBnotA],axis=0)                    
-    A['nxTo'].append(B['nxTo'].vindex[indxInBnotA],axis=0)                    
-    A['nyTo'].append(B['nyTo'].vindex[indxInBnotA],axis=0)                    
-    A['numTo'].append(B['numTo'].vindex[indxInBnotA],axis=0)                    
-
+    print('Starting to combine connectivity')
+    writeFlatConnectivity(A,*mergeFlatConnectivity([flattenConnectivity(A),flattenConnectivity(B)]))
     print('   done in',time.time()-tic)
-    
 
     return None
 
+#===============================================================================================
+# Combine many connectivity matrices at once, in bounded memory.
+#
+# Adding matrices one at a time to an in-memory accumulator with
+# combineConnectivity() reads and rewrites the accumulator for each
+# matrix added, and holds it all in memory. combineMany() instead does
+# a single pass over all of the matrices:
+#
+#   1) each input is read a chunk of rows at a time, flattened into
+#      triplets, and the triplets split by their starting point into
+#      nPartition partitions, each of which is spilled to its own files
+#      in a scratch directory. The inputs are read in parallel.
+#   2) each partition is summed with mergeFlatConnectivity(); since no
+#      starting point is in more than one partition, this sums all of
+#      the triplets of each starting point. The partitions are summed
+#      in parallel, and only one partition per thread is in memory.
+#   3) the rows of all the partitions are written out, a chunk at a
+#      time, in the order they first appear in the inputs, so the
+#      result is the same as adding the inputs in order with
+#      combineConnectivity().
+#
+# Threads are used rather than processes, since the time goes into
+# reading, decompressing and numpy, and the inputs may be in-memory
+# zarr groups which can not be passed to other processes.
+
+def spillInput(nIn,C,spillDir,nPartition):
+    '''numberOfStartingTimes=spillInput(nIn,C,spillDir,nPartition)
+
+    read the connectivity matrix C, the nIn'th input of combineMany(),
+    a chunk of rows at a time, and write its triplets into spillDir,
+    split into nPartition partitions by their starting point. Each
+    file holds the rows of one chunk which fall in one partition, in
+    the order they are in C, and the files of a partition sort in the
+    order of the inputs and of the chunks.
+    '''
+    nRow=C['nxFrom'].shape[0]
+    readChunk=max(1,C['nxFrom'].chunks[0])
+    for nChunk,startRow in enumerate(range(0,nRow,readChunk)):
+        endRow=min(nRow,startRow+readChunk)
+        nxTo,rowLength=raggedToFlat(C['nxTo'][startRow:endRow],coordType)
+        nyTo,jnk=raggedToFlat(C['nyTo'][startRow:endRow],coordType)
+        numTo,jnk=raggedToFlat(C['numTo'][startRow:endRow],typeOfSum)
+        rowPoint=grid2int(C['nxFrom'][startRow:endRow],C['nyFrom'][startRow:endRow])
+        toPoint=grid2int(nxTo,nyTo)
+
+        #rowKey orders the rows of all the inputs: by input, then by row
+        rowKey=int64(nIn)*2**40+arange(startRow,endRow,dtype=int64)
+        rowPartition=rowPoint%nPartition
+        entryPartition=repeat(rowPartition,rowLength)
+        for nPart in unique(rowPartition):
+            inRow=rowPartition==nPart
+            inEntry=entryPartition==nPart
+            savez(os.path.join(spillDir,'part%4.4d_input%4.4d_chunk%8.8d.npz'%(nPart,nIn,nChunk)),
+                  rowPoint=rowPoint[inRow],rowLength=rowLength[inRow],toPoint=toPoint[inEntry],
+                  numTo=numTo[inEntry],rowKey=rowKey[inRow])
+    return C.attrs['numberOfStartingTimes']
+
+def mergePartition(nPart,spillDir):
+    '''nRow=mergePartition(nPart,spillDir)
+
+    sum the spilled triplets of partition nPart with
+    mergeFlatConnectivity(), and save the result into spillDir, with
+    the rows sorted by rowKey, the key of the input row in which their
+    starting point first appears, and rowStart, where the destinations
+    of each row start. The spilled files are then deleted. Returns the
+    number of rows in the partition.
+    '''
+    fileList=sorted(glob.glob(os.path.join(spillDir,'part%4.4d_*.npz'%nPart)))
+
+    #start with an empty piece, in case no starting point falls in this partition
+    flatList=[(zeros((0,),dtype=pointType),zeros((0,),dtype=int64),zeros((0,),dtype=pointType),
+               zeros((0,),dtype=typeOfSum))]
+    rowPointAll=[zeros((0,),dtype=pointType)]
+    rowKeyAll=[zeros((0,),dtype=int64)]
+    for fileName in fileList:
+        with load(fileName) as data:
+            flatList.append((data['rowPoint'],data['rowLength'],data['toPoint'],data['numTo']))
+            rowPointAll.append(data['rowPoint'])
+            rowKeyAll.append(data['rowKey'])
+    rowPoint,rowLength,toPoint,numTo=mergeFlatConnectivity(flatList)
+
+    #the files are read in the order of the inputs and their rows, so
+    #the first time a starting point appears has the smallest rowKey
+    #of that point, and the rows are already in order of rowKey
+    uniquePoint,firstRow=unique(concatenate(rowPointAll),return_index=True)
+    rowKey=concatenate(rowKeyAll)[firstRow[searchsorted(uniquePoint,rowPoint)]]
+    rowStart=concatenate(([0],cumsum(rowLength))).astype(int64)
+    for name,values in (('rowPoint',rowPoint),('rowLength',rowLength),('toPoint',toPoint),
+                        ('numTo',numTo),('rowKey',rowKey),('rowStart',rowStart)):
+        save(os.path.join(spillDir,'merged%4.4d_%s.npy'%(nPart,name)),values)
+    for fileName in fileList:
+        os.remove(fileName)
+    return len(rowPoint)
+
+def combineMany(inputList,store,prepare=None,nPartition=16,nThread=None,spillDir=None,chunkSize=int(1e6)):
+    '''E=combineMany(inputList,store,prepare=None,nPartition=16,nThread=None,spillDir=None,chunkSize=int(1e6))
+
+    add together all of the connectivity matrices in inputList, each
+    either the root object of a zarr structure or the name of a file
+    or directory that zarr.open() can read (such as the EZfate
+    climatology zip files), and write the sum into a new connectivity
+    matrix made by makeEmptyConnectivity(store,chunkSize). Returns the
+    root object of the sum, which is the same as adding the inputs in
+    order to an empty matrix with combineConnectivity().
+
+    prepare, if given, is a function which is applied to each input
+    after it is opened, and returns the matrix to add, e.g. to trim it
+    with trimConnectivity(). It is called in the reading threads, so
+    it must not change anything shared.
+
+    nThread threads (os.cpu_count() if None) read the inputs, and
+    then sum the nPartition partitions. At most one input (if prepare
+    loads it into memory), or one partition, per thread, and one
+    chunk of the output, is in memory at a time; more partitions make
+    each smaller. The partitions are spilled into a temporary
+    directory made in spillDir (the system default if None), which is
+    deleted when done.
+
+    numTo is kept as typeOfSum, and it is an error for a sum to
+    overflow it.
+    '''
+    def readInput(nIn):
+        C=inputList[nIn]
+        if isinstance(C,str):
+            C=zarr.open(C,'r')
+        if prepare is not None:
+            C=prepare(C)
+        return spillInput(nIn,C,theSpillDir,nPartition)
+
+    E=makeEmptyConnectivity(store,chunkSize=chunkSize)
+    theSpillDir=tempfile.mkdtemp(prefix='combineMany_',dir=spillDir)
+    try:
+        tic=time.time()
+        print('Starting to read',len(inputList),'connectivity matrices into',nPartition,'partitions')
+        with ThreadPool(nThread) as pool:
+            numStarts=pool.map(readInput,range(len(inputList)))
+        E.attrs['numberOfStartingTimes']=int(sum(numStarts))
+        print('   done in',time.time()-tic)
+
+        tic=time.time()
+        print('Starting to sum the partitions')
+        with ThreadPool(nThread) as pool:
+            nRowPart=pool.map(lambda nPart: mergePartition(nPart,theSpillDir),range(nPartition))
+        print('   done in',time.time()-tic)
+
+        #the merged partitions are memory mapped, so only what is
+        #written out is read in
+        tic=time.time()
+        print('Starting to write out',sum(nRowPart),'rows')
+        merged=[{name:load(os.path.join(theSpillDir,'merged%4.4d_%s.npy'%(nPart,name)),mmap_mode='r')
+                 for name in ('rowPoint','toPoint','numTo','rowKey','rowStart')} for nPart in range(nPartition)]
+
+        #the order of all the rows in the output, and for each, its
+        #partition and row within it. Since the rows of each partition
+        #are sorted by rowKey, those within a chunk of the output are a
+        #contiguous block of the partition
+        partOfRow=repeat(arange(nPartition),nRowPart)
+        localRow=concatenate([arange(n) for n in nRowPart]).astype(int64)
+        rowOrder=argsort(concatenate([p['rowKey'][:] for p in merged]),kind='stable')
+        partOfRow=partOfRow[rowOrder]
+        localRow=localRow[rowOrder]
+        del rowOrder
+
+        for startRow in range(0,len(partOfRow),chunkSize):
+            partOfChunk=partOfRow[startRow:startRow+chunkSize]
+            localOfChunk=localRow[startRow:startRow+chunkSize]
+            nChunk=len(partOfChunk)
+            chunkArrays={name:empty((nChunk,),dtype=object) for name in ('nxTo','nyTo','numTo')}
+            chunkArrays['nxFrom']=empty((nChunk,),dtype=coordType)
+            chunkArrays['nyFrom']=empty((nChunk,),dtype=coordType)
+            for nPart in unique(partOfChunk):
+                inPart=nonzero(partOfChunk==nPart)[0]
+                firstRow=localOfChunk[inPart[0]]; lastRow=localOfChunk[inPart[-1]]+1
+                p=merged[nPart]
+                rowStart=array(p['rowStart'][firstRow:lastRow+1])
+                nxTo,nyTo=int2grid(array(p['toPoint'][rowStart[0]:rowStart[-1]]))
+                numTo=array(p['numTo'][rowStart[0]:rowStart[-1]])
+                nxFrom,nyFrom=int2grid(array(p['rowPoint'][firstRow:lastRow]))
+                chunkArrays['nxFrom'][inPart]=nxFrom
+                chunkArrays['nyFrom'][inPart]=nyFrom
+                chunkArrays['nxTo'][inPart]=flatToRagged(nxTo.astype(coordType),diff(rowStart))
+                chunkArrays['nyTo'][inPart]=flatToRagged(nyTo.astype(coordType),diff(rowStart))
+                chunkArrays['numTo'][inPart]=flatToRagged(numTo,diff(rowStart))
+            for name in ('nxFrom','nyFrom','nxTo','nyTo','numTo'):
+                E[name].append(chunkArrays[name],axis=0)
+        del merged
+        print('   done in',time.time()-tic)
+    finally:
+        shutil.rmtree(theSpillDir)
+
+    return E
 
 #so lets test this code
 if __name__=="__main__":
@@ -0,0 +1,302 @@
+from numpy import *
+import numpy as np
+import zarr
+import numcodecs
+import os
+
+# This module keeps the output of all the runs of one experiment in a
+# single chunked zarr store (a directory), rather than in a zip file
+# for each run, or each snapshot of each run. The output of
+# 02_manyNeutralSpecies_fastModel.py has dimensions (run, snapshot,
+# location, species), and that of
+# 04_twoSpeciesModel_differentR_relativeFitnessDifference.py has
+# dimensions (run, location, region) and (run, region). The analysis
+# codes can then read one run, or a slice of many runs, without opening
+# thousands of files.
+#
+# Each chunk holds one run (and one snapshot), so the runs can be
+# written as they finish, in any order, and by different processes at
+# once, since no two writers touch the same chunk. Each run also has a
+# flag in the array written, which is set after its data, so a run
+# whose flag is set is complete even if the job was killed while
+# another run was being written. The store must be made, by
+# openNeutralStore() or openFitnessStore(), in one process before any
+# others write to it.
+#
+# The populations are small integers, and mostly zero, so they are
+# compressed with zstd after bit shuffling, which packs the few bits
+# that are set in each value together.
+#
+# The snapshots of the neutral model can instead be stored sparsely,
+# as the (location,species,number) triplets of the species present at
+# each location, which is far smaller, and far quicker to write, than
+# the dense (location,species) array when there are many species, since
+# each location holds no more than Pmax adults. The locations and
+# their coordinates, lonVec and latVec, are stored once in the store,
+# and are shared by all of the snapshots. loadNeutralSnapshot() gives
+# back either form of a snapshot, whichever way it was stored.
+
+#the compressor of the arrays in a store
+storeCompressor=numcodecs.Blosc(cname='zstd',clevel=5,shuffle=numcodecs.Blosc.BITSHUFFLE)
+
+def neutralStoreName(ConnectivityModelName,R,Pmax,Nintro):
+    '''storeName=neutralStoreName(ConnectivityModelName,R,Pmax,Nintro)
+
+    the name of the store of the runs of
+    02_manyNeutralSpecies_fastModel.py with these parameters
+    '''
+    if Nintro<0:
+        return ('modelOutputNeutral/manySpecies_'+ConnectivityModelName
+                +'_Params_R_%2d_Pmax%2.2d.zarr'%(R,Pmax))
+    else:
+        return ('modelOutputNeutral/manySpecies_'+ConnectivityModelName
+                +'_Params_R_%2d_Pmax%2.2d_Nintro%2.2d.zarr'%(R,Pmax,Nintro))
+
+def fitnessStoreName(ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro):
+    '''storeName=fitnessStoreName(ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro)
+
+    the name of the store of the runs of
+    04_twoSpeciesModel_differentR_relativeFitnessDifference.py with
+    these parameters
+    '''
+    if Nintro<0:
+        return ('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
+                +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d.zarr'%(R0,R1,Tmax,Pmax))
+    else:
+        return ('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
+                +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d.zarr'%(R0,R1,Tmax,Pmax,Nintro))
+
+def requireRunArray(store,name,shape,chunks,theDtype):
+    '''theArray=requireRunArray(store,name,shape,chunks,theDtype)
+
+    get the array name of store, making it if it does not exist. Its
+    first dimension is the run; if it has fewer runs than shape[0], it
+    is made larger, so more runs can be added to a store. The other
+    dimensions must match shape.
+    '''
+    if name not in store:
+        return store.create_dataset(name,shape=shape,chunks=chunks,dtype=theDtype,fill_value=0,
+                                    compressor=storeCompressor)
+    theArray=store[name]
+    assert theArray.shape[1:]==tuple(shape[1:]),'the array '+name+' of the store does not match this experiment'
+    if theArray.shape[0]<shape[0]:
+        theArray.resize((shape[0],)+theArray.shape[1:])
+    return theArray
+
+def checkStoreAttrs(store,storeName,attrs):
+    '''checkStoreAttrs(store,storeName,attrs)
+
+    assert that each of the settings in the dictionary attrs, such as
+    the engine and the dtype of the population, is the same as the one
+    recorded in store when it was made, so the runs of an experiment
+    made with other settings are not added to it. A setting the store
+    does not record, because it was made before it was recorded, is
+    recorded now.
+    '''
+    for key,value in attrs.items():
+        if key not in store.attrs:
+            store.attrs[key]=value
+        assert store.attrs[key]==value,('the %s of %s is %s, but this experiment has %s'
+                                        %(key,storeName,store.attrs[key],value))
+    return None
+
+def denseToTriplets(P):
+    '''cellVec,speciesVec,countVec=denseToTriplets(P)
+
+    the nonzero entries of the (Ndomain,Nspecies) population P as
+    (location,species,number) triplets, in order of location
+    '''
+    cellVec,speciesVec=nonzero(P)
+    return cellVec,speciesVec,P[cellVec,speciesVec]
+
+def tripletsToDense(cellVec,speciesVec,countVec,Ndomain,Nspecies,Pdtype):
+    '''P=tripletsToDense(cellVec,speciesVec,countVec,Ndomain,Nspecies,Pdtype)
+
+    the (Ndomain,Nspecies) population array of the triplets
+    '''
+    P=zeros((Ndomain,Nspecies),dtype=Pdtype)
+    P[cellVec,speciesVec]=countVec
+    return P
+
+def openNeutralStore(storeName,nRun,snapshotVec,lonVec,latVec,Nspecies,Pdtype,sparse=False,engineMode='dense'):
+    '''store=openNeutralStore(storeName,nRun,snapshotVec,lonVec,latVec,Nspecies,Pdtype,sparse=False,engineMode='dense')
+
+    open, or make, the store of the runs of
+    02_manyNeutralSpecies_fastModel.py, for nRun runs with snapshots of
+    the population at the generations in snapshotVec. If sparse is
+    True, the snapshots are stored as triplets, and otherwise as dense
+    (location,species) arrays. If the store exists, it must have been
+    made with the same snapshots, Nspecies, Pdtype, sparse and
+    engineMode; see checkStoreAttrs().
+    '''
+    store=zarr.open_group(storeName,mode='a')
+    Ndomain=len(lonVec)
+    nSnapshot=len(snapshotVec)
+    if 'snapshotNt' not in store:
+        store.array('lonVec',lonVec)
+        store.array('latVec',latVec)
+        store.array('snapshotNt',array(snapshotVec,dtype=int64))
+        store.attrs['sparse']=sparse
+        store.attrs['Nspecies']=int(Nspecies)
+        store.attrs['Pdtype']=dtype(Pdtype).name
+    elif 'sparse' not in store.attrs:
+        #a store made before the snapshots could be sparse
+        store.attrs.update({'sparse':False,'Nspecies':store['P'].shape[3],'Pdtype':store['P'].dtype.name})
+    assert (store['snapshotNt'][:]==snapshotVec).all(),'the snapshots of '+storeName+' do not match this experiment'
+    assert store.attrs['sparse']==sparse,storeName+' does not store the snapshots in the same form as this experiment'
+    assert store.attrs['Nspecies']==Nspecies,'the species of '+storeName+' do not match this experiment'
+    checkStoreAttrs(store,storeName,{'Pdtype':dtype(Pdtype).name,'engineMode':engineMode})
+    if not sparse:
+        requireRunArray(store,'P',(nRun,nSnapshot,Ndomain,Nspecies),(1,1,Ndomain,Nspecies),Pdtype)
+    requireRunArray(store,'seed',(nRun,),(1,),int64)
+    requireRunArray(store,'written',(nRun,nSnapshot),(1,1),bool)
+    requireRunArray(store,'finished',(nRun,),(1,),bool)
+    return store
+
+def snapshotIndex(store,nt):
+    '''nSnap=snapshotIndex(store,nt)
+
+    the index of the snapshot at generation nt in a store made by
+    openNeutralStore(), or None if it has no such snapshot
+    '''
+    nSnap=nonzero(store['snapshotNt'][:]==nt)[0]
+    return (nSnap[0] if len(nSnap)>0 else None)
+
+def saveNeutralSnapshot(store,nR,nt,P,seed):
+    '''saveNeutralSnapshot(store,nR,nt,P,seed)
+
+    save the population of run nR at generation nt, and the seed of
+    the run, into a store made by openNeutralStore(). P is either the
+    dense (Ndomain,Nspecies) population, or its triplets
+    (cellVec,speciesVec,countVec), e.g. from pkm.slotsToTriplets(). In
+    a sparse store, each snapshot is the (3,number of triplets) array
+    sparseP/nR_nSnap.
+    '''
+    nSnap=snapshotIndex(store,nt)
+    assert nSnap is not None,'generation %d is not a snapshot of this store'%nt
+    if store.attrs.get('sparse',False):
+        if not isinstance(P,tuple):
+            P=denseToTriplets(P)
+        triplets=array(P,dtype=int32).reshape((3,-1))
+        store.array('sparseP/%d_%d'%(nR,nSnap),triplets,chunks=triplets.shape,compressor=storeCompressor,
+                    overwrite=True)
+    else:
+        if isinstance(P,tuple):
+            P=tripletsToDense(*P,store['P'].shape[2],store['P'].shape[3],store['P'].dtype)
+        store['P'][nR,nSnap]=P
+    store['seed'][nR]=seed
+    store['written'][nR,nSnap]=True
+    return None
+
+def markNeutralRunFinished(store,nR):
+    '''markNeutralRunFinished(store,nR)
+
+    record in a store made by openNeutralStore() that run nR has
+    finished, and all of its snapshots have been saved. A run whose
+    introduced species all went extinct has no snapshots after that.
+    '''
+    store['finished'][nR]=True
+    return None
+
+def isNeutralRunFinished(store,nR):
+    '''isFinished=isNeutralRunFinished(store,nR)
+
+    True if markNeutralRunFinished() has been called for run nR
+    '''
+    return bool(('finished' in store) and (nR<store['finished'].shape[0]) and store['finished'][nR])
+
+def loadNeutralSnapshot(store,nR,nt,asSparse=False):
+    '''jnk=loadNeutralSnapshot(store,nR,nt,asSparse=False)
+
+    load the snapshot at generation nt of run nR from a store made by
+    openNeutralStore(), as a dictionary with the same entries as the
+    zip file of a snapshot (P, lonVec, latVec and seed), or None if it
+    was not written, e.g. because all the introduced species went
+    extinct before nt. If asSparse is True, the population is given as
+    its triplets, cellVec, speciesVec and countVec, and the shape of
+    the dense population, shapeP, rather than as P.
+    '''
+    nSnap=snapshotIndex(store,nt)
+    if (nSnap is None) or (nR>=store['written'].shape[0]) or (not store['written'][nR,nSnap]):
+        return None
+    jnk={'lonVec':store['lonVec'][:],'latVec':store['latVec'][:],'seed':store['seed'][nR]}
+    if store.attrs.get('sparse',False):
+        Ndomain=len(jnk['lonVec'])
+        Nspecies=store.attrs['Nspecies']
+        cellVec,speciesVec,countVec=store['sparseP/%d_%d'%(nR,nSnap)][:]
+        countVec=countVec.astype(store.attrs['Pdtype'])
+        if not asSparse:
+            jnk['P']=tripletsToDense(cellVec,speciesVec,countVec,Ndomain,Nspecies,countVec.dtype)
+    else:
+        P=store['P'][nR,nSnap]
+        Ndomain,Nspecies=P.shape
+        if asSparse:
+            cellVec,speciesVec,countVec=denseToTriplets(P)
+        else:
+            jnk['P']=P
+    if asSparse:
+        jnk.update({'cellVec':cellVec,'speciesVec':speciesVec,'countVec':countVec,'shapeP':(Ndomain,Nspecies)})
+    return jnk
+
+def openFitnessStore(storeName,nRun,lonVec,latVec,speciesList,Pdtype,engineMode):
+    '''store=openFitnessStore(storeName,nRun,lonVec,latVec,speciesList,Pdtype,engineMode)
+
+    open, or make, the store of the runs of
+    04_twoSpeciesModel_differentR_relativeFitnessDifference.py, for nRun
+    runs of introductions into each of the regions in speciesList. If
+    the store exists, it must have been made with the same speciesList,
+    Pdtype and engineMode; see checkStoreAttrs().
+    '''
+    store=zarr.open_group(storeName,mode='a')
+    Ndomain=len(lonVec)
+    Nregions=len(unique(speciesList))
+    if 'speciesList' not in store:
+        store.array('lonVec',lonVec)
+        store.array('latVec',latVec)
+        store.array('speciesList',speciesList)
+        store.attrs['engineMode']=engineMode
+        store.attrs['Pdtype']=dtype(Pdtype).name
+    elif 'Pdtype' not in store.attrs:
+        #a store made before Pdtype was recorded
+        store.attrs['Pdtype']=store['finalPopVec'].dtype.name
+    assert array_equal(store['speciesList'][:],speciesList),'the regions of '+storeName+' do not match this experiment'
+    checkStoreAttrs(store,storeName,{'Pdtype':dtype(Pdtype).name,'engineMode':engineMode})
+    requireRunArray(store,'finalPopVec',(nRun,Ndomain,Nregions),(1,Ndomain,Nregions),Pdtype)
+    requireRunArray(store,'ntVecFinal',(nRun,Nregions),(1,Nregions),int64)
+    requireRunArray(store,'stopReasonVec',(nRun,Nregions),(1,Nregions),int8)
+    requireRunArray(store,'seed',(nRun,),(1,),int64)
+    requireRunArray(store,'written',(nRun,),(1,),bool)
+    return store
+
+def saveFitnessRun(store,nR,finalPopVec,ntVecFinal,stopReasonVec,seed):
+    '''saveFitnessRun(store,nR,finalPopVec,ntVecFinal,stopReasonVec,seed)
+
+    save the results of run nR into a store made by openFitnessStore()
+    '''
+    store['finalPopVec'][nR]=finalPopVec
+    store['ntVecFinal'][nR]=ntVecFinal
+    store['stopReasonVec'][nR]=stopReasonVec
+    store['seed'][nR]=seed
+    store['written'][nR]=True
+    return None
+
+def hasFitnessRun(store,nR):
+    '''isWritten=hasFitnessRun(store,nR)
+
+    True if run nR has been saved into a store made by openFitnessStore()
+    '''
+    return bool((nR<store['written'].shape[0]) and store['written'][nR])
+
+def loadFitnessRun(store,nR):
+    '''jnk=loadFitnessRun(store,nR)
+
+    load run nR from a store made by openFitnessStore(), as a
+    dictionary with the same entries as the zip file of a run, or None
+    if it was not written
+    '''
+    if not hasFitnessRun(store,nR):
+        return None
+    return {'finalPopVec':store['finalPopVec'][nR],'ntVecFinal':store['ntVecFinal'][nR],
+            'stopReasonVec':store['stopReasonVec'][nR],'seed':store['seed'][nR],
+            'lonVec':store['lonVec'][:],'latVec':store['latVec'][:],'speciesList':store['speciesList'][:],
+            'engineMode':store.attrs['engineMode']}
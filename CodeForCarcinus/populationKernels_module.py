@@ -0,0 +1,799 @@
+from numpy import *
+from numba import njit
+from numba.typed import List
+
+# This module holds the computational cores of the population models
+# in 02_manyNeutralSpecies_fastModel.py and
+# 04_twoSpeciesModel_differentR_relativeFitnessDifference.py, compiled
+# with numba. They work on the connectivity in the compressed sparse
+# row form made by createLinearModel_module.makeLinearModel(EfileName,returnCSR=True),
+# so the destinations of habitat point n are EwhereTo[Eindptr[n]:Eindptr[n+1]].
+#
+# The random numbers are drawn from a numpy Generator (as made by
+# np.random.default_rng()) that is passed in, so that the streams of
+# random numbers are reproducible, and each process can be given its
+# own stream.
+#
+# The kernels are compiled with cache=True, so the compiled code is
+# saved in __pycache__ and each worker process of a multiprocessing
+# pool does not have to compile them again.
+
+#The population and the number of settlers are small non-negative
+#integers -- a habitat point holds no more than Pmax adults -- so they
+#are stored in compact unsigned integer types, to reduce the memory
+#used and the memory bandwidth needed each generation. The population
+#is stored as uint8 or uint16, and the settlers as uint16 or uint32.
+#Because unsigned integers silently wrap around when they overflow,
+#values are checked with checkFits() before they are stored.
+
+def populationDtype(Pmax,Pdtype='auto'):
+    '''dtype=populationDtype(Pmax,Pdtype='auto')
+
+    the dtype used to store the population. If Pdtype is 'auto', it is
+    the smallest of uint8 and uint16 that can hold Pmax; otherwise it
+    is Pdtype, after checking it can hold Pmax.
+    '''
+    if Pdtype=='auto':
+        Pdtype=('uint8' if Pmax<=iinfo(uint8).max else 'uint16')
+    Pdtype=dtype(Pdtype)
+    checkFits(Pmax,Pdtype,'Pmax')
+    return Pdtype
+
+def checkFits(values,theDtype,what):
+    '''checkFits(values,theDtype,what)
+
+    asserts if the largest of values is too big to be stored as
+    theDtype. what is the name of the values, for the error message
+    '''
+    if size(values)>0:
+        maxValue=amax(values)
+        assert maxValue<=iinfo(theDtype).max, \
+            '%s of %d is too large for %s; use a larger dtype'%(what,maxValue,dtype(theDtype).name)
+    return None
+
+#There are two ways to send the surviving larvae from a habitat point
+#to their destinations, which give the same distribution of settlers:
+#
+#  'larvae': each larva is placed individually, by picking a
+#     destination at random, weighted by numTo, with searchsorted() on
+#     the cumulative sum Ecumsum. The cost scales with the number of
+#     larvae, R*P*EfracReturn.
+#
+#  'multinomial': the number of larvae going to each destination is
+#     drawn at once from the multinomial distribution with
+#     probabilities numTo/sum(numTo), by binomial splitting: the
+#     number going to the first destination is binomial with
+#     probability numTo[0]/sum(numTo), the number going to the second
+#     is binomial from those left with probability
+#     numTo[1]/sum(numTo[1:]), and so on. The cost scales with the
+#     number of destinations of the habitat point, not the number of
+#     larvae, so it is faster for large R.
+#
+#  'auto': for each habitat point, use whichever of the two is cheaper.
+#
+#dispersalModes maps these names to the integer codes passed into the kernels.
+dispersalModes={'larvae':0,'multinomial':1,'auto':2}
+
+#This function finds where the larvae of a single species settle. It
+#does the whole of the inner loop of findWhereSettle() in compiled
+#code: for every habitat point with a population, the number of larvae
+#that survive to settle is R*Pcol*EfracReturn stochastically rounded
+#to an integer (so 1.7 has a 30% chance of being rounded to 2, and a
+#70% chance of being rounded to 1), the surviving larvae are sent to
+#their destinations in one of the ways described above, and the larvae
+#reaching each location are counted into thisWhereSettle.
+@njit(cache=True)
+def disperseLarvae(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,rng,thisWhereSettle,dispersalMode):
+    '''disperseLarvae(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,rng,thisWhereSettle,dispersalMode)
+
+    Pcol: the population of one species at each habitat point, of length Ndomain
+    R: the number of larvae produced per adult
+    EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo: the connectivity, in compressed sparse row form
+    rng: a numpy Generator
+    thisWhereSettle: array of length Ndomain. The number of larvae
+       which settle at each point is ADDED to it, so zero it first.
+    dispersalMode: one of the values in dispersalModes
+
+    returns nothing.
+    '''
+    for n in range(len(Pcol)):
+        if Pcol[n]>0:
+            nSurvive=int(floor(rng.random()+R*Pcol[n]*EfracReturn[n]))
+            if nSurvive==0:
+                continue
+            rowStart=Eindptr[n]
+            rowEnd=Eindptr[n+1]
+            if (dispersalMode==1) or ((dispersalMode==2) and (nSurvive>rowEnd-rowStart)):
+                splitLarvae(nSurvive,EwhereTo[rowStart:rowEnd],EnumTo[rowStart:rowEnd],rng,thisWhereSettle)
+            else:
+                rowCumsum=Ecumsum[rowStart:rowEnd]
+                for k in range(nSurvive):
+                    whereGo=searchsorted(rowCumsum,rng.random())
+                    thisWhereSettle[EwhereTo[rowStart+whereGo]]+=1
+    return None
+
+#send nLarvae larvae to the destinations rowWhereTo, with probabilities
+#rowNumTo/sum(rowNumTo), by binomial splitting, as described above, and
+#add them to thisWhereSettle
+@njit(cache=True)
+def splitLarvae(nLarvae,rowWhereTo,rowNumTo,rng,thisWhereSettle):
+    weightLeft=0
+    for j in range(len(rowNumTo)):
+        weightLeft+=int(rowNumTo[j])
+    numLeft=nLarvae
+    for j in range(len(rowNumTo)):
+        if numLeft==0:
+            break
+        weight=int(rowNumTo[j])
+        if weight>=weightLeft:
+            numHere=numLeft #the last destination gets all that are left
+        else:
+            numHere=rng.binomial(numLeft,weight/weightLeft)
+        thisWhereSettle[rowWhereTo[j]]+=numHere
+        numLeft-=numHere
+        weightLeft-=weight
+    return None
+
+#When more larvae settle at a habitat point than it can hold, Pmax of
+#them are chosen at random to become adults. This is done here by
+#sampling without replacement from the larvae which settled, so no
+#species can have more recruits than it had settlers (the number of
+#recruits of each species is multivariate hypergeometric). The settlers
+#are given as triplets of the nonzero entries of whereSettle, grouped by
+#habitat point, so the cost is proportional to the number of nonzero
+#entries of whereSettle, not to Ndomain*Nspecies.
+@njit(cache=True)
+def recruitLottery(settleIndptr,settleCount,Pmax,rng,nRecruit):
+    '''recruitLottery(settleIndptr,settleCount,Pmax,rng,nRecruit)
+
+    settleIndptr: the settlers at habitat point n are entries
+       settleIndptr[n]:settleIndptr[n+1] of settleCount
+    settleCount: number of larvae settling, for each entry
+    Pmax: the most adults a habitat point can hold
+    rng: a numpy Generator
+    nRecruit: array the same length as settleCount, into which the
+       number of each entry's larvae which become adults is written
+
+    returns nothing.
+    '''
+    for n in range(len(settleIndptr)-1):
+        recruitLotteryCell(settleIndptr[n],settleIndptr[n+1],settleCount,Pmax,rng,nRecruit)
+    return None
+
+@njit(cache=True)
+def recruitLotteryCell(rowStart,rowEnd,settleCount,Pmax,rng,nRecruit):
+    '''recruitLotteryCell(rowStart,rowEnd,settleCount,Pmax,rng,nRecruit)
+
+    the recruitment lottery of recruitLottery() for the single habitat
+    point whose settlers are entries rowStart:rowEnd of settleCount.
+    returns nothing.
+    '''
+    totalSettle=0
+    for j in range(rowStart,rowEnd):
+        totalSettle+=settleCount[j]
+        nRecruit[j]=0
+
+    if totalSettle<=Pmax:
+        #they all survive
+        for j in range(rowStart,rowEnd):
+            nRecruit[j]=settleCount[j]
+    else:
+        #draw Pmax larvae, one at a time, from those not yet drawn
+        numLeft=totalSettle
+        for k in range(Pmax):
+            pick=int(rng.random()*numLeft)
+            j=rowStart
+            while pick>=settleCount[j]-nRecruit[j]:
+                pick-=settleCount[j]-nRecruit[j]
+                j+=1
+            nRecruit[j]+=1
+            numLeft-=1
+    return None
+
+def recruitDense(whereSettle,Pmax,rng):
+    '''cellVec,speciesVec,nRecruit=recruitDense(whereSettle,Pmax,rng)
+
+    Does the recruitment lottery of recruitLottery() for all the
+    habitat points in the dense (Ndomain,Nspecies) array whereSettle at
+    once. The adults are returned as triplets, so that
+    P[cellVec,speciesVec]=nRecruit puts them into a zeroed P.
+    '''
+    cellVec,speciesVec=nonzero(whereSettle) #row major, so grouped by habitat point
+    settleCount=whereSettle[cellVec,speciesVec]
+    settleIndptr=zeros((whereSettle.shape[0]+1,),dtype=int64)
+    settleIndptr[1:]=cumsum(bincount(cellVec,minlength=whereSettle.shape[0]))
+    nRecruit=zeros(settleCount.shape,dtype=settleCount.dtype)
+    recruitLottery(settleIndptr,settleCount,Pmax,rng,nRecruit)
+    return cellVec,speciesVec,nRecruit
+
+#The sparse population engine. When there are many species, but each
+#habitat point can only hold Pmax adults, a dense (Ndomain,Nspecies)
+#population array is almost all zeros. Instead, the population is
+#stored as "slots": Pspecies[n,k] is the species of the k'th slot of
+#habitat point n, and Pcount[n,k] is how many adults of that species
+#are there, for k in range(Pmax). An empty slot has Pcount==0 and
+#Pspecies==-1. Since a habitat point holds at most Pmax adults, it
+#can hold at most Pmax species, so Pmax slots are always enough. The
+#memory, and the cost of a generation, then scale with the number of
+#individuals and not with Ndomain*Nspecies.
+#
+#Several independent replicates of the model can be run at once, as an
+#ensemble, by stacking them along the habitat axis: the slots are then
+#(nReplicate*Ndomain,Pmax), and row k*Ndomain+n is habitat point n of
+#replicate k. Larvae only travel between habitat points of the same
+#replicate, so the replicates never interact, but the setup and
+#overhead of each generation is shared between them. sparseGeneration()
+#is given one Generator for each replicate, in a numba typed List, and
+#the random numbers of row c come from Generator c//Ndomain. Since each
+#Generator is used, in the same order, only by the rows of its own
+#replicate, each replicate has its own reproducible stream, and its
+#results do not depend on which others it is run with, or whether it
+#is run alone.
+
+def generatorList(rngs):
+    '''rngList=generatorList(rngs)
+
+    the Generators in rngs, one for each replicate, as the numba typed
+    List sparseGeneration() takes
+    '''
+    return List(rngs)
+
+def makeSlots(Ndomain,Pmax,Pdtype='auto'):
+    '''Pspecies,Pcount=makeSlots(Ndomain,Pmax,Pdtype='auto')
+
+    make an empty sparse population, with the counts stored as
+    populationDtype(Pmax,Pdtype)
+    '''
+    Pspecies=full((Ndomain,Pmax),-1,dtype=int32)
+    Pcount=zeros((Ndomain,Pmax),dtype=populationDtype(Pmax,Pdtype))
+    return Pspecies,Pcount
+
+def addToSlots(Pspecies,Pcount,cellVec,speciesVec,numVec):
+    '''addToSlots(Pspecies,Pcount,cellVec,speciesVec,numVec)
+
+    add numVec[j] adults of species speciesVec[j] to habitat point
+    cellVec[j], for all j. Asserts if a habitat point would have more
+    species than slots.
+    '''
+    for n,nsp,num in zip(cellVec,speciesVec,numVec):
+        if num<=0:
+            continue
+        whereSlot=nonzero(Pspecies[n,:]==nsp)[0]
+        if len(whereSlot)==0:
+            whereSlot=nonzero(Pcount[n,:]==0)[0]
+            assert len(whereSlot)>0,'more species at a habitat point than it has slots'
+            Pspecies[n,whereSlot[0]]=nsp
+        checkFits(int(Pcount[n,whereSlot[0]])+num,Pcount.dtype,'the population')
+        Pcount[n,whereSlot[0]]+=num
+    return None
+
+def slotsToDense(Pspecies,Pcount,Nspecies):
+    '''P=slotsToDense(Pspecies,Pcount,Nspecies)
+
+    make the dense (Ndomain,Nspecies) population array from the slots
+    '''
+    P=zeros((Pspecies.shape[0],Nspecies),dtype=Pcount.dtype)
+    cellVec,slotVec=nonzero(Pcount)
+    P[cellVec,Pspecies[cellVec,slotVec]]=Pcount[cellVec,slotVec]
+    return P
+
+def slotsToTriplets(Pspecies,Pcount):
+    '''cellVec,speciesVec,countVec=slotsToTriplets(Pspecies,Pcount)
+
+    the population in the slots as (habitat point,species,number)
+    triplets, one for each species present at each habitat point, in
+    order of habitat point, without making the dense population array
+    '''
+    cellVec,slotVec=nonzero(Pcount)
+    return cellVec,Pspecies[cellVec,slotVec],Pcount[cellVec,slotVec]
+
+def speciesTotals(Pspecies,Pcount,Nspecies,nReplicate=None):
+    '''numBySpecies=speciesTotals(Pspecies,Pcount,Nspecies,nReplicate=None)
+
+    the total population of each species, like P.sum(axis=0). If
+    nReplicate is given, the slots hold an ensemble of nReplicate
+    replicates, and the totals of each replicate are returned as an
+    (nReplicate,Nspecies) array.
+    '''
+    indx=Pcount>0
+    if nReplicate is None:
+        return bincount(Pspecies[indx],weights=Pcount[indx],minlength=Nspecies).astype(int64)
+    whichReplicate=nonzero(indx)[0]//(Pspecies.shape[0]//nReplicate)
+    return bincount(whichReplicate*Nspecies+Pspecies[indx],weights=Pcount[indx],
+                    minlength=nReplicate*Nspecies).astype(int64).reshape((nReplicate,Nspecies))
+
+#do one generation of the sparse engine: disperse the larvae of every
+#occupied slot, as in disperseLarvae(), keeping them as
+#(habitat point,species,count) records instead of adding them into a
+#dense whereSettle; sort the records by habitat point with a counting
+#sort; do the recruitment lottery with recruitLotteryCell(); and put the
+#survivors into new slots.
+@njit(cache=True)
+def sparseGeneration(Pspecies,Pcount,R,Pmax,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,rngList,isActive,
+                     dispersalMode):
+    '''PspeciesNew,PcountNew=sparseGeneration(Pspecies,Pcount,R,Pmax,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,rngList,isActive,dispersalMode)
+
+    the arguments are as for disperseLarvae(), with the population
+    given as slots, which may hold an ensemble of replicates. rngList
+    is a numba typed List of one Generator for each replicate, and
+    isActive a boolean array of whether each replicate is advanced; the
+    population of a replicate which is not active is returned
+    unchanged. Returns the population of the next generation.
+    '''
+    Ndomain=len(EfracReturn)
+    nCell,nSlot=Pspecies.shape
+    nReplicate=nCell//Ndomain
+
+    #how many larvae from each slot survive to settle. Each record holds
+    #at least one larva, so this bounds the number of records. The
+    #rows of each replicate are contiguous, so each replicate's
+    #Generator is fetched once
+    nSurvive=zeros((nCell,nSlot),dtype=int64)
+    nLarvae=0
+    for nRep in range(nReplicate):
+        if not isActive[nRep]:
+            continue
+        rng=rngList[nRep]
+        for n in range(Ndomain):
+            c=nRep*Ndomain+n
+            for k in range(nSlot):
+                if Pcount[c,k]>0:
+                    nSurvive[c,k]=int(floor(rng.random()+R*Pcount[c,k]*EfracReturn[n]))
+                    nLarvae+=nSurvive[c,k]
+
+    #send them to their destinations
+    settleCell=empty((nLarvae,),dtype=int64)
+    settleSpecies=empty((nLarvae,),dtype=Pspecies.dtype)
+    settleCount=empty((nLarvae,),dtype=int64)
+    nRecord=0
+    for nRep in range(nReplicate):
+        if not isActive[nRep]:
+            continue
+        rng=rngList[nRep]
+        replicateStart=nRep*Ndomain #larvae stay in the replicate they came from
+        for n in range(Ndomain):
+            c=replicateStart+n
+            rowStart=Eindptr[n]
+            rowEnd=Eindptr[n+1]
+            for k in range(nSlot):
+                numLeft=nSurvive[c,k]
+                if numLeft==0:
+                    continue
+                nsp=Pspecies[c,k]
+                if (dispersalMode==1) or ((dispersalMode==2) and (numLeft>rowEnd-rowStart)):
+                    #binomial splitting, as in splitLarvae()
+                    weightLeft=0
+                    for j in range(rowStart,rowEnd):
+                        weightLeft+=int(EnumTo[j])
+                    for j in range(rowStart,rowEnd):
+                        if numLeft==0:
+                            break
+                        weight=int(EnumTo[j])
+                        if weight>=weightLeft:
+                            numHere=numLeft
+                        else:
+                            numHere=rng.binomial(numLeft,weight/weightLeft)
+                        if numHere>0:
+                            settleCell[nRecord]=replicateStart+EwhereTo[j]
+                            settleSpecies[nRecord]=nsp
+                            settleCount[nRecord]=numHere
+                            nRecord+=1
+                        numLeft-=numHere
+                        weightLeft-=weight
+                else:
+                    rowCumsum=Ecumsum[rowStart:rowEnd]
+                    for m in range(numLeft):
+                        whereGo=searchsorted(rowCumsum,rng.random())
+                        settleCell[nRecord]=replicateStart+EwhereTo[rowStart+whereGo]
+                        settleSpecies[nRecord]=nsp
+                        settleCount[nRecord]=1
+                        nRecord+=1
+
+    #counting sort of the records by the habitat point they settle in
+    settleIndptr=zeros((nCell+1,),dtype=int64)
+    for j in range(nRecord):
+        settleIndptr[settleCell[j]+1]+=1
+    for c in range(nCell):
+        settleIndptr[c+1]+=settleIndptr[c]
+    fillPtr=settleIndptr[:-1].copy()
+    sortedSpecies=empty((nRecord,),dtype=Pspecies.dtype)
+    sortedCount=empty((nRecord,),dtype=int64)
+    for j in range(nRecord):
+        c=settleCell[j]
+        sortedSpecies[fillPtr[c]]=settleSpecies[j]
+        sortedCount[fillPtr[c]]=settleCount[j]
+        fillPtr[c]+=1
+
+    #which survive, each habitat point with the Generator of its replicate
+    nRecruit=zeros((nRecord,),dtype=int64)
+    for nRep in range(nReplicate):
+        rng=rngList[nRep]
+        for c in range(nRep*Ndomain,(nRep+1)*Ndomain):
+            recruitLotteryCell(settleIndptr[c],settleIndptr[c+1],sortedCount,Pmax,rng,nRecruit)
+
+    #and put them in the slots of the next generation. A species may
+    #have arrived in several records, from different sources, so
+    #combine them
+    PspeciesNew=full((nCell,nSlot),-1,dtype=Pspecies.dtype)
+    PcountNew=zeros((nCell,nSlot),dtype=Pcount.dtype)
+    for c in range(nCell):
+        if not isActive[c//Ndomain]:
+            PspeciesNew[c,:]=Pspecies[c,:]
+            PcountNew[c,:]=Pcount[c,:]
+            continue
+        numUsed=0
+        for j in range(settleIndptr[c],settleIndptr[c+1]):
+            if nRecruit[j]>0:
+                k=0
+                while (k<numUsed) and (PspeciesNew[c,k]!=sortedSpecies[j]):
+                    k+=1
+                if k==numUsed:
+                    PspeciesNew[c,k]=sortedSpecies[j]
+                    numUsed+=1
+                PcountNew[c,k]+=nRecruit[j]
+    return PspeciesNew,PcountNew
+
+#The frontier engine of the two species model in
+#04_twoSpeciesModel_differentR_relativeFitnessDifference.py. Most
+#introductions hold only a few habitat points, and die out in a few
+#generations, but a generation of the dense model costs the same as
+#if both species filled the whole domain. The frontier engine only
+#follows the introduced species (species 0, the invader): its
+#population is kept as the habitat points it holds, invCell, and the
+#number of adults there, invCount. The resident (species 1) is not
+#followed; it is taken to fill everything else, at the level it
+#would have in that generation if there were no invader. A generation then only has to
+#work on the habitat points the invader holds, those its larvae reach,
+#and the habitat points whose larvae could reach those, so its cost
+#scales with the footprint of the invader, not with Ndomain.
+#
+#The resident does not quite fill its habitat, because a habitat
+#point which few larvae reach is sometimes left empty. The number of
+#resident larvae reaching a habitat point is taken to be Poisson, with
+#a mean residentSupply equal to R1 times the mean number of resident
+#adults at each habitat point, times EfracReturn there, times the
+#fraction of the larvae from there which go to this point, summed
+#over all habitat points, and the number of adults is the smaller of
+#that and Pmax. The 04 model starts with the resident filling all of
+#the habitat the invader does not hold, so the resident falls, over
+#some generations, to the level at which this stops changing. Its
+#level in each generation is found once, with residentApproach(), and
+#its final level with residentEquilibrium().
+#
+#Where the invader's larvae settle, the resident larvae competing with
+#them are made as in the dense model, from each habitat point whose
+#larvae can reach there, found from the connectivity in reverse,
+#made by incomingConnectivity(): the residents at that point are drawn
+#as above (but no more than Pmax less the invaders there), and their
+#surviving larvae are stochastically rounded. This is done once per
+#generation for each such point, so the same larvae are shared by all
+#the points they reach, and the number reaching each point where the
+#invader larvae settle is binomial. The recruits
+#are then chosen by lottery from the invader and resident larvae, as
+#in recruitLottery(). The approximation is in drawing the residents
+#from their level without the invader, independently each generation;
+#it ignores that, where the invader has held habitat for a while,
+#fewer residents are left around it. (The numbers reaching the
+#different points from one habitat point are also drawn independently,
+#rather than as one multinomial draw.)
+
+def incomingConnectivity(Eindptr,EwhereTo,EnumTo):
+    '''EinIndptr,EinFrom,EinProb=incomingConnectivity(Eindptr,EwhereTo,EnumTo)
+
+    the connectivity in reverse, in compressed sparse row form: the
+    larvae settling at habitat point n can come from the habitat points
+    EinFrom[EinIndptr[n]:EinIndptr[n+1]], and EinProb is the fraction of
+    the larvae from each of those which go to n.
+    '''
+    Ndomain=len(Eindptr)-1
+    rowOf=repeat(arange(Ndomain,dtype=int32),diff(Eindptr))
+    rowWeight=bincount(rowOf,weights=EnumTo,minlength=Ndomain)
+    rowWeight[rowWeight==0]=1.0 #empty rows, which are not used
+    prob=EnumTo/rowWeight[rowOf]
+    order=argsort(EwhereTo,kind='stable')
+    EinIndptr=zeros((Ndomain+1,),dtype=int64)
+    EinIndptr[1:]=cumsum(bincount(EwhereTo,minlength=Ndomain))
+    return EinIndptr,rowOf[order],prob[order]
+
+@njit(cache=True)
+def residentIteration(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,residentMean,residentSupply):
+    '''change=residentIteration(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,residentMean,residentSupply)
+
+    one generation of the resident alone, on average: residentSupply is
+    set to the mean number of resident larvae reaching each habitat
+    point from residentMean adults, and residentMean to the mean number
+    of adults this leaves. Returns the largest change in residentMean.
+    '''
+    Ndomain=len(EfracReturn)
+    residentSupply[:]=0.0
+    for n in range(Ndomain):
+        rowStart=Eindptr[n]
+        rowEnd=Eindptr[n+1]
+        weightSum=0.0
+        for j in range(rowStart,rowEnd):
+            weightSum+=EnumTo[j]
+        if weightSum==0.0:
+            continue
+        for j in range(rowStart,rowEnd):
+            residentSupply[EwhereTo[j]]+=R1*residentMean[n]*EfracReturn[n]*EnumTo[j]/weightSum
+
+    #the mean of min(Pmax,Poisson(residentSupply))
+    change=0.0
+    for n in range(Ndomain):
+        prob=exp(-residentSupply[n])
+        newMean=float64(Pmax)
+        for k in range(Pmax):
+            newMean-=(Pmax-k)*prob
+            prob*=residentSupply[n]/(k+1)
+        change=max(change,abs(newMean-residentMean[n]))
+        residentMean[n]=newMean
+    return change
+
+@njit(cache=True)
+def residentEquilibrium(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,tolerance=1e-9,maxIter=500):
+    '''residentMean,residentSupply=residentEquilibrium(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,tolerance=1e-9,maxIter=500)
+
+    the mean number of resident adults at each habitat point, and the
+    mean number of resident larvae reaching it, when the resident is
+    alone in the domain; see the description of the frontier engine
+    above. Found by iterating from a full domain until the mean number
+    of adults changes by less than tolerance.
+    '''
+    Ndomain=len(EfracReturn)
+    residentMean=full((Ndomain,),float64(Pmax))
+    residentSupply=zeros((Ndomain,),dtype=float64)
+    for nIter in range(maxIter):
+        if residentIteration(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,residentMean,residentSupply)<tolerance:
+            break
+    return residentMean,residentSupply
+
+def residentApproach(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,tolerance=1e-3,maxIter=500):
+    '''supplyByGeneration=residentApproach(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,tolerance=1e-3,maxIter=500)
+
+    the residentSupply of each generation when the resident starts by
+    filling the domain, as in the 04 model, as a (nGeneration,Ndomain)
+    array; see the description of the frontier engine above. Row nt is
+    the residentSupply to give frontierGeneration() in generation nt.
+    Row 0 is inf, which frontierGeneration() takes to mean the resident
+    fills all the habitat the invader does not hold. The rows stop once
+    the mean number of adults changes by less than tolerance, and the
+    last row is then used for all later generations; see
+    residentSupplyAt().
+    '''
+    Ndomain=len(EfracReturn)
+    residentMean=full((Ndomain,),float64(Pmax))
+    residentSupply=zeros((Ndomain,),dtype=float64)
+    supplyByGeneration=[full((Ndomain,),inf)]
+    for nIter in range(maxIter):
+        change=residentIteration(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo,residentMean,residentSupply)
+        supplyByGeneration.append(residentSupply.copy())
+        if change<tolerance:
+            break
+    return array(supplyByGeneration)
+
+def residentSupplyAt(supplyByGeneration,nt):
+    '''residentSupply=residentSupplyAt(supplyByGeneration,nt)
+
+    the residentSupply of generation nt, from residentApproach()
+    '''
+    return supplyByGeneration[min(nt,supplyByGeneration.shape[0]-1)]
+
+@njit(cache=True)
+def frontierGeneration(invCell,invCount,R0,R1,Pmax,residentSupply,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,
+                       EinIndptr,EinFrom,EinProb,rng,dispersalMode,settleWork,invWork,residentWork):
+    '''invCellNew,invCountNew=frontierGeneration(invCell,invCount,R0,R1,Pmax,residentSupply,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,EinIndptr,EinFrom,EinProb,rng,dispersalMode,settleWork,invWork,residentWork)
+
+    one generation of the frontier engine described above.
+
+    invCell,invCount: the habitat points the invader holds, and the
+       number of adults there
+    R0,R1: the number of larvae produced per adult of the invader and resident
+    residentSupply: from residentSupplyAt(), or residentEquilibrium(R1,Pmax,...).
+       Where it is inf, the resident fills the habitat
+    EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,rng,dispersalMode: as for disperseLarvae()
+    EinIndptr,EinFrom,EinProb: from incomingConnectivity()
+    settleWork,invWork,residentWork: int64 arrays of length Ndomain, all zero.
+       They are used as scratch space, and are returned zeroed, so
+       they can be made once and reused every generation.
+
+    returns the invader's habitat points, in increasing order, and the
+    number of adults there, in the next generation.
+    '''
+    #where the invader is, and where its larvae settle
+    nDestination=0
+    for i in range(len(invCell)):
+        n=invCell[i]
+        invWork[n]=invCount[i]
+        rowStart=Eindptr[n]
+        rowEnd=Eindptr[n+1]
+        nDestination+=rowEnd-rowStart
+
+        nSurvive=int(floor(rng.random()+R0*invCount[i]*EfracReturn[n]))
+        if nSurvive==0:
+            continue
+        if (dispersalMode==1) or ((dispersalMode==2) and (nSurvive>rowEnd-rowStart)):
+            splitLarvae(nSurvive,EwhereTo[rowStart:rowEnd],EnumTo[rowStart:rowEnd],rng,settleWork)
+        else:
+            rowCumsum=Ecumsum[rowStart:rowEnd]
+            for k in range(nSurvive):
+                whereGo=searchsorted(rowCumsum,rng.random())
+                settleWork[EwhereTo[rowStart+whereGo]]+=1
+
+    #gather the habitat points the invader larvae reached, zeroing
+    #settleWork as we go, so each is only gathered once
+    settleCell=empty((nDestination,),dtype=int64)
+    settleCount=empty((nDestination,),dtype=int64)
+    nSettle=0
+    for i in range(len(invCell)):
+        n=invCell[i]
+        for j in range(Eindptr[n],Eindptr[n+1]):
+            d=EwhereTo[j]
+            if settleWork[d]>0:
+                settleCell[nSettle]=d
+                settleCount[nSettle]=settleWork[d]
+                settleWork[d]=0
+                nSettle+=1
+    settleCell=settleCell[:nSettle]
+    settleCount=settleCount[:nSettle]
+    order=argsort(settleCell)
+
+    #at each, make the resident larvae, and choose the recruits. The
+    #surviving resident larvae of each habitat point are made the
+    #first time it is reached, and kept, plus one, in residentWork, so
+    #zero means not yet made; residentCell lists those to zero after
+    nIncoming=0
+    for m in range(nSettle):
+        d=settleCell[m]
+        nIncoming+=EinIndptr[d+1]-EinIndptr[d]
+    residentCell=empty((nIncoming,),dtype=int64)
+    nResidentCell=0
+    invCellNew=empty((nSettle,),dtype=invCell.dtype)
+    invCountNew=empty((nSettle,),dtype=invCount.dtype)
+    nNew=0
+    for m in range(nSettle):
+        d=settleCell[order[m]]
+        numInvader=settleCount[order[m]]
+        numResident=0
+        for j in range(EinIndptr[d],EinIndptr[d+1]):
+            s=EinFrom[j]
+            if residentWork[s]==0:
+                if isinf(residentSupply[s]):
+                    numAdult=Pmax-invWork[s]
+                else:
+                    numAdult=min(rng.poisson(residentSupply[s]),Pmax-invWork[s])
+                nSurvive=0
+                if numAdult>0:
+                    nSurvive=int(floor(rng.random()+R1*numAdult*EfracReturn[s]))
+                residentWork[s]=nSurvive+1
+                residentCell[nResidentCell]=s
+                nResidentCell+=1
+            nSurvive=residentWork[s]-1
+            if nSurvive>0:
+                numResident+=rng.binomial(nSurvive,EinProb[j])
+        if numInvader+numResident<=Pmax:
+            nRecruit=numInvader
+        else:
+            #draw Pmax larvae, one at a time, from those not yet drawn
+            nRecruit=0
+            numLeft=numInvader+numResident
+            for k in range(Pmax):
+                if rng.random()*numLeft<numInvader-nRecruit:
+                    nRecruit+=1
+                numLeft-=1
+        if nRecruit>0:
+            invCellNew[nNew]=d
+            invCountNew[nNew]=nRecruit
+            nNew+=1
+
+    #leave invWork and residentWork zeroed for the next generation
+    for i in range(len(invCell)):
+        invWork[invCell[i]]=0
+    for i in range(nResidentCell):
+        residentWork[residentCell[i]]=0
+    return invCellNew[:nNew],invCountNew[:nNew]
+
+def frontierToDense(invCell,invCount,Ndomain,Pmax,Pdtype,residentSupply=None,rng=None):
+    '''P=frontierToDense(invCell,invCount,Ndomain,Pmax,Pdtype,residentSupply=None,rng=None)
+
+    the (Ndomain,2) population of the two species model, for the
+    invader held by the frontier engine, with the resident filling the
+    rest of the habitat. If residentSupply, as for frontierGeneration(),
+    and the Generator rng are given, the residents are instead drawn at
+    their level, as in frontierGeneration(), but no more than fit
+    beside the invader.
+    '''
+    P=zeros((Ndomain,2),dtype=Pdtype)
+    P[invCell,0]=invCount
+    P[:,1]=Pmax-P[:,0]
+    if residentSupply is not None:
+        isDrawn=~isinf(residentSupply)
+        P[isDrawn,1]=minimum(rng.poisson(residentSupply[isDrawn]),P[isDrawn,1])
+    return P
+
+#Why a run of the two species model stopped: it reached Tmax; the
+#introduced species went extinct; the introduced species fixed, so
+#the native species is gone; or the population of the introduced
+#species stopped changing, see isStationary(). stopReasons maps these
+#names to the codes saved in stopReasonVec in the model output.
+stopReasons={'Tmax':0,'extinct':1,'fixed':2,'stationary':3}
+
+def isStationary(history,window,tolerance,nBatch=10):
+    '''stationary=isStationary(history,window,tolerance,nBatch=10)
+
+    whether the series history, e.g. the population of a species in
+    each generation, has stopped changing. The last window values are
+    split into nBatch batches, and the trend of the batch means is
+    found by least squares; averaging over batches makes the
+    uncertainty of the trend less sensitive to the correlation from
+    one generation to the next. The series is stationary if the change
+    over the window, plus twice its standard error, is less than
+    tolerance times the mean. It is never stationary if it is shorter
+    than window.
+    '''
+    batchLength=window//nBatch
+    if (len(history)<window) or (batchLength==0):
+        return False
+    x=array(history[-nBatch*batchLength:],dtype=float64)
+    batchMean=x.reshape((nBatch,batchLength)).mean(axis=1)
+    t=arange(nBatch)-0.5*(nBatch-1)
+    slope=sum(t*batchMean)/sum(t**2)
+    residual=batchMean-batchMean.mean()-slope*t
+    slopeError=sqrt(sum(residual**2)/(nBatch-2)/sum(t**2))
+    return (abs(slope)+2*slopeError)*nBatch<tolerance*x.mean()
+
+def didPersist(modelOutput,Tmax):
+    '''persisted=didPersist(modelOutput,Tmax)
+
+    whether the introduction into each region persisted, in the
+    output of a run of
+    04_twoSpeciesModel_differentR_relativeFitnessDifference.py, as
+    loaded by zarr.load(). An introduction persisted if its run
+    reached Tmax, or stopped because the introduced species fixed,
+    since it can not go extinct after that. A run which stopped
+    because it was stationary could still have gone extinct before
+    Tmax, so it did not persist; see didStopStationary(). Output
+    written before runs could stop early, which has no stopReasonVec,
+    only stopped early on extinction, so there an introduction
+    persisted if its run reached Tmax.
+    '''
+    if 'stopReasonVec' in modelOutput:
+        stopReasonVec=modelOutput['stopReasonVec']
+        return (stopReasonVec==stopReasons['Tmax'])|(stopReasonVec==stopReasons['fixed'])
+    return modelOutput['ntVecFinal']==Tmax-1
+
+def didStopStationary(modelOutput):
+    '''stationary=didStopStationary(modelOutput)
+
+    whether the run of the introduction into each region stopped
+    because its population had stopped changing (see isStationary()),
+    in the output of a run of
+    04_twoSpeciesModel_differentR_relativeFitnessDifference.py, as
+    loaded by zarr.load(). These runs neither persisted to Tmax nor
+    went extinct, so they are counted separately.
+    '''
+    if 'stopReasonVec' in modelOutput:
+        return modelOutput['stopReasonVec']==stopReasons['stationary']
+    return zeros(modelOutput['ntVecFinal'].shape,dtype=bool)
+
+def balancedChunks(weights,nChunks):
+    '''chunkList=balancedChunks(weights,nChunks)
+
+    Split the indices of weights into at most nChunks chunks of
+    consecutive indices, each with roughly the same total weight, for
+    handing out to the workers of a multiprocessing pool. Indices with
+    zero weight (e.g. extinct species) are left out. The chunks are
+    returned as a list of index arrays, the heaviest first, so the
+    longest jobs are started first.
+    '''
+    indx=nonzero(weights>0)[0]
+    if len(indx)==0:
+        return []
+    w=weights[indx].astype(float64)
+    cumWeight=cumsum(w)
+
+    #each index goes in the chunk its weight is centered in
+    chunkId=minimum(floor((cumWeight-0.5*w)*nChunks/cumWeight[-1]).astype(int64),nChunks-1)
+    chunkList=split(indx,nonzero(diff(chunkId))[0]+1)
+
+    chunkWeight=array([weights[c].sum() for c in chunkList])
+    return [chunkList[n] for n in argsort(-chunkWeight,kind='stable')]
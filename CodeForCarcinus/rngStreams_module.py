@@ -0,0 +1,73 @@
+from numpy import *
+import numpy as np
+
+# This module gives the population models in
+# 02_manyNeutralSpecies_fastModel.py and
+# 04_twoSpeciesModel_differentR_relativeFitnessDifference.py
+# reproducible streams of random numbers. Everything random in a model
+# run is drawn from a stream made from a single seed and a key, such
+# as (what the stream is for, run number, generation, species), with
+# numpy's SeedSequence. SeedSequence(seed,spawn_key=key) is the same
+# SeedSequence that SeedSequence(seed).spawn() would give after
+# spawning down the levels of key, so the streams are statistically
+# independent of each other, but any one of them can be made directly,
+# in any process, without making the others first.
+#
+# Because the key of a stream names the piece of the model it is used
+# for, and not the worker process or job which happens to do that
+# piece, the results of a model run depend only on the seed. They are
+# the same no matter how many processes are used, or how the work is
+# split between them, and a model run can be repeated by running it
+# again with the seed saved in its output.
+
+#what a stream is used for; the first entry of its key
+initialStream=0    #placing the introduced individuals
+dispersalStream=1  #dispersing the larvae of a species
+recruitStream=2    #choosing the recruits in a block of habitat points
+generationStream=3 #a whole generation of the sparse engine
+modelStream=4      #all of a model run in 04_twoSpeciesModel_differentR_relativeFitnessDifference.py
+
+#the recruits are chosen in blocks of cellsPerStream habitat points,
+#each with its own stream, and the work is split between processes in
+#whole blocks; see blockChunks()
+cellsPerStream=4096
+
+def makeSeed(seed=None):
+    '''seed=makeSeed(seed=None)
+
+    the seed from which all the streams of a model run are made. If
+    seed is None, a new seed is picked from the entropy of the
+    operating system, so it should be saved to repeat the run. The
+    seed is kept below 2**63 so it can be saved as an int64.
+    '''
+    if seed is None:
+        seed=np.random.SeedSequence().entropy%2**63
+    return int(seed)
+
+def streamSeed(seed,*key):
+    '''seedSequence=streamSeed(seed,*key)
+
+    the SeedSequence of the stream named by key, a series of
+    non-negative integers. It can be passed to another process, and
+    made into a Generator there with np.random.default_rng()
+    '''
+    return np.random.SeedSequence(seed,spawn_key=tuple(int(k) for k in key))
+
+def streamRng(seed,*key):
+    '''rng=streamRng(seed,*key)
+
+    a numpy Generator for the stream named by key; see streamSeed()
+    '''
+    return np.random.default_rng(streamSeed(seed,*key))
+
+def blockChunks(Ndomain,nChunks):
+    '''chunkVec=blockChunks(Ndomain,nChunks)
+
+    split the habitat points range(Ndomain) into at most nChunks
+    chunks of whole blocks of cellsPerStream points, so that chunk n is
+    chunkVec[n]:chunkVec[n+1]. Because each block has its own stream,
+    the recruits chosen do not depend on nChunks.
+    '''
+    nBlock=(Ndomain+cellsPerStream-1)//cellsPerStream
+    chunkVec=unique(linspace(0,nBlock,min(nChunks,nBlock)+1).astype(int))*cellsPerStream
+    return minimum(chunkVec,Ndomain)
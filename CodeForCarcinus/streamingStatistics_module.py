@@ -0,0 +1,303 @@
+from numpy import *
+import numpy as np
+import zarr
+import os
+import time
+from multiprocessing.pool import ThreadPool
+import outputStore_module as osm
+import populationKernels_module as pkm
+
+# This module computes the statistics of persistence used by the
+# analysis codes (03_*.py and 05_*.py) from the output of many model
+# runs, without holding more than a few runs in memory at once. Each
+# run is read, and reduced to a few vectors with one value for each
+# species or region (e.g. whether the species introduced into a region
+# is present at the end of the run), by a pool of threads, and the
+# vectors are added into an accumulator, which keeps, for each
+# statistic, its sum and the sum of its square over the runs read so
+# far. From these come the mean over the runs, and a confidence interval
+# for it, at any time.
+#
+# Threads are used, rather than processes, because the time goes into
+# reading and decompressing the output, which release the GIL, and
+# threads can be used from the analysis codes, which are plain scripts
+# with no "if __name__=='__main__':" guard.
+#
+# watchRuns() keeps reducing the runs as they are saved, so the
+# statistics can be followed while the model is still running.
+#
+# Where the output is is described by a source, made by
+# neutralSource() or fitnessSource(), with the same parameters the
+# analysis codes use to find it.
+
+#the statistics which are 0 or 1 in each run, whose confidence
+#intervals are those of a proportion
+proportionStatistics=('isPresent','persisted','stationary')
+
+def neutralSource(outputFormat,ConnectivityModelName,R,Pmax,Nintro,Tmax):
+    '''source=neutralSource(outputFormat,ConnectivityModelName,R,Pmax,Nintro,Tmax)
+
+    the snapshots at generation Tmax of the runs of
+    02_manyNeutralSpecies_fastModel.py with these parameters, saved in
+    outputFormat 'store' or 'zip'. A run with no snapshot at Tmax is
+    counted as one in which all the introduced species went extinct.
+    With outputFormat='zip' there is no way to tell such a run from one
+    which has not finished, so every run is counted as soon as the
+    statistics are computed, and watchRuns() needs outputFormat='store'.
+    '''
+    if outputFormat=='store':
+        storeName=osm.neutralStoreName(ConnectivityModelName,R,Pmax,Nintro)
+    else:
+        storeName=None
+    return {'model':'neutral','outputFormat':outputFormat,'storeName':storeName,'Tmax':Tmax,
+            'fileName':('modelOutputNeutral/manySpecies_'+ConnectivityModelName
+                        +'_Params_R_%2.2d_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d'%(R,Tmax,Pmax,Nintro)+'_nRun%d.zip')}
+
+def fitnessSource(outputFormat,ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro):
+    '''source=fitnessSource(outputFormat,ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro)
+
+    the runs of 04_twoSpeciesModel_differentR_relativeFitnessDifference.py
+    with these parameters, saved in outputFormat 'store' or 'zip'
+    '''
+    if outputFormat=='store':
+        storeName=osm.fitnessStoreName(ConnectivityModelName,R0,R1,Tmax,Pmax,Nintro)
+    else:
+        storeName=None
+    if Nintro<=0:
+        fileName=('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
+                  +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d'%(R0,R1,Tmax,Pmax)+'_nRun%d.zip')
+    else:
+        fileName=('modelOutputRelativeFitness/twoSpecies_'+ConnectivityModelName
+                  +'_Params_R0_%2.4f_R1_%2.4f_Tmax%3.3d_Pmax%2.2d_Nintro%2.2d'%(R0,R1,Tmax,Pmax,Nintro)
+                  +'_nRun%d.zip')
+    return {'model':'fitness','outputFormat':outputFormat,'storeName':storeName,'Tmax':Tmax,'fileName':fileName}
+
+def openSource(source):
+    '''store=openSource(source)
+
+    open the store of source for reading, or None if its output is in
+    zip files. It is opened again each time, so it sees runs saved since
+    it was last opened.
+    '''
+    if source['outputFormat']=='zip':
+        return None
+    return zarr.open_group(source['storeName'],mode='r')
+
+def isRunReady(source,store,nR):
+    '''isReady=isRunReady(source,store,nR)
+
+    True if run nR of source has finished, and can be read
+    '''
+    if source['model']=='neutral':
+        if store is None:
+            return True
+        return osm.isNeutralRunFinished(store,nR)
+    if store is None:
+        return os.path.exists(source['fileName']%nR)
+    return osm.hasFitnessRun(store,nR)
+
+def loadCoordinates(source,runList):
+    '''lonVec,latVec=loadCoordinates(source,runList)
+
+    the longitude and latitude of the habitat points of source, from
+    its store, or from the file of the first run in runList which has one
+    '''
+    store=openSource(source)
+    if store is not None:
+        return store['lonVec'][:],store['latVec'][:]
+    for nR in runList:
+        if os.path.exists(source['fileName']%nR):
+            jnk=zarr.load(source['fileName']%nR)
+            return jnk['lonVec'],jnk['latVec']
+    assert False,'Error, there was no ouput for any model run'
+
+def neutralRunStatistics(jnk,speciesList):
+    '''stats=neutralRunStatistics(jnk,speciesList)
+
+    reduce the snapshot jnk of a run of the neutral model, with the
+    population as triplets (see osm.loadNeutralSnapshot()), to
+       totalPop: the population of each species
+       isPresent: 1 if the species exists anywhere, and 0 if not
+       popInIntroRegion: the population of each species in the region
+          it was introduced into, where speciesList is the region of
+          each habitat point
+    '''
+    Nspecies=jnk['shapeP'][1]
+    cellVec=jnk['cellVec']; speciesVec=jnk['speciesVec']; countVec=jnk['countVec'].astype(int64)
+    totalPop=bincount(speciesVec,weights=countVec,minlength=Nspecies).astype(int64)
+    inRegion=speciesList[cellVec]==speciesVec
+    popInIntroRegion=bincount(speciesVec[inRegion],weights=countVec[inRegion],minlength=Nspecies).astype(int64)
+    return {'totalPop':totalPop,'isPresent':(totalPop>0).astype(int64),'popInIntroRegion':popInIntroRegion}
+
+def fitnessRunStatistics(jnk,speciesList,Tmax):
+    '''stats=fitnessRunStatistics(jnk,speciesList,Tmax)
+
+    reduce run jnk of the two species model to
+       persisted: 1 if the introduction into each region persisted
+          (see pkm.didPersist()), and 0 if not
+       stationary: 1 if the run of the introduction into each region
+          stopped because it was stationary (see pkm.didStopStationary()),
+          and 0 if not; these are neither persisted nor extinct
+       ntVecRun: the number of generations each introduction lasted,
+          counting those which persisted as lasting until Tmax
+       finalPopInRegion: the average final population of each
+          introduced species over the region it was introduced into
+    '''
+    persisted=pkm.didPersist(jnk,Tmax)
+    stationary=pkm.didStopStationary(jnk)
+    ntVecRun=where(persisted,Tmax-1,jnk['ntVecFinal'])
+    finalPopVec=jnk['finalPopVec']
+    Nregions=finalPopVec.shape[1]
+    popInRegion=finalPopVec[arange(len(speciesList)),speciesList].astype(float64)
+    finalPopInRegion=(bincount(speciesList,weights=popInRegion,minlength=Nregions)
+                      /bincount(speciesList,minlength=Nregions))
+    return {'persisted':persisted.astype(int64),'stationary':stationary.astype(int64),
+            'ntVecRun':ntVecRun.astype(int64),
+            'finalPopInRegion':finalPopInRegion}
+
+def loadRunStatistics(source,store,nR,speciesList):
+    '''stats=loadRunStatistics(source,store,nR,speciesList)
+
+    read run nR of source, and reduce it with neutralRunStatistics()
+    or fitnessRunStatistics(). For the neutral model, a run with no
+    snapshot at Tmax gives an empty dictionary, since all of its
+    statistics are zero.
+    '''
+    Tmax=source['Tmax']
+    if source['model']=='neutral':
+        if store is None:
+            fileName=source['fileName']%nR
+            if not os.path.exists(fileName):
+                return {}
+            P=zarr.load(fileName)['P']
+            jnk=dict(zip(('cellVec','speciesVec','countVec'),osm.denseToTriplets(P)))
+            jnk['shapeP']=P.shape
+        else:
+            jnk=osm.loadNeutralSnapshot(store,nR,Tmax,asSparse=True)
+            if jnk is None:
+                return {}
+        return neutralRunStatistics(jnk,speciesList)
+    if store is None:
+        jnk=zarr.load(source['fileName']%nR)
+    else:
+        jnk=osm.loadFitnessRun(store,nR)
+    return fitnessRunStatistics(jnk,speciesList,Tmax)
+
+def makeAccumulator():
+    '''acc=makeAccumulator()
+
+    an empty accumulator of the statistics of runs
+    '''
+    return {'nRun':0,'runs':set(),'sum':{},'sumSq':{}}
+
+def addRun(acc,nR,stats):
+    '''addRun(acc,nR,stats)
+
+    add the statistics of run nR to the accumulator acc
+    '''
+    acc['nRun']+=1
+    acc['runs'].add(nR)
+    for name,value in stats.items():
+        if name not in acc['sum']:
+            acc['sum'][name]=zeros(value.shape,dtype=value.dtype)
+            acc['sumSq'][name]=zeros(value.shape,dtype=float64)
+        acc['sum'][name]+=value
+        acc['sumSq'][name]+=value.astype(float64)**2
+    return None
+
+def reduceRuns(source,runList,speciesList,nThread=None,acc=None):
+    '''acc=reduceRuns(source,runList,speciesList,nThread=None,acc=None)
+
+    add to the accumulator acc (or a new one, if acc is None) the
+    statistics of the runs in runList which have finished, and are not
+    already in acc, reading them with a pool of nThread threads
+    (os.cpu_count() if None). Each thread holds one run at a time.
+    '''
+    if acc is None:
+        acc=makeAccumulator()
+    #the store is not made until the model has started
+    if (source['outputFormat']=='store') and (not os.path.exists(source['storeName'])):
+        return acc
+    store=openSource(source)
+    readyList=[nR for nR in runList if (nR not in acc['runs']) and isRunReady(source,store,nR)]
+    if len(readyList)==0:
+        return acc
+
+    def runStatistics(nR):
+        return nR,loadRunStatistics(source,store,nR,speciesList)
+
+    with ThreadPool(nThread) as pool:
+        for nR,stats in pool.imap_unordered(runStatistics,readyList):
+            addRun(acc,nR,stats)
+    return acc
+
+def watchRuns(source,runList,speciesList,callback=None,interval=60.0,nThread=None,acc=None):
+    '''acc=watchRuns(source,runList,speciesList,callback=None,interval=60.0,nThread=None,acc=None)
+
+    reduce the runs in runList as they are saved, looking for new runs
+    every interval seconds, and calling callback(acc) each time some
+    are added, until all of runList has been read, or the watching is
+    stopped with control-C. Returns the accumulator.
+    '''
+    if acc is None:
+        acc=makeAccumulator()
+    try:
+        while True:
+            nRead=acc['nRun']
+            acc=reduceRuns(source,runList,speciesList,nThread,acc)
+            if (acc['nRun']>nRead) and (callback is not None):
+                callback(acc)
+            if len(acc['runs'])>=len(runList):
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print('stopped watching after',acc['nRun'],'runs')
+    return acc
+
+def runMean(acc,name):
+    '''meanVec=runMean(acc,name)
+
+    the mean over the runs read of the statistic name; for
+    proportionStatistics, the fraction of the runs in which it was 1
+    '''
+    assert acc['nRun']>0,'Error, there was no ouput for any model run'
+    if name not in acc['sum']:
+        return 0.0 #every run read had no snapshot, so all the statistics are zero
+    return acc['sum'][name]/acc['nRun']
+
+def confidenceInterval(acc,name,z=1.96):
+    '''lowVec,highVec=confidenceInterval(acc,name,z=1.96)
+
+    the confidence interval of runMean(acc,name); z=1.96 gives the 95%
+    interval. For proportionStatistics it is the Wilson score interval,
+    which behaves well when the fraction is near 0 or 1, or there are
+    few runs; otherwise it is the normal approximation, from the
+    variance of the statistic between runs.
+    '''
+    n=acc['nRun']
+    meanVec=runMean(acc,name)
+    if name in proportionStatistics:
+        center=(meanVec+z**2/(2*n))/(1+z**2/n)
+        halfWidth=z*sqrt(meanVec*(1-meanVec)/n+z**2/(4*n**2))/(1+z**2/n)
+    else:
+        if name in acc['sumSq']:
+            variance=maximum(acc['sumSq'][name]-n*meanVec**2,0.0)/max(n-1,1)
+        else:
+            variance=0.0
+        center=meanVec
+        halfWidth=z*sqrt(variance/n)
+    return center-halfWidth,center+halfWidth
+
+def printSummary(acc,name):
+    '''printSummary(acc,name)
+
+    print the number of runs read, and the mean of the statistic name
+    over all the species or regions, with the widest 95% interval of
+    any of them. Use as the callback of watchRuns(), e.g. with
+    lambda acc: printSummary(acc,'persisted')
+    '''
+    meanVec=runMean(acc,name)
+    lowVec,highVec=confidenceInterval(acc,name)
+    print('   %d runs read; the average of %s is %8.4f, and its widest 95%% interval is %8.4f'
+          %(acc['nRun'],name,mean(meanVec),amax(highVec-lowVec)),flush=True)
+    return None
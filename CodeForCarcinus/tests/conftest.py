@@ -0,0 +1,65 @@
+import os
+import sys
+import shutil
+import atexit
+import tempfile
+import numpy as np
+import netCDF4 as nc
+import pytest
+
+# The tests compare the fast code with the old code it replaced, or
+# with what it should give on average, on small synthetic connectivity
+# matrices. They are run from the CodeForCarcinus directory with
+#
+#    python -m pytest tests
+#
+# The modules find the model grid through getEZfateFromOSN, which
+# downloads it into OSNdataDir if it is not there. So that the tests
+# do not download anything, or touch the data in OSNdataDir, the
+# getEZfateFromOSN cache is pointed at a temporary directory holding a
+# small synthetic model grid, of nxGrid by nyGrid points, before any of
+# the modules are imported.
+
+codeDir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,codeDir)
+import getEZfateFromOSN
+
+nxGrid=90
+nyGrid=70
+
+def makeSyntheticGrid(dataCacheDir):
+    '''makeSyntheticGrid(dataCacheDir)
+
+    write a small model grid, with the nav_lon, nav_lat and hdepw
+    variables the modules read, where getEZfateFromOSN will find it in
+    dataCacheDir, and make the directory of connectivity matrices. The
+    water is land west of nx=20, and deepens to the east.
+    '''
+    gridDir=os.path.join(dataCacheDir,'EZfateData/EZfateFiles')
+    os.makedirs(gridDir)
+    os.makedirs(os.path.join(dataCacheDir,'EZfateData/communityConnectivityMatrices'))
+    with nc.Dataset(os.path.join(gridDir,'ext-PSY4V3R1_mesh_zgr.nc'),'w') as gridData:
+        gridData.createDimension('t',1)
+        gridData.createDimension('y',nyGrid)
+        gridData.createDimension('x',nxGrid)
+        lon,lat=np.meshgrid(np.linspace(-80.0,-50.0,nxGrid),np.linspace(30.0,55.0,nyGrid))
+        gridData.createVariable('nav_lon','f4',('y','x'))[:]=lon
+        gridData.createVariable('nav_lat','f4',('y','x'))[:]=lat
+        depth=np.zeros((nyGrid,nxGrid))
+        depth[:,20:]=(np.arange(20,nxGrid)-19)*5.0
+        gridData.createVariable('hdepw','f4',('t','y','x'))[0,:,:]=depth
+    return None
+
+testDataDir=tempfile.mkdtemp(prefix='CodeForCarcinusTests_')
+atexit.register(shutil.rmtree,testDataDir,ignore_errors=True)
+getEZfateFromOSN.dataCacheDir=os.path.join(testDataDir,'OSNdataDir')+os.sep
+makeSyntheticGrid(getEZfateFromOSN.dataCacheDir)
+
+@pytest.fixture
+def workDir(tmp_path,monkeypatch):
+    '''run the test in an empty directory, with the output directories
+    the model scripts expect, so files they write are thrown away'''
+    for dirName in ('modelOutputNeutral','modelOutputRelativeFitness','transposes'):
+        (tmp_path/dirName).mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,117 @@
+from numpy import *
+import numpy as np
+import zarr
+import makeConnectivityModule as mcm
+
+# Small random connectivity matrices, and the linear model made from
+# them, for the tests. They have the same layout and dtypes as the
+# matrices made by 00_makeConnectivityMatrices_trimByDepth.py, but the
+# starting points, and the destinations of each row, are drawn at
+# random from a window of the grid.
+
+def randomConnectivity(rng,nRow,nxRange,nyRange,maxLen=30,emptyFrac=0.05,store=None,numberOfStartingTimes=3,
+                       chunkSize=256):
+    '''C=randomConnectivity(rng,nRow,nxRange,nyRange,maxLen=30,emptyFrac=0.05,store=None,numberOfStartingTimes=3,chunkSize=256)
+
+    a connectivity matrix of nRow distinct starting points, drawn from
+    the grid points nxRange x nyRange (each a (start,stop) pair), each
+    with up to maxLen destinations within the same ranges. A fraction
+    emptyFrac of the rows have no destinations. It is made in store, or
+    in memory if store is None, with its arrays chunked in chunkSize
+    rows (a zarr chunk of ragged rows is slow to read unless it is
+    small), and has numLaunched.
+    '''
+    if store is None:
+        store=zarr.MemoryStore()
+    nxPool=arange(*nxRange); nyPool=arange(*nyRange)
+    allPoints=rng.choice(len(nxPool)*len(nyPool),nRow,replace=False)
+    nxFrom=nxPool[allPoints//len(nyPool)].astype(mcm.coordType)
+    nyFrom=nyPool[allPoints%len(nyPool)].astype(mcm.coordType)
+    nxTo=empty((nRow,),dtype=object); nyTo=empty((nRow,),dtype=object); numTo=empty((nRow,),dtype=object)
+    for n in range(nRow):
+        nTo=(0 if rng.random()<emptyFrac else int(rng.integers(1,maxLen)))
+        toPoints=rng.choice(len(nxPool)*len(nyPool),nTo,replace=False)
+        nxTo[n]=nxPool[toPoints//len(nyPool)].astype(mcm.coordType)
+        nyTo[n]=nyPool[toPoints%len(nyPool)].astype(mcm.coordType)
+        numTo[n]=rng.integers(1,50,nTo).astype(mcm.typeOfSum)
+
+    C=mcm.makeEmptyConnectivity(store,chunkSize)
+    mcm.writeFlatConnectivity(C,mcm.grid2int(nxFrom,nyFrom),array([len(p) for p in numTo],dtype=int64),
+                              mcm.grid2int(concatenate(list(nxTo)),concatenate(list(nyTo))),
+                              concatenate(list(numTo)))
+    numLaunched=array([p.sum() for p in numTo],dtype=int64)+rng.integers(0,30,nRow)
+    C.array('numLaunched',numLaunched.astype('i4'))
+    C.attrs['numberOfStartingTimes']=numberOfStartingTimes
+    return C
+
+def randomTransposeFile(rng,fileName,nRow,nxRange,nyRange,maxLen=12):
+    '''randomTransposeFile(rng,fileName,nRow,nxRange,nyRange,maxLen=12)
+
+    write, into the zarr directory fileName, a connectivity matrix
+    which, like those the models read, only has destinations which are
+    also starting points. Some rows have no destinations, and some of
+    those have no larvae launched.
+    '''
+    C=randomConnectivity(rng,nRow,nxRange,nyRange,maxLen=1,emptyFrac=1.0,store=zarr.DirectoryStore(fileName))
+    nxFrom=C['nxFrom'][:]; nyFrom=C['nyFrom'][:]
+    nxTo=empty((nRow,),dtype=object); nyTo=empty((nRow,),dtype=object); numTo=empty((nRow,),dtype=object)
+    for n in range(nRow):
+        whereTo=rng.choice(nRow,int(rng.integers(0,maxLen)),replace=False)
+        nxTo[n]=nxFrom[whereTo]; nyTo[n]=nyFrom[whereTo]
+        numTo[n]=rng.integers(1,50,len(whereTo)).astype(mcm.typeOfSum)
+    C['nxTo'][:]=nxTo; C['nyTo'][:]=nyTo; C['numTo'][:]=numTo
+    numLaunched=array([p.sum() for p in numTo],dtype=int64)+rng.integers(0,30,nRow)
+    isEmpty=array([len(p)==0 for p in numTo])
+    numLaunched[isEmpty&(rng.random(nRow)<0.5)]=0
+    C['numLaunched'][:]=numLaunched.astype('i4')
+    return None
+
+def randomCSR(rng,Ndomain,maxLen=8,fracReturn=0.3):
+    '''EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=randomCSR(rng,Ndomain,maxLen=8,fracReturn=0.3)
+
+    a random linear model in compressed sparse row form, as made by
+    createLinearModel_module.makeLinearModel(EfileName,returnCSR=True).
+    Every habitat point has at least one destination.
+    '''
+    rowLength=rng.integers(1,maxLen,Ndomain)
+    Eindptr=zeros((Ndomain+1,),dtype=int64)
+    Eindptr[1:]=cumsum(rowLength)
+    EwhereTo=rng.integers(0,Ndomain,Eindptr[-1]).astype(int32)
+    EnumTo=rng.integers(1,50,Eindptr[-1]).astype(uint16)
+    Ecumsum=zeros((Eindptr[-1],))
+    for n in range(Ndomain):
+        row=slice(Eindptr[n],Eindptr[n+1])
+        Ecumsum[row]=cumsum(EnumTo[row])/sum(EnumTo[row])
+    EfracReturn=rng.random(Ndomain)*fracReturn
+    return EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo
+
+def expectedSettlers(Pcol,R,EfracReturn,Eindptr,EwhereTo,EnumTo):
+    '''meanSettle=expectedSettlers(Pcol,R,EfracReturn,Eindptr,EwhereTo,EnumTo)
+
+    the mean number of larvae of a species with population Pcol which
+    settle at each habitat point, R*Pcol*EfracReturn times the
+    fraction of the larvae of each point going to each destination
+    '''
+    Ndomain=len(EfracReturn)
+    rowOf=repeat(arange(Ndomain),diff(Eindptr))
+    rowWeight=bincount(rowOf,weights=EnumTo,minlength=Ndomain)
+    return bincount(EwhereTo,weights=(R*Pcol*EfracReturn)[rowOf]*EnumTo/rowWeight[rowOf],minlength=Ndomain)
+
+def sameConnectivity(A,B):
+    '''isSame=sameConnectivity(A,B)
+
+    True if the connectivity matrices A and B have the same arrays,
+    with the same values and dtypes, row by row, and the same attributes
+    '''
+    if (sorted(A.array_keys())!=sorted(B.array_keys())) or (dict(A.attrs)!=dict(B.attrs)):
+        return False
+    for name in A.array_keys():
+        a=A[name][:]; b=B[name][:]
+        if (len(a)!=len(b)) or (a.dtype!=b.dtype):
+            return False
+        if a.dtype==object:
+            if not all([array_equal(p,q) and (p.dtype==q.dtype) for p,q in zip(a,b)]):
+                return False
+        elif not array_equal(a,b):
+            return False
+    return True
@@ -0,0 +1,82 @@
+from numpy import *
+import numpy as np
+import os
+import createLinearModel_module as cLM
+import syntheticData_module as sdm
+
+# The compressed sparse row (CSR) form of the linear model, and the
+# array and cached ways of making it, are checked against the old
+# dictionary code of makeLinearModel(EfileName,useDicts=True).
+
+def test_packCSR_roundTrip():
+    rng=np.random.default_rng(1)
+    rowLength=rng.integers(0,6,50)
+    EwhereTo=empty((50,),dtype=object); EnumTo=empty((50,),dtype=object)
+    for n in range(50):
+        EwhereTo[n]=rng.integers(0,50,rowLength[n])
+        EnumTo[n]=rng.integers(1,50,rowLength[n]).astype(uint16)
+    Eindptr,EwhereToFlat,EnumToFlat,EcumsumFlat=cLM.packCSR(EwhereTo,EnumTo)
+    assert array_equal(diff(Eindptr),rowLength)
+    for old,flat in ((EwhereTo,EwhereToFlat),(EnumTo,EnumToFlat)):
+        new=cLM.unpackCSR(Eindptr,flat)
+        assert all([array_equal(p,q) for p,q in zip(old,new)])
+    for n,Ecumsum in enumerate(cLM.unpackCSR(Eindptr,EcumsumFlat)):
+        if rowLength[n]>0:
+            assert allclose(Ecumsum,cumsum(EnumTo[n])/sum(EnumTo[n]),rtol=0,atol=1e-12)
+            assert Ecumsum[-1]==1.0
+
+def test_packCSR_empty():
+    EwhereTo=empty((3,),dtype=object); EnumTo=empty((3,),dtype=object)
+    for n in range(3):
+        EwhereTo[n]=zeros((0,),dtype=int64); EnumTo[n]=zeros((0,),dtype=uint16)
+    Eindptr,EwhereToFlat,EnumToFlat,EcumsumFlat=cLM.packCSR(EwhereTo,EnumTo)
+    assert array_equal(Eindptr,zeros((4,))) and len(EwhereToFlat)==0 and len(EcumsumFlat)==0
+
+def makeTransposeFile(seed=2):
+    EfileName=os.path.join('transposes','E_test.zarr')
+    sdm.randomTransposeFile(np.random.default_rng(seed),EfileName,300,(25,60),(10,50))
+    return EfileName
+
+def sameLinearModel(old,new):
+    '''compare two results of makeLinearModel(...,returnCSR=True)'''
+    EwhereTo,EnumTo,EfracReturn,Ecumsum,Eindptr,nxny2nlin,nlin2nxny,nxny2lonLat,nlin2lonLat=old
+    assert array_equal(Eindptr,new[4])
+    assert array_equal(EwhereTo,new[0]) and array_equal(EnumTo,new[1])
+    assert array_equal(EfracReturn,new[2])
+    assert allclose(Ecumsum,new[3],rtol=0,atol=1e-12)
+    for key in nxny2nlin:
+        assert nxny2nlin[key]==new[5][key]
+        assert tuple(nxny2lonLat[key])==tuple(new[7][key])
+    for n in range(len(EfracReturn)):
+        assert tuple(nlin2nxny[n])==tuple(new[6][n])
+        assert tuple(nlin2lonLat[n])==tuple(new[8][n])
+    return True
+
+def test_makeLinearModel_arraysMatchDicts(workDir):
+    EfileName=makeTransposeFile()
+    old=cLM.makeLinearModel(EfileName,returnCSR=True,useDicts=True)
+    assert sameLinearModel(old,cLM.makeLinearModel(EfileName,returnCSR=True,useDicts=False))
+
+    #and the ragged form is the CSR form split into rows
+    ragged=cLM.makeLinearModel(EfileName,returnCSR=False,useDicts=False)
+    for flat,rows in ((old[0],ragged[0]),(old[1],ragged[1])):
+        assert all([array_equal(p,q) for p,q in zip(cLM.unpackCSR(old[4],flat),rows)])
+
+def test_makeLinearModel_cacheMatchesDicts(workDir):
+    EfileName=makeTransposeFile()
+    old=cLM.makeLinearModel(EfileName,returnCSR=True,useDicts=True)
+    assert not cLM.isLinearModelCacheGood(EfileName)
+    assert sameLinearModel(old,cLM.makeLinearModel(EfileName,returnCSR=True,useDicts=False,useCache=True))
+    assert cLM.isLinearModelCacheGood(EfileName)
+    assert sameLinearModel(old,cLM.makeLinearModel(EfileName,returnCSR=True,useDicts=False,useCache=True))
+
+def test_linearModelCache_rebuiltWhenMaskChanges(workDir):
+    EfileName=makeTransposeFile()
+    cLM.writeLinearModelCache(EfileName)
+    assert cLM.isLinearModelCacheGood(EfileName)
+    maskTime=os.stat(cLM.maskFile).st_mtime
+    try:
+        os.utime(cLM.maskFile,(maskTime+10.0,maskTime+10.0))
+        assert not cLM.isLinearModelCacheGood(EfileName)
+    finally:
+        os.utime(cLM.maskFile,(maskTime,maskTime))
@@ -0,0 +1,603 @@
+from numpy import *
+import numpy as np
+import os
+import time
+import copy
+import zarr
+import numcodecs
+import netCDF4 as nc
+from shapely.geometry import MultiPoint
+from shapely.geometry.polygon import Polygon
+import pytest
+import makeConnectivityModule as mcm
+import syntheticData_module as sdm
+
+# The array code which combines and trims connectivity matrices is
+# checked against the old row by row code, which is kept here as the
+# *_rowByRow() functions, on random matrices. The results should be
+# identical, row for row.
+
+nxRange=(25,60)
+nyRange=(10,50)
+
+def combineConnectivity_rowByRow(A,B,runFast=True):
+    '''combineConnectivity_rowByRow(A,B,runFast=True)
+
+    connectivity matrix B is added to connectivity in A. To combine
+    many matrices, start with A as an empty matrix defined by
+    makeEmptyConnectivity(), and keep adding to it.
+
+    A and B are the root object to a zarr structure
+
+    if runFast=True, then load some of B into memory, so that it is
+    faster (but uses more memory)
+
+    This is the old, row by row, version of combineConnectivity().
+
+    Does not return anything.
+
+    '''
+
+    #find total number of starting times in A and B, and update
+    #numberOfStartingTimes in A. Need to deal with fact that A might not
+    #have that attribute yet, if it is an empty dataset
+    if 'numberOfStartingTimes' in A.attrs:
+        numA=A.attrs['numberOfStartingTimes']
+    else:
+        numA=0
+        
+    numB=B.attrs['numberOfStartingTimes']
+    A.attrs['numberOfStartingTimes']=numA+numB
+        
+    #make sets of starting points in A and B
+    inA=set([(p[0],p[1]) for p in zip(A['nxFrom'][:],A['nyFrom'][:])])
+    inB=set([(p[0],p[1]) for p in zip(B['nxFrom'][:],B['nyFrom'][:])])
+
+    #make a dictionary that maps from (nxFrom,nyFrom) in B to row in B
+    nxFromB=B['nxFrom'][:]
+    nyFromB=B['nyFrom'][:]
+    whereInB=dict([((nxFromB[n],nyFromB[n]),n) for n in range(len(nxFromB))])
+
+    #find all points in A and B, and all points in B but not A
+    inAandB=inA.intersection(inB)
+    inBnotA=inB.difference(inA)
+
+    if runFast:
+        nxToAllB=B['nxTo'][:]
+        nyToAllB=B['nyTo'][:]
+        numToAllB=B['numTo'][:]
+
+    #The basic logic is simple, but the implementation here is perhaps
+    #slow.
+    #
+    #First loop over all points in A, by chunk, and if the starting
+    #points are in A and B ((nxFrom,nyFrom) in inAandB) then add to
+    #existing nxTo,nyTo and numTo. Note their are two cases to worry
+    #about -- (nxTo,nyTo) in both A and B, and (nxTo,nyTo) just in
+    #B. The case where a point is in A but not B should be fine and
+    #automatically delt with in the follow loop for the in A and B
+    #case.
+    #
+    #All this code needs to do is update nxTo,nyTo and numTo
+    tic=time.time()
+    print('Starting to combine inAandB')
+    lenA=A['nxFrom'].shape[0]
+    chunkSize=A['nxFrom'].chunks[0]
+    startThisChunk=0
+    while startThisChunk <lenA:
+        thisChunkSize=min(chunkSize,lenA-startThisChunk) #on last loop, should == lenA 
+
+        #get a chunk. Do a deep copy for the ones that will be
+        #altered. Why? For reasons I don't understand, the object
+        #arrays in *To arrays are unwriteable with the deep copy. It
+        #is ok to do this, because below I copy the update chunks back
+        #to A
+        nxFrom=A['nxFrom'][startThisChunk:startThisChunk+thisChunkSize]
+        nyFrom=A['nyFrom'][startThisChunk:startThisChunk+thisChunkSize]
+
+        nxTo=copy.deepcopy(A['nxTo'][startThisChunk:startThisChunk+thisChunkSize])
+        nyTo=copy.deepcopy(A['nyTo'][startThisChunk:startThisChunk+thisChunkSize])
+        numTo=copy.deepcopy(A['numTo'][startThisChunk:startThisChunk+thisChunkSize])
+
+        #update info in this chunk
+        for nA in range(len(nxFrom)): #loop over chunk, nA is a row in the chunk
+            if (nxFrom[nA],nyFrom[nA]) in inAandB: #is (nxFrom,nyFrom) in A and B
+
+                #to check if To point from B in A already for this
+                #(nxFrom,nyFrom), and to find where that
+                #(nxFrom,nyFrom) are, create dictionary whose key is a
+                #single (nxFrom[],nyFrom[]) in A and whose value is the
+                #location of that point in the nxFrom/nyFrom/numFrom
+                #vector for a row in A
+                inThisTo=dict([((p[0],p[1]),p[2]) for p in zip(nxTo[nA],nyTo[nA],range(len(nxTo[nA])))]) 
+
+                #breakpoint()
+                
+                #to store points that need to be appended to nxTo, nyTo and numTo of A
+                nxToNew=[]; nyToNew=[]; numToNew=[]
+
+                #loop over *To in B. Note that here it is gaurenteed
+                #that *From points are in both A and B
+                bRow=whereInB[(nxFrom[nA],nyFrom[nA])]
+                if runFast:
+                    nxToB=nxToAllB[bRow]
+                    nyToB=nyToAllB[bRow]
+                    numToB=numToAllB[bRow]                    
+                else:
+                    nxToB=B['nxTo'][bRow]
+                    nyToB=B['nyTo'][bRow]
+                    numToB=B['numTo'][bRow]
+
+                for nB in range(len(nxToB)): #nB is, confusingly, a location in nxToB/nyToB/numToB
+                    if (nxToB[nB],nyToB[nB]) in inThisTo:
+                        #then the (nxTo,nyTo) point is in both A and B
+                        #for this (nxFrom,nyFrom), and so we just need
+                        #to update the numTo
+                        whichOne=inThisTo[(nxToB[nB],nyToB[nB])]
+                        numTo[nA][whichOne]+=numToB[nB]
+                    else:
+                        #then the (nxTo,nyTo) point is only in B for
+                        #this (nxFrom,nyFrom), and so we need to add
+                        #new items to nxTo/nyTo/numTo in A
+                        nxToNew.append(nxToB[nB])
+                        nyToNew.append(nyToB[nB])
+                        numToNew.append(numToB[nB])
+
+                #now, we need to append nxToNew,nyToNew and numToNew to nxTo[n]/nyTo[n]/numTo[n]
+                nxTo[nA]=concatenate((nxTo[nA],array(nxToNew)))#,casting='no')
+                nyTo[nA]=concatenate((nyTo[nA],array(nyToNew)))#,casting='no')
+                numTo[nA]=concatenate((numTo[nA],array(numToNew)))#,casting='no')
+                #breakpoint()
+
+        #now write the chunk back to A, but only the *To's, since they
+        #are the only ones to have changed
+        A['nxTo'][startThisChunk:startThisChunk+thisChunkSize]=nxTo
+        A['nyTo'][startThisChunk:startThisChunk+thisChunkSize]=nyTo
+        A['numTo'][startThisChunk:startThisChunk+thisChunkSize]=numTo
+
+        #now update startThisChunk
+        #print('Done with',startThisChunk,'of',lenA)
+        startThisChunk=startThisChunk+chunkSize
+
+    print('   done in',time.time()-tic)
+
+    tic=time.time()
+    print('Starting to combine inBnotA')
+
+    #now we need to find all (nxFrom,nyFrom) points that are in B but
+    #not A, and the nxFrom/nyFrom/nxTo/nyTo/numTo lines for those
+    #starting points to A. This is a straightforward append.
+    indxInBnotA=array([ (p in inBnotA) for p in zip(nxFromB,nyFromB)])
+    A['nxFrom'].append(B['nxFrom'].vindex[indxInBnotA],axis=0)                    
+    A['nyFrom'].append(B['nyFrom'].vindex[indxInBnotA],axis=0)                    
+    A['nxTo'].append(B['nxTo'].vindex[indxInBnotA],axis=0)                    
+    A['nyTo'].append(B['nyTo'].vindex[indxInBnotA],axis=0)                    
+    A['numTo'].append(B['numTo'].vindex[indxInBnotA],axis=0)                    
+
+    print('   done in',time.time()-tic)
+    
+
+    return None
+
+def trimConnectivity_rowByRow(connectivityIn,theDict,theMin,theMax,loadConnectToMem=True,keepAllTo=False):
+    '''trimConnectivity_rowByRow(connectivityIn,theDict,theMin,theMax) is
+    the old, row by row, version of trimConnectivity(), and takes as input
+
+    connectivityIn, an open zarr file that specifies the connectivity
+    matrix, as created by makeConnectFromFile()
+
+    theDict, a dictionary with key (nx,ny) that returns a number as a
+    value (e.g. as from depthDict(), where the dictionary returns the
+    depth at the location (nx,ny).
+
+    theMin and the theMax: each starting and ending point in
+    connectivityIn (defined by their (nx,ny)) is only included in the
+    new connectivity matrix if (nx,ny) is in theDict AND
+    theMin<=theDict(nx,ny)<=theMax
+
+    loadConnectToMem=True: If this is true, load connectivity into
+    memory -- much faster, but much more memory. If false, work on disk, slower but no memory ussage.
+
+    keepAllTo=False: if False, also trim *To points that are meet the triming criteria. if True, don't
+    remove *To points
+
+    returns connectivityOut, an in memory zarr file that is the
+    reduced connectivity matrix that satisfies the criterion above.
+
+    '''
+
+    #first, make in-memory connectivityOut zarr data store and fill
+    #with appropriate (nxFrom,nyFrom)
+    nxFromIn=connectivityIn['nxFrom'][:]
+    nyFromIn=connectivityIn['nyFrom'][:]
+
+    toKeep=[mcm.isGood(theDict,theMin,theMax,p) for p in zip(nxFromIn,nyFromIn)]
+
+    #make output as an in-memory zarr
+    nOut=sum(toKeep)
+
+    #create zarr dataset
+    chunkSize=int(1e6) #should experiment with this
+    store=zarr.MemoryStore()
+    root=zarr.group(store=store)
+    
+    nxFrom=root.empty(shape=(nOut,),name='nxFrom',dtype=mcm.coordType,chunks=chunkSize)
+    nyFrom=root.empty(shape=(nOut,),name='nyFrom',dtype=mcm.coordType,chunks=chunkSize)
+    if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases everything
+        print('   adding numLaunched variable')
+        numLaunched=root.empty(shape=(nOut,),name='numLaunched',dtype='i',chunks=chunkSize)
+
+    nxTo=root.empty(shape=(nOut,),name='nxTo',dtype=object,chunks=chunkSize,
+                    object_codec=numcodecs.VLenArray(mcm.coordType))
+    nyTo=root.empty(shape=(nOut,),name='nyTo',dtype=object,chunks=chunkSize,
+                    object_codec=numcodecs.VLenArray(mcm.coordType))
+    numTo=root.empty(shape=(nOut,),name='numTo',dtype=object,chunks=chunkSize,
+                     object_codec=numcodecs.VLenArray(mcm.typeOfSum))
+
+    #write out nxFrom,nyFrom
+    nxFrom[:]=nxFromIn[toKeep]
+    nyFrom[:]=nyFromIn[toKeep]
+    if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases things
+        print('  adding numLaunched data')
+        numLaunchedIn=connectivityIn['numLaunched'][:] #again, zarr lowercases things? or not? or macOS
+        numLaunched[:]=numLaunchedIn[toKeep] 
+
+    #now we need to update nxTo,nyTo and numTo
+    print('starting to fill lists')
+    tic=time.time()
+    sourceIndx=arange(len(nxFromIn))[toKeep]
+    nxToNew=empty((nOut,),dtype=object)
+    nyToNew=empty((nOut,),dtype=object)
+    numToNew=empty((nOut,),dtype=object)
+
+    #if we can fit the connectivity array in memory, it should be much
+    #faster... if we can't, just leave as link to zarr array
+    if not loadConnectToMem:
+        #slow, low memory usage
+        print('In trimConnectivity, using slow, low memory ussage path')
+        nxToIn=connectivityIn['nxTo']
+        nyToIn=connectivityIn['nyTo']
+        numToIn=connectivityIn['numTo']
+    else:
+        #fast, high memory usage
+        print('In trimConnectivity, Loading connectivity matrix into memory; if fails, make loadConnectToMem=False')
+        nxToIn=connectivityIn['nxTo'][:]
+        nyToIn=connectivityIn['nyTo'][:]
+        numToIn=connectivityIn['numTo'][:]
+        print('   done loading into memory')
+
+    #breakpoint()
+    
+    for n in range(nOut):
+        nIn=sourceIndx[n]
+        nxToOld=nxToIn[nIn]
+        nyToOld=nyToIn[nIn]
+        numToOld=numToIn[nIn]
+        if keepAllTo:
+            nxToNew[n]=nxToOld
+            nyToNew[n]=nyToOld
+            numToNew[n]=numToOld
+        else:
+            toKeep=[mcm.isGood(theDict,theMin,theMax,p) for p in zip(nxToOld,nyToOld)]
+            nxToNew[n]=nxToOld[toKeep]
+            nyToNew[n]=nyToOld[toKeep]
+            numToNew[n]=numToOld[toKeep]
+    print('done filling lists in ',time.time()-tic)
+    nxTo[:]=nxToNew 
+    nyTo[:]=nyToNew
+    numTo[:]=numToNew
+    print('done with To',time.time()-tic,'cummalative')
+
+    #pass the numberOfStartingTimes info through to the output
+    root.attrs['numberOfStartingTimes']=connectivityIn.attrs['numberOfStartingTimes']
+    
+    return root
+
+def trimConnectivity_byPoly_rowByRow(connectivityIn,thePolygon,keepInPoly=True,loadConnectToMem=True,keepAllTo=False):
+    '''trimConnectivity_byPoly_rowByRow(connectivityIn,thePolygon) is the
+    old, point by point, version of trimConnectivity_byPoly(), and takes as input
+
+    connectivityIn, an open zarr file that specifies the connectivity
+    matrix, as created by makeConnectFromFile()
+
+    thePolygon, a list of (lon,lat) points that define a polygon.
+
+    keepInPoly=True, if this is true, keep points in polygon, if false, keep points outside polygon
+
+    loadConnectToMem=True: If this is true, load connectivity into
+    memory -- much faster, but much more memory. If false, work on disk, slower but no memory ussage.
+
+    keepAllTo=False: if False, also trim *To points that are meet the triming criteria. if True, don't
+    remove *To points
+
+    returns connectivityOut, an in memory zarr file that is the
+    reduced connectivity matrix that satisfies the criterion above.
+
+    '''
+
+    #first, make in-memory connectivityOut zarr data store and fill
+    #with appropriate (nxFrom,nyFrom)
+    nxFromIn=connectivityIn['nxFrom'][:]
+    nyFromIn=connectivityIn['nyFrom'][:]
+
+    #get latitude and longitude matrices, and make vectors of latFromIn and lonFromIn
+    with nc.Dataset(mcm.maskFile,'r') as gridData:
+        lonMat=gridData['nav_lon'][:]
+        latMat=gridData['nav_lat'][:]
+        lonHabVec=array([lonMat[p] for p in zip(nyFromIn,nxFromIn)])
+        latHabVec=array([latMat[p] for p in zip(nyFromIn,nxFromIn)])
+
+    #now make dictionary with key (nx,ny) and a boolean if in polygon
+    allPoints=MultiPoint([a for a in zip(lonHabVec,latHabVec)])
+    regionPolyShapely=Polygon(thePolygon)
+    toKeep=[p.within(regionPolyShapely) for p in allPoints.geoms] #there has to be a better way
+
+    #plot(*regionPolyShapely.exterior.xy)
+    #
+    # jnkx=[p.x for p in allPoints.geoms]
+    # jnky=[p.y for p in allPoints.geoms]
+    # plot(jnkx,jnky,'k*')
+        
+                        
+    #if keepInPoly is false, then we want to keep the points outside
+    #of the polygon, so must reverse toKeep
+    if not keepInPoly:
+        toKeep=logical_not(toKeep)
+
+    #make dictionary of points to keep with key (nx,ny)
+    toKeepDict={}
+    jnk=[(p,True) for p in zip(nxFromIn[toKeep],nyFromIn[toKeep])]
+    toKeepDict.update(jnk)
+
+    #make output as an in-memory zarr
+    nOut=sum(toKeep)
+
+    #create zarr dataset
+    chunkSize=int(1e6) #should experiment with this
+    store=zarr.MemoryStore()
+    root=zarr.group(store=store)
+
+    #print('   LOST IN TURNIPS'); breakpoint()
+    
+    nxFrom=root.empty(shape=(nOut,),name='nxFrom',dtype=mcm.coordType,chunks=chunkSize)
+    nyFrom=root.empty(shape=(nOut,),name='nyFrom',dtype=mcm.coordType,chunks=chunkSize)
+    if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases everything
+        print('   adding numLaunched variable')
+        numLaunched=root.empty(shape=(nOut,),name='numLaunched',dtype='i',chunks=chunkSize)
+
+    nxTo=root.empty(shape=(nOut,),name='nxTo',dtype=object,chunks=chunkSize,
+                    object_codec=numcodecs.VLenArray(mcm.coordType))
+    nyTo=root.empty(shape=(nOut,),name='nyTo',dtype=object,chunks=chunkSize,
+                    object_codec=numcodecs.VLenArray(mcm.coordType))
+    numTo=root.empty(shape=(nOut,),name='numTo',dtype=object,chunks=chunkSize,
+                     object_codec=numcodecs.VLenArray(mcm.typeOfSum))
+
+    #write out nxFrom,nyFrom
+    nxFrom[:]=nxFromIn[toKeep]
+    nyFrom[:]=nyFromIn[toKeep]
+    if ('numlaunched' in connectivityIn) or ('numLaunched' in connectivityIn): #zarr lowercases things
+        print('  adding numLaunched data')
+        #is the case insensitivity of macOS screwing me up? Will this work on my laptop?
+        numLaunchedIn=connectivityIn['numLaunched'][:] #again, zarr lowercases things
+        numLaunched[:]=numLaunchedIn[toKeep] 
+
+
+    #now we need to update nxTo,nyTo and numTo
+    print('starting to fill lists')
+    tic=time.time()
+    sourceIndx=arange(len(nxFromIn))[toKeep]
+    nxToNew=empty((nOut,),dtype=object)
+    nyToNew=empty((nOut,),dtype=object)
+    numToNew=empty((nOut,),dtype=object)
+
+    #if we can fit the connectivity array in memory, it should be much
+    #faster... if we can't, just leave as link to zarr array
+    if not loadConnectToMem:
+        #slow, low memory usage
+        print('In trimConnectivity, using slow, low memory ussage path')
+        nxToIn=connectivityIn['nxTo']
+        nyToIn=connectivityIn['nyTo']
+        numToIn=connectivityIn['numTo']
+    else:
+        #fast, high memory usage
+        print('In trimConnectivity, Loading connectivity matrix into memory; if fails, make loadConnectToMem=False')
+        nxToIn=connectivityIn['nxTo'][:]
+        nyToIn=connectivityIn['nyTo'][:]
+        numToIn=connectivityIn['numTo'][:]
+        print('   done loading into memory')
+
+    #breakpoint()
+    
+    for n in range(nOut):
+        nIn=sourceIndx[n]
+        nxToOld=nxToIn[nIn]
+        nyToOld=nyToIn[nIn]
+        numToOld=numToIn[nIn]
+        if keepAllTo:
+            nxToNew[n]=nxToOld
+            nyToNew[n]=nyToOld
+            numToNew[n]=numToOld
+        else:
+            toKeep=[(p in toKeepDict)  for p in zip(nxToOld,nyToOld)]
+            nxToNew[n]=nxToOld[toKeep]
+            nyToNew[n]=nyToOld[toKeep]
+            numToNew[n]=numToOld[toKeep]
+    print('done filling lists in ',time.time()-tic)
+    nxTo[:]=nxToNew 
+    nyTo[:]=nyToNew
+    numTo[:]=numToNew
+    print('done with To',time.time()-tic,'cummalative')
+
+    #pass the numberOfStartingTimes info through to the output
+    root.attrs['numberOfStartingTimes']=connectivityIn.attrs['numberOfStartingTimes']
+    
+    return root
+
+def randomInputs(seed,nRowList,**kwargs):
+    rng=np.random.default_rng(seed)
+    return [sdm.randomConnectivity(rng,nRow,nxRange,nyRange,numberOfStartingTimes=n+1,**kwargs)
+            for n,nRow in enumerate(nRowList)]
+
+def combineInOrder(inputList,rowByRow):
+    E=mcm.makeEmptyConnectivity(zarr.MemoryStore(),chunkSize=256)
+    for C in inputList:
+        if rowByRow:
+            combineConnectivity_rowByRow(E,C)
+        else:
+            mcm.combineConnectivity(E,C)
+    return E
+
+def test_combineConnectivity_matchesRowByRow():
+    #the last input is a single empty row, and the matrices share many
+    #of their starting and destination points
+    inputList=randomInputs(50,[400,300,600,1])
+    inputList[-1]=sdm.randomConnectivity(np.random.default_rng(51),1,nxRange,nyRange,emptyFrac=1.0)
+    new=combineInOrder(inputList,False)
+    assert sdm.sameConnectivity(new,combineInOrder(inputList,True))
+    assert new.attrs['numberOfStartingTimes']==1+2+3+3
+
+    #nothing is lost
+    total=sum([sum([p.sum() for p in C['numTo'][:]]) for C in inputList])
+    assert sum([p.sum() for p in new['numTo'][:]])==total
+
+def test_combineConnectivity_intoEmpty():
+    #adding a matrix to an empty one copies it
+    C=randomInputs(52,[200])[0]
+    E=combineInOrder([C],False)
+    for name in ('nxFrom','nyFrom'):
+        assert array_equal(E[name][:],C[name][:])
+    for name in ('nxTo','nyTo','numTo'):
+        assert all([array_equal(p,q) for p,q in zip(E[name][:],C[name][:])])
+
+    #and adding an empty matrix changes nothing
+    empty=mcm.makeEmptyConnectivity(zarr.MemoryStore(),chunkSize=256)
+    empty.attrs['numberOfStartingTimes']=0
+    mcm.combineConnectivity(E,empty)
+    assert sdm.sameConnectivity(E,combineInOrder([C],True))
+
+def test_mergeFlatConnectivity_matchesRowByRow():
+    inputList=randomInputs(53,[300,300,50])
+    new=mcm.mergeFlatConnectivity([mcm.flattenConnectivity(C) for C in inputList])
+    old=mcm.flattenConnectivity(combineInOrder(inputList,True))
+    for p,q in zip(new,old):
+        assert array_equal(p,q) and (p.dtype==q.dtype)
+
+def test_combineConnectivity_overflow():
+    C=randomInputs(54,[20],emptyFrac=0.0)[0]
+    numTo=C['numTo'][:]
+    numTo[0]=full(numTo[0].shape,40000,dtype=mcm.typeOfSum)
+    C['numTo'][:]=numTo
+    E=combineInOrder([C],False)
+    with pytest.raises(AssertionError,match='overflowed'):
+        mcm.combineConnectivity(E,C)
+
+@pytest.mark.parametrize('nPartition,nThread,chunkSize',[(1,1,2000),(3,2,37),(16,4,5),(7,None,1)])
+def test_combineMany_matchesCombineConnectivity(workDir,nPartition,nThread,chunkSize):
+    #the inputs are read a chunk at a time, so they are made with small chunks
+    inputList=randomInputs(55,[300,250,1,400],chunkSize=64)
+    inputList[2]=sdm.randomConnectivity(np.random.default_rng(56),1,nxRange,nyRange,emptyFrac=1.0)
+
+    #inputs can also be given by name
+    inputList.append('inputOnDisk.zarr')
+    sdm.randomConnectivity(np.random.default_rng(57),150,nxRange,nyRange,store=zarr.DirectoryStore(inputList[-1]),
+                           chunkSize=32)
+
+    E=mcm.combineMany(inputList,zarr.MemoryStore(),nPartition=nPartition,nThread=nThread,
+                      spillDir=str(workDir),chunkSize=chunkSize)
+    old=combineInOrder([zarr.open(C,'r') if isinstance(C,str) else C for C in inputList],True)
+    assert sdm.sameConnectivity(E,old)
+    assert E['nxTo'].chunks[0]==chunkSize
+
+    #and the scratch files are gone
+    assert not [p for p in os.listdir(workDir) if p.startswith('combineMany_')]
+
+def test_combineMany_prepare(workDir):
+    #prepare is applied to each input before it is added
+    inputList=randomInputs(58,[200,200])
+    nxGrid=indices((100,100))[1]
+    def prepare(C):
+        return mcm.trimConnectivity(C,nxGrid,30,45)
+    E=mcm.combineMany(inputList,zarr.MemoryStore(),prepare=prepare,nPartition=4,spillDir=str(workDir),
+                      chunkSize=256)
+    assert sdm.sameConnectivity(E,combineInOrder([prepare(C) for C in inputList],True))
+
+def test_combineMany_overflow(workDir):
+    C=randomInputs(59,[20],emptyFrac=0.0)[0]
+    numTo=C['numTo'][:]
+    numTo[3]=full(numTo[3].shape,40000,dtype=mcm.typeOfSum)
+    C['numTo'][:]=numTo
+    with pytest.raises(AssertionError,match='overflowed'):
+        mcm.combineMany([C,C],zarr.MemoryStore(),nPartition=4,spillDir=str(workDir),chunkSize=256)
+    assert not [p for p in os.listdir(workDir) if p.startswith('combineMany_')]
+
+@pytest.mark.parametrize('keepAllTo',[False,True])
+def test_trimConnectivity_matchesRowByRow(workDir,keepAllTo):
+    #the depth deepens to the east, so only the western part of the
+    #starting points are between theMin and theMax. The old code
+    #writes its output a row at a time, which is slow, so the matrices
+    #are small
+    C=randomInputs(60,[100])[0]
+    depthDict=mcm.getDepthDict(C['nxFrom'][:],C['nyFrom'][:])
+    old=trimConnectivity_rowByRow(C,depthDict,0.0,100.0,keepAllTo=keepAllTo)
+    assert 0<old['nxFrom'].shape[0]<C['nxFrom'].shape[0]
+    assert 'numLaunched' in old
+    assert sdm.sameConnectivity(mcm.trimConnectivity(C,depthDict,0.0,100.0,keepAllTo=keepAllTo),old)
+    assert sdm.sameConnectivity(mcm.trimConnectivity(C,depthDict,0.0,100.0,keepAllTo=keepAllTo,
+                                                     loadConnectToMem=False),old)
+
+    #a dictionary of the whole grid is the same as the grid itself,
+    #which is how the 00_makeConnectivityMatrices scripts now trim
+    nxAll,nyAll=meshgrid(arange(mcm.gridGeometry('depth').shape[1]),arange(mcm.gridGeometry('depth').shape[0]))
+    fullDict=mcm.getDepthDict(nxAll.ravel(),nyAll.ravel())
+    old=trimConnectivity_rowByRow(C,fullDict,0.0,100.0,keepAllTo=keepAllTo)
+    for loadConnectToMem in (True,False):
+        assert sdm.sameConnectivity(mcm.trimConnectivity(C,mcm.gridGeometry('depth'),0.0,100.0,keepAllTo=keepAllTo,
+                                                         loadConnectToMem=loadConnectToMem),old)
+
+def test_trimConnectivity_keepNothing(workDir):
+    C=randomInputs(61,[100])[0]
+    depthDict=mcm.getDepthDict(C['nxFrom'][:],C['nyFrom'][:])
+    old=trimConnectivity_rowByRow(C,depthDict,1e4,2e4)
+    assert old['nxFrom'].shape[0]==0
+    assert sdm.sameConnectivity(mcm.trimConnectivity(C,depthDict,1e4,2e4),old)
+
+def test_makeIsGood():
+    theGrid=ma.masked_array(arange(12.0).reshape((3,4)),mask=zeros((3,4),dtype=bool))
+    theGrid[1,2]=ma.masked
+    theDict={(nx,ny):theGrid[ny,nx] for nx in range(4) for ny in range(3)}
+    nxVec=array([0,1,2,3,2,7,0]); nyVec=array([0,1,1,2,2,0,5])
+    #for a masked value, isGood() gives masked, which is not good
+    expected=[bool(mcm.isGood(theDict,2.0,10.0,p)) for p in zip(nxVec,nyVec)]
+    assert array_equal(mcm.makeIsGood(theDict,2.0,10.0)(nxVec,nyVec),expected)
+    assert array_equal(mcm.makeIsGood(theGrid,2.0,10.0)(nxVec,nyVec),expected)
+
+#a polygon within the part of the synthetic grid the random matrices use
+regionPoly=[(-70.0,35.0),(-62.0,36.0),(-60.0,46.0),(-66.0,47.5),(-71.0,42.0)]
+
+@pytest.mark.parametrize('keepInPoly,keepAllTo',[(True,False),(True,True),(False,False),(False,True)])
+def test_trimConnectivity_byPoly_matchesRowByRow(keepInPoly,keepAllTo):
+    C=randomInputs(62,[100])[0]
+    old=trimConnectivity_byPoly_rowByRow(C,regionPoly,keepInPoly=keepInPoly,keepAllTo=keepAllTo)
+    assert 0<old['nxFrom'].shape[0]<C['nxFrom'].shape[0]
+    for loadConnectToMem in (True,False):
+        assert sdm.sameConnectivity(mcm.trimConnectivity_byPoly(C,regionPoly,keepInPoly=keepInPoly,keepAllTo=keepAllTo,
+                                                                loadConnectToMem=loadConnectToMem),old)
+
+def test_polygonGridMask():
+    otherPoly=[(-69.0,33.5),(-64.0,33.5),(-64.0,34.9),(-69.0,34.9)]
+    inPoly=mcm.polygonGridMask(regionPoly)
+    inOther=mcm.polygonGridMask(otherPoly)
+    assert inPoly.any() and inOther.any() and not (inPoly&inOther).any()
+
+    #a shapely polygon is the same as its points, and a list of polygons is their union
+    assert array_equal(mcm.polygonGridMask(Polygon(otherPoly)),inOther)
+    assert array_equal(mcm.polygonGridMask([regionPoly,otherPoly]),inPoly|inOther)
+
+    #and the row by row code gives the same starting points
+    C=randomInputs(63,[600],emptyFrac=1.0)[0]
+    old=trimConnectivity_byPoly_rowByRow(C,otherPoly)
+    new=mcm.trimConnectivity_byPoly(C,[regionPoly,otherPoly])
+    both=mcm.trimConnectivity_byPoly(C,regionPoly)
+    assert old['nxFrom'].shape[0]>0
+    assert sorted(zip(new['nxFrom'][:],new['nyFrom'][:]))==sorted(list(zip(old['nxFrom'][:],old['nyFrom'][:]))
+                                                                   +list(zip(both['nxFrom'][:],both['nyFrom'][:])))
@@ -0,0 +1,132 @@
+from numpy import *
+import numpy as np
+import os
+import sys
+import importlib.util
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import pytest
+import createLinearModel_module as cLM
+import populationKernels_module as pkm
+import rngStreams_module as rsm
+import syntheticData_module as sdm
+
+# The dense engine of 02_manyNeutralSpecies_fastModel.py gives each
+# species, when dispersing, and each block of rsm.cellsPerStream
+# habitat points, when choosing recruits, its own stream of random
+# numbers, so a run with a given seed should not depend on how many
+# processes there are, or on how the species and habitat points are
+# split into jobs, or on the order the jobs are done in. Here a few
+# generations are run with findWhereSettle() and whichLarvaeSurvive()
+# split in several ways, in this process and in a pool of workers.
+
+Ndomain=300
+Nspecies=12
+Pmax=10
+R=4.0
+nGeneration=4
+seed=20250101
+streamRun=3
+
+@pytest.fixture
+def neutralModel(workDir,monkeypatch):
+    '''import 02_manyNeutralSpecies_fastModel.py, whose name is not a
+    valid module name, with a small random connectivity attached, and
+    small blocks of habitat points, so there are many of them'''
+    monkeypatch.setattr(rsm,'cellsPerStream',32)
+    moduleName='manyNeutralSpecies_fastModel'
+    spec=importlib.util.spec_from_file_location(moduleName,os.path.join(os.path.dirname(pkm.__file__),
+                                                                        '02_manyNeutralSpecies_fastModel.py'))
+    model=importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules,moduleName,model) #so pool workers can unpickle its functions
+    spec.loader.exec_module(model)
+
+    EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=sdm.randomCSR(np.random.default_rng(5),Ndomain,fracReturn=0.6)
+    shmConnectivity,connectivitySpec,E=cLM.makeSharedArrays({'EwhereTo':EwhereTo,'EnumTo':EnumTo,'Ecumsum':Ecumsum,
+                                                             'EfracReturn':EfracReturn,'Eindptr':Eindptr})
+    model.attachConnectivity(connectivitySpec)
+    yield model,connectivitySpec
+    model.shmConnectivity=[]
+    for shm in shmConnectivity:
+        shm.close(); shm.unlink()
+
+def initialPopulation():
+    rng=np.random.default_rng(6)
+    P=zeros((Ndomain,Nspecies),dtype=int64)
+    for n in range(Ndomain):
+        P[n,:]=rng.multinomial(Pmax,ones(Nspecies)/Nspecies)
+    return P
+
+def runGenerations(model,nChunks,jobOrder=None,pool=None):
+    '''run nGeneration generations of the dense engine from
+    initialPopulation(), splitting each step into about nChunks jobs,
+    done in the order given by jobOrder(jobList), in this process if
+    pool is None, and returns P at each generation'''
+    Pdtype='int64'; settleDtype='int64'
+    shm_P=shared_memory.SharedMemory(create=True,size=Ndomain*Nspecies*8)
+    shm_whereSettle=shared_memory.SharedMemory(create=True,size=Ndomain*Nspecies*8)
+    try:
+        P=ndarray((Ndomain,Nspecies),dtype=Pdtype,buffer=shm_P.buf)
+        whereSettle=ndarray((Ndomain,Nspecies),dtype=settleDtype,buffer=shm_whereSettle.buf)
+        P[:,:]=initialPopulation()
+        history=[]
+        for nt in range(nGeneration):
+            whereSettle.fill(0)
+            argIn=[(shm_P.name,shm_whereSettle.name,whichSpecies,R,Ndomain,Nspecies,seed,(streamRun,nt),
+                    'auto',Pdtype,settleDtype)
+                   for whichSpecies in pkm.balancedChunks(P.sum(axis=0),nChunks)]
+            runJobs(model.findWhereSettleStar,argIn,jobOrder,pool)
+
+            P.fill(0)
+            chunkVec=rsm.blockChunks(Ndomain,nChunks)
+            argIn=[(shm_P.name,shm_whereSettle.name,chunkVec[n],chunkVec[n+1],Pmax,Ndomain,Nspecies,seed,(streamRun,nt),
+                    Pdtype,settleDtype) for n in range(len(chunkVec)-1)]
+            runJobs(model.whichLarvaeSurviveStar,argIn,jobOrder,pool)
+            history.append(P.copy())
+        return history
+    finally:
+        del P,whereSettle
+        for shm in (shm_P,shm_whereSettle):
+            shm.close(); shm.unlink()
+
+def runJobs(theFunction,argIn,jobOrder,pool):
+    if jobOrder is not None:
+        argIn=jobOrder(argIn)
+    if pool is None:
+        for args in argIn:
+            theFunction(args)
+    else:
+        for output in pool.imap_unordered(theFunction,argIn,chunksize=1):
+            pass
+    return None
+
+def test_sameRunForAnyChunking(neutralModel):
+    model,connectivitySpec=neutralModel
+    reference=runGenerations(model,1)
+
+    #it is a real run, in which the populations change, and stay at Pmax
+    assert not array_equal(reference[-1],initialPopulation())
+    assert all([(P.sum(axis=1)<=Pmax).all() for P in reference])
+
+    shuffle=lambda jobs: [jobs[n] for n in np.random.default_rng(len(jobs)).permutation(len(jobs))]
+    for nChunks,jobOrder in ((3,None),(7,lambda jobs: jobs[::-1]),(Ndomain,shuffle)):
+        history=runGenerations(model,nChunks,jobOrder)
+        assert all([array_equal(P,Q) for P,Q in zip(reference,history)])
+
+def test_sameRunForAnyNumberOfProcesses(neutralModel):
+    model,connectivitySpec=neutralModel
+    reference=runGenerations(model,1)
+    for nCPU in (1,2,3):
+        with mp.get_context('fork').Pool(nCPU,initializer=model.attachConnectivity,initargs=(connectivitySpec,)) as pool:
+            history=runGenerations(model,4*nCPU,pool=pool)
+        assert all([array_equal(P,Q) for P,Q in zip(reference,history)])
+
+def test_streamsDependOnSeedAndGeneration(neutralModel):
+    model,connectivitySpec=neutralModel
+    history=runGenerations(model,1)
+    assert not any([array_equal(history[n],history[n+1]) for n in range(nGeneration-1)])
+    streamA=rsm.streamRng(seed,rsm.dispersalStream,streamRun,0,1).random(5)
+    for key in ((streamRun,1,1),(streamRun,0,2),(streamRun+1,0,1)):
+        assert not array_equal(streamA,rsm.streamRng(seed,rsm.dispersalStream,*key).random(5))
+    assert not array_equal(streamA,rsm.streamRng(seed,rsm.recruitStream,streamRun,0,1).random(5))
+    assert array_equal(streamA,rsm.streamRng(seed,rsm.dispersalStream,streamRun,0,1).random(5))
@@ -0,0 +1,342 @@
+from numpy import *
+import numpy as np
+import populationKernels_module as pkm
+import syntheticData_module as sdm
+
+# The compiled kernels are checked against the numpy code they replaced
+# where they draw the same random numbers, and otherwise against that
+# code, and the expected number of settlers, on average over many
+# draws. Means are compared to within nSE standard errors, with fixed
+# seeds, so the tests are repeatable.
+
+nSE=5.0
+
+def findWhereSettle_old(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,rng):
+    '''the dispersal step of findWhereSettle() in
+    02_manyNeutralSpecies_fastModel.py before it was compiled, for one
+    species, with the linear model in compressed sparse row form'''
+    Ndomain=len(Pcol)
+    intSurvive=floor(rng.random(Ndomain)+R*Pcol*EfracReturn).astype(int)
+    thisWhereSettle=zeros((Ndomain,),dtype=int)
+    for n in arange(Ndomain)[Pcol>0]:
+        whereGoList=searchsorted(Ecumsum[Eindptr[n]:Eindptr[n+1]],rng.random(intSurvive[n]))
+        for m in EwhereTo[Eindptr[n]:Eindptr[n+1]][whereGoList]:
+            thisWhereSettle[m]+=1
+    return thisWhereSettle
+
+def findWhereSettle_perCell(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,rng):
+    '''findWhereSettle_old() with the random numbers drawn in the order
+    disperseLarvae() draws them, one point at a time'''
+    thisWhereSettle=zeros((len(Pcol),),dtype=int)
+    for n in arange(len(Pcol))[Pcol>0]:
+        nSurvive=int(floor(rng.random()+R*Pcol[n]*EfracReturn[n]))
+        for k in range(nSurvive):
+            thisWhereSettle[EwhereTo[Eindptr[n]+searchsorted(Ecumsum[Eindptr[n]:Eindptr[n+1]],rng.random())]]+=1
+    return thisWhereSettle
+
+def randomModel(seed,Ndomain=60,Pmax=20):
+    rng=np.random.default_rng(seed)
+    EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=sdm.randomCSR(rng,Ndomain)
+    Pcol=rng.integers(0,Pmax+1,Ndomain)*(rng.random(Ndomain)<0.7)
+    return Pcol,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo
+
+def meanAndVar(draws):
+    draws=array(draws,dtype=float)
+    return draws.mean(axis=0),draws.var(axis=0)/draws.shape[0]
+
+def closeMeans(meanA,varA,meanB,varB=0.0):
+    return (abs(meanA-meanB)<=nSE*sqrt(varA+varB)+1e-9).all()
+
+def test_disperseLarvae_matchesOldCode():
+    R=3.0
+    Pcol,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=randomModel(10)
+
+    #drawing the same random numbers, the compiled kernel gives the same settlers
+    for seed in range(5):
+        thisWhereSettle=zeros((len(Pcol),),dtype=int64)
+        pkm.disperseLarvae(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,np.random.default_rng(seed),
+                           thisWhereSettle,pkm.dispersalModes['larvae'])
+        assert array_equal(thisWhereSettle,
+                           findWhereSettle_perCell(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,np.random.default_rng(seed)))
+
+    #and the old code, which draws them in another order, the same on average
+    rng=np.random.default_rng(11)
+    oldMean,oldVar=meanAndVar([findWhereSettle_old(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,rng) for n in range(400)])
+    for dispersalMode in pkm.dispersalModes.values():
+        draws=zeros((400,len(Pcol)),dtype=int64)
+        for n in range(400):
+            pkm.disperseLarvae(Pcol,R,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,rng,draws[n,:],dispersalMode)
+        newMean,newVar=meanAndVar(draws)
+        assert closeMeans(newMean,newVar,oldMean,oldVar)
+        assert closeMeans(newMean,newVar,sdm.expectedSettlers(Pcol,R,EfracReturn,Eindptr,EwhereTo,EnumTo))
+
+def test_disperseLarvae_addsToWhereSettle():
+    Pcol,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=randomModel(12)
+    for dispersalMode in pkm.dispersalModes.values():
+        once=zeros((len(Pcol),),dtype=int64)
+        pkm.disperseLarvae(Pcol,2.0,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,np.random.default_rng(3),once,dispersalMode)
+        twice=ones((len(Pcol),),dtype=int64)
+        pkm.disperseLarvae(Pcol,2.0,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,np.random.default_rng(3),twice,dispersalMode)
+        assert array_equal(twice,once+1)
+
+        #no population, no larvae
+        none=zeros((len(Pcol),),dtype=int64)
+        pkm.disperseLarvae(zeros_like(Pcol),2.0,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,np.random.default_rng(3),none,dispersalMode)
+        assert not none.any()
+
+def test_splitLarvae_conservesLarvae():
+    rng=np.random.default_rng(13)
+    rowWhereTo=array([4,0,7,2,9],dtype=int32)
+    rowNumTo=array([5,1,30,2,12],dtype=uint16)
+    draws=zeros((2000,10),dtype=int64)
+    for n in range(2000):
+        pkm.splitLarvae(37,rowWhereTo,rowNumTo,rng,draws[n,:])
+    assert (draws.sum(axis=1)==37).all()
+    assert not draws[:,[1,3,5,6,8]].any()
+    newMean,newVar=meanAndVar(draws[:,rowWhereTo])
+    assert closeMeans(newMean,newVar,37*rowNumTo/rowNumTo.sum())
+
+def recruitLottery_old(whereSettle,Pmax,rng):
+    '''the recruitment of whichLarvaeSurvive() in
+    02_manyNeutralSpecies_fastModel.py before it was compiled, which
+    chose the Pmax survivors with replacement'''
+    P=zeros(whereSettle.shape,dtype=int)
+    totalRecruits=whereSettle.sum(axis=1)
+    indx=logical_and(totalRecruits<=Pmax,totalRecruits>0)
+    P[indx,:]=whereSettle[indx,:]
+    for nin in nonzero(totalRecruits>Pmax)[0]:
+        for n in searchsorted(cumsum(whereSettle[nin,:])/totalRecruits[nin],rng.random(Pmax)):
+            P[nin,n]+=1
+    return P
+
+def recruitDenseP(whereSettle,Pmax,rng):
+    P=zeros(whereSettle.shape,dtype=int64)
+    cellVec,speciesVec,nRecruit=pkm.recruitDense(whereSettle,Pmax,rng)
+    P[cellVec,speciesVec]=nRecruit
+    return P
+
+def test_recruitLottery_matchesOldCode():
+    rng=np.random.default_rng(20)
+    Pmax=8
+    whereSettle=rng.integers(0,6,(40,6))*(rng.random((40,6))<0.6)
+    whereSettle[0,:]=0; whereSettle[1,:]=[0,0,9,0,0,0]; whereSettle[2,:]=[1,0,0,0,0,Pmax-1]
+    totalSettle=whereSettle.sum(axis=1)
+    assert (totalSettle>Pmax).sum()>10
+
+    draws=zeros((2000,)+whereSettle.shape,dtype=int64)
+    for n in range(2000):
+        draws[n]=recruitDenseP(whereSettle,Pmax,rng)
+
+    #no species has more recruits than settlers, and every point is
+    #filled, or takes all of its settlers
+    assert (draws<=whereSettle).all() and (draws>=0).all()
+    assert (draws.sum(axis=2)==minimum(totalSettle,Pmax)).all()
+    assert (draws[:,totalSettle<=Pmax,:]==whereSettle[totalSettle<=Pmax,:]).all()
+
+    #on average, the same recruits as the old code, Pmax times the
+    #fraction of the settlers of each species
+    newMean,newVar=meanAndVar(draws)
+    oldMean,oldVar=meanAndVar([recruitLottery_old(whereSettle,Pmax,rng) for n in range(2000)])
+    assert closeMeans(newMean,newVar,oldMean,oldVar)
+    expected=whereSettle*minimum(1.0,Pmax/maximum(totalSettle,1))[:,newaxis]
+    assert closeMeans(newMean,newVar,expected)
+
+def test_recruitLottery_isHypergeometric():
+    #unlike the old code, the recruits of each species are drawn without
+    #replacement, so their variance is that of the hypergeometric
+    #distribution
+    rng=np.random.default_rng(21)
+    settleCount=array([3,1,7,2],dtype=int64)
+    Pmax=5
+    settleIndptr=array([0,len(settleCount)],dtype=int64)
+    draws=zeros((20000,len(settleCount)),dtype=int64)
+    for n in range(20000):
+        pkm.recruitLottery(settleIndptr,settleCount,Pmax,rng,draws[n,:])
+    N=settleCount.sum(); frac=settleCount/N
+    assert allclose(draws.mean(axis=0),Pmax*frac,atol=0.03)
+    assert allclose(draws.var(axis=0),Pmax*frac*(1-frac)*(N-Pmax)/(N-1),rtol=0.05)
+
+def randomSlots(seed,Ndomain,Nspecies,Pmax,nReplicate):
+    rng=np.random.default_rng(seed)
+    Pspecies,Pcount=pkm.makeSlots(nReplicate*Ndomain,Pmax)
+    for c in range(nReplicate*Ndomain):
+        pkm.addToSlots(Pspecies,Pcount,full((Nspecies,),c),arange(Nspecies),rng.multinomial(Pmax,ones(Nspecies)/Nspecies))
+    return Pspecies,Pcount
+
+def test_sparseGeneration_ensembleMatchesSingleRuns():
+    Ndomain=50; Nspecies=5; Pmax=6; nReplicate=4
+    EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=sdm.randomCSR(np.random.default_rng(22),Ndomain,fracReturn=0.8)
+    Pspecies,Pcount=randomSlots(23,Ndomain,Nspecies,Pmax,nReplicate)
+    for dispersalMode in pkm.dispersalModes.values():
+        for isActive in (ones((nReplicate,),dtype=bool),array([True,False,True,False])):
+            rngList=pkm.generatorList([np.random.default_rng(100+n) for n in range(nReplicate)])
+            PspeciesNew,PcountNew=pkm.sparseGeneration(Pspecies,Pcount,3.0,Pmax,EfracReturn,Eindptr,EwhereTo,Ecumsum,
+                                                       EnumTo,rngList,isActive,dispersalMode)
+            for nRep in range(nReplicate):
+                rows=slice(nRep*Ndomain,(nRep+1)*Ndomain)
+                if isActive[nRep]:
+                    alone=pkm.sparseGeneration(Pspecies[rows],Pcount[rows],3.0,Pmax,EfracReturn,Eindptr,EwhereTo,
+                                               Ecumsum,EnumTo,pkm.generatorList([np.random.default_rng(100+nRep)]),
+                                               ones((1,),dtype=bool),dispersalMode)
+                else:
+                    alone=(Pspecies[rows],Pcount[rows])
+                assert array_equal(PspeciesNew[rows],alone[0]) and array_equal(PcountNew[rows],alone[1])
+
+def test_sparseGeneration_matchesDenseEngine():
+    Ndomain=40; Nspecies=4; Pmax=6; R=3.0; nTrial=1500
+    EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=sdm.randomCSR(np.random.default_rng(24),Ndomain,fracReturn=0.8)
+    Pspecies,Pcount=randomSlots(25,Ndomain,Nspecies,Pmax,1)
+    P=pkm.slotsToDense(Pspecies,Pcount,Nspecies)
+    rng=np.random.default_rng(26)
+    for dispersalMode in pkm.dispersalModes.values():
+        sparseDraws=zeros((nTrial,Ndomain,Nspecies),dtype=int64)
+        denseDraws=zeros((nTrial,Ndomain,Nspecies),dtype=int64)
+        rngList=pkm.generatorList([rng])
+        for n in range(nTrial):
+            PspeciesNew,PcountNew=pkm.sparseGeneration(Pspecies,Pcount,R,Pmax,EfracReturn,Eindptr,EwhereTo,Ecumsum,
+                                                       EnumTo,rngList,ones((1,),dtype=bool),dispersalMode)
+            sparseDraws[n]=pkm.slotsToDense(PspeciesNew,PcountNew,Nspecies)
+
+            #a generation of the dense engine
+            whereSettle=zeros((Ndomain,Nspecies),dtype=int64)
+            for nsp in range(Nspecies):
+                pkm.disperseLarvae(P[:,nsp],R,EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo,rng,whereSettle[:,nsp],
+                                   dispersalMode)
+            denseDraws[n]=recruitDenseP(whereSettle,Pmax,rng)
+
+            #each species is in one slot of a point
+            occupied=PcountNew>0
+            for c in nonzero(occupied.any(axis=1))[0]:
+                assert len(unique(PspeciesNew[c,occupied[c]]))==occupied[c].sum()
+        assert (sparseDraws.sum(axis=2)<=Pmax).all()
+        sparseMean,sparseVar=meanAndVar(sparseDraws)
+        denseMean,denseVar=meanAndVar(denseDraws)
+        assert closeMeans(sparseMean,sparseVar,denseMean,denseVar)
+
+def frontierSetup(seed,Ndomain,R1,Pmax):
+    EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo=sdm.randomCSR(np.random.default_rng(seed),Ndomain,fracReturn=0.8)
+    residentMean,residentSupply=pkm.residentEquilibrium(R1,Pmax,EfracReturn,Eindptr,EwhereTo,EnumTo)
+    incoming=pkm.incomingConnectivity(Eindptr,EwhereTo,EnumTo)
+    return (EfracReturn,Eindptr,EwhereTo,Ecumsum,EnumTo),residentSupply,incoming
+
+def frontierStep(invCell,invCount,R0,R1,Pmax,residentSupply,E,incoming,rng,dispersalMode):
+    work=tuple([zeros((len(E[0]),),dtype=int64) for n in range(3)])
+    invCellNew,invCountNew=pkm.frontierGeneration(invCell,invCount,R0,R1,Pmax,residentSupply,*E,*incoming,rng,
+                                                  dispersalMode,*work)
+    assert not any([w.any() for w in work]),'the scratch arrays are not returned zeroed'
+    return invCellNew,invCountNew
+
+def test_frontierGeneration_withoutResident():
+    #with no resident larvae, the invader takes all the points its
+    #larvae reach, up to Pmax, drawing the same random numbers as
+    #disperseLarvae()
+    Ndomain=80; Pmax=7; R0=4.0
+    E,residentSupply,incoming=frontierSetup(30,Ndomain,0.0,Pmax)
+    assert not residentSupply.any()
+    invCell=array([3,17,18,40,79],dtype=int64); invCount=array([7,1,4,7,2],dtype=int64)
+    Pcol=zeros((Ndomain,),dtype=int64); Pcol[invCell]=invCount
+    for dispersalMode in pkm.dispersalModes.values():
+        for seed in range(5):
+            invCellNew,invCountNew=frontierStep(invCell,invCount,R0,0.0,Pmax,residentSupply,E,incoming,
+                                                np.random.default_rng(seed),dispersalMode)
+            thisWhereSettle=zeros((Ndomain,),dtype=int64)
+            pkm.disperseLarvae(Pcol,R0,*E,np.random.default_rng(seed),thisWhereSettle,dispersalMode)
+            assert array_equal(invCellNew,nonzero(thisWhereSettle)[0])
+            assert array_equal(invCountNew,minimum(thisWhereSettle,Pmax)[invCellNew])
+
+def test_frontierGeneration_emptyInvader():
+    E,residentSupply,incoming=frontierSetup(31,30,3.0,5)
+    invCellNew,invCountNew=frontierStep(zeros((0,),dtype=int64),zeros((0,),dtype=int64),3.0,3.0,5,residentSupply,
+                                        E,incoming,np.random.default_rng(0),pkm.dispersalModes['auto'])
+    assert len(invCellNew)==0 and len(invCountNew)==0
+
+def test_residentApproach():
+    Ndomain=60; Pmax=6; R1=3.0
+    E,residentSupply,incoming=frontierSetup(32,Ndomain,R1,Pmax)
+    supplyByGeneration=pkm.residentApproach(R1,Pmax,E[0],E[1],E[2],E[4])
+
+    #the resident starts full, and ends at its equilibrium
+    assert isinf(supplyByGeneration[0]).all() and isfinite(supplyByGeneration[1:]).all()
+    assert allclose(supplyByGeneration[-1],residentSupply,rtol=1e-2,atol=1e-2)
+    assert (pkm.residentSupplyAt(supplyByGeneration,10**6)==supplyByGeneration[-1]).all()
+
+    #a full resident fills the habitat beside the invader
+    P=pkm.frontierToDense(array([3,9]),array([2,6]),Ndomain,Pmax,'int64',supplyByGeneration[0],
+                          np.random.default_rng(0))
+    assert (P.sum(axis=1)==Pmax).all()
+
+def test_frontierEngine_matchesDenseEngine():
+    #runs of the frontier engine give the same chance that the invader
+    #is still there, and the same mean number of invaders, in each
+    #generation, as runs of the dense engine started as the 04 model
+    #starts it, with the resident filling all the habitat the invader
+    #does not hold
+    Ndomain=200; Pmax=6; R1=3.0; nGeneration=12; nRun=800
+    E,residentSupply,incoming=frontierSetup(34,Ndomain,R1,Pmax)
+    supplyByGeneration=pkm.residentApproach(R1,Pmax,E[0],E[1],E[2],E[4])
+    invCellStart=array([7],dtype=int64); invCountStart=array([Pmax],dtype=int64)
+    dispersalMode=pkm.dispersalModes['auto']
+    rng=np.random.default_rng(35)
+    for R0 in (3.0,3.5):
+        frontierTotal=zeros((nRun,nGeneration),dtype=int64)
+        denseTotal=zeros((nRun,nGeneration),dtype=int64)
+        for n in range(nRun):
+            invCell,invCount=invCellStart,invCountStart
+            for nt in range(nGeneration):
+                invCell,invCount=frontierStep(invCell,invCount,R0,R1,Pmax,pkm.residentSupplyAt(supplyByGeneration,nt),
+                                              E,incoming,rng,dispersalMode)
+                assert (diff(invCell)>0).all() and (invCount>0).all() and (invCount<=Pmax).all()
+                frontierTotal[n,nt]=invCount.sum()
+
+            P=zeros((Ndomain,2),dtype=int64)
+            P[invCellStart,0]=invCountStart
+            P[:,1]=Pmax-P[:,0]
+            for nt in range(nGeneration):
+                whereSettle=zeros((Ndomain,2),dtype=int64)
+                for nsp,R in ((0,R0),(1,R1)):
+                    pkm.disperseLarvae(P[:,nsp],R,*E,rng,whereSettle[:,nsp],dispersalMode)
+                P=recruitDenseP(whereSettle,Pmax,rng)
+                denseTotal[n,nt]=P[:,0].sum()
+
+        #some runs die out, and some do not
+        assert 0.1<(denseTotal[:,-1]>0).mean()<0.9
+        for statistic in (lambda total: total>0,lambda total: total):
+            frontierMean,frontierVar=meanAndVar(statistic(frontierTotal))
+            denseMean,denseVar=meanAndVar(statistic(denseTotal))
+            assert closeMeans(frontierMean,frontierVar,denseMean,denseVar)
+
+def test_isStationary():
+    rng=np.random.default_rng(40)
+    window=200; tolerance=0.02
+
+    #too short to tell, or a window too short to split into batches
+    assert not pkm.isStationary(full((window-1,),500.0),window,tolerance)
+    assert not pkm.isStationary(full((50,),500.0),5,tolerance)
+
+    #a constant series, or one with noise but no trend, is stationary,
+    #and only the last window values count
+    assert pkm.isStationary(full((window,),500.0),window,tolerance)
+    noisy=500.0+rng.normal(0.0,5.0,3*window)
+    assert pkm.isStationary(noisy,window,tolerance)
+    assert pkm.isStationary(concatenate((linspace(0.0,500.0,1000),noisy)),window,tolerance)
+
+    #a trend of more than the tolerance over the window is not
+    assert not pkm.isStationary(linspace(500.0,600.0,window),window,tolerance)
+    assert not pkm.isStationary(linspace(500.0,400.0,window)+rng.normal(0.0,5.0,window),window,tolerance)
+
+    #nor is noise too large to rule such a trend out
+    assert not pkm.isStationary(500.0+rng.normal(0.0,200.0,window),window,tolerance)
+
+    #an extinct population is not stationary; the run stops as extinct instead
+    assert not pkm.isStationary(zeros((window,)),window,tolerance)
+
+def test_stopReasons():
+    modelOutput={'stopReasonVec':array([pkm.stopReasons[key] for key in ('Tmax','extinct','fixed','stationary')]),
+                 'ntVecFinal':array([9,3,5,6])}
+    assert array_equal(pkm.didPersist(modelOutput,10),[True,False,True,False])
+    assert array_equal(pkm.didStopStationary(modelOutput),[False,False,False,True])
+
+    #output from before runs could stop early
+    del modelOutput['stopReasonVec']
+    assert array_equal(pkm.didPersist(modelOutput,10),[True,False,False,False])
+    assert not pkm.didStopStationary(modelOutput).any()